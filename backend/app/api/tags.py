@@ -1,41 +1,76 @@
 """标签相关API路由"""
-from fastapi import APIRouter, HTTPException
-from typing import List, Dict
+from fastapi import APIRouter, HTTPException, Query
+from typing import List, Dict, Optional
 from PIL import Image
+import asyncio
 import logging
 
 from ..models.tag_models import TagMatchRequest, ImageTagResult
-from ..services.wd_tagger import get_wd_tagger
 from ..services.tag_matcher import get_tag_matcher
+from ..services.batch_scheduler import get_batch_scheduler, TaggerQueueFullError
+from ..services.tag_cache import get_tag_cache
+from ..services.model_warmup import get_model_warmup
+from ..services.model_pool import get_model_pool
 from ..utils.config import config
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/tags", tags=["tags"])
 
-# 获取服务实例
-wd_tagger = get_wd_tagger()
+# 获取服务实例（WD Tagger 由 _get_tagger() 按需获取，导入路由时不加载模型）
 tag_matcher = get_tag_matcher()
 
+def _get_tagger(model: Optional[str] = None):
+    """获取已加载的WD Tagger；模型尚未加载完成时返回503，由客户端稍后重试
+
+    默认模型由后台预热加载（未启用预热或上次加载失败时由本次请求在后台开始加载）；
+    指定其他模型时从多模型池中获取，首次使用时在后台线程加载，不在请求处理中阻塞事件循环。
+    """
+    if model and model != config.WD_MODEL_NAME:
+        try:
+            tagger = get_model_pool().get_if_loaded(model)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"模型加载失败: {e}")
+        if tagger is None:
+            raise HTTPException(status_code=503, detail=f"模型 {model} 加载中，请稍后重试")
+        return tagger
+    
+    try:
+        ready = get_model_warmup().check_ready()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"模型加载失败: {e}")
+    if not ready:
+        raise HTTPException(status_code=503, detail="模型加载中，请稍后重试")
+    from ..services.wd_tagger import get_wd_tagger
+    return get_wd_tagger()
+
 @router.post("/analyze-image", response_model=ImageTagResult)
 async def analyze_single_image(
     image_path: str,
     general_threshold: float = 0.35,
-    character_threshold: float = 0.75
+    character_threshold: float = 0.75,
+    model: Optional[str] = None
 ):
-    """分析单张图片的标签"""
+    """分析单张图片的标签（model 为空时使用默认模型）"""
     try:
         if not config.validate_file_path(image_path, "image"):
             raise HTTPException(status_code=400, detail="无效的图片文件路径")
         
+        _get_tagger(model)
         image = Image.open(image_path)
-        result = wd_tagger.tag_single_image(
-            image=image,
+        result = await get_batch_scheduler(model).tag(
+            image,
             general_threshold=general_threshold,
             character_threshold=character_threshold
         )
         result.filename = image_path
         
         return result
+    except TaggerQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"分析图片标签失败: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -44,7 +79,8 @@ async def analyze_single_image(
 async def analyze_multiple_images(
     image_paths: List[str],
     general_threshold: float = 0.35,
-    character_threshold: float = 0.75
+    character_threshold: float = 0.75,
+    model: Optional[str] = None
 ):
     """批量分析图片标签"""
     try:
@@ -53,29 +89,62 @@ async def analyze_multiple_images(
             if not config.validate_file_path(path, "image"):
                 raise HTTPException(status_code=400, detail=f"无效的图片文件路径: {path}")
         
-        # 加载图片
-        images = []
-        for path in image_paths:
-            image = Image.open(path)
-            images.append(image)
-        
-        # 批量分析
-        results = wd_tagger.batch_tag_images(
-            images=images,
+        # 批量分析（按批次打开图片）
+        results = _get_tagger(model).batch_tag_images(
+            images=image_paths,
             filenames=image_paths,
             general_threshold=general_threshold,
             character_threshold=character_threshold
         )
         
         return results
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"批量分析图片标签失败: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/embeddings")
+async def extract_image_embeddings(
+    image_paths: List[str],
+    include_tags: bool = True,
+    general_threshold: float = 0.35,
+    character_threshold: float = 0.75,
+    model: Optional[str] = None
+):
+    """提取图片的池化特征（L2归一化），可同时返回同一次前向推理得到的标签"""
+    try:
+        for path in image_paths:
+            if not config.validate_file_path(path, "image"):
+                raise HTTPException(status_code=400, detail=f"无效的图片文件路径: {path}")
+        
+        from ..services.embedding_prefilter import l2_normalize
+        results, embeddings = _get_tagger(model).tag_images_with_embeddings(
+            images=image_paths,
+            filenames=image_paths,
+            general_threshold=general_threshold,
+            character_threshold=character_threshold
+        )
+        
+        response = {
+            "success": True,
+            "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            "embeddings": l2_normalize(embeddings).tolist()
+        }
+        if include_tags:
+            response["tags"] = results
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"提取图片特征失败: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.post("/create-match-request")
 async def create_match_request_from_references(
     reference_image_paths: List[str],
-    min_confidence: float = 0.7
+    min_confidence: float = 0.7,
+    model: Optional[str] = None
 ):
     """根据参考图片自动创建匹配请求"""
     try:
@@ -84,13 +153,13 @@ async def create_match_request_from_references(
             if not config.validate_file_path(path, "image"):
                 raise HTTPException(status_code=400, detail=f"无效的图片文件路径: {path}")
         
-        # 分析参考图片
-        reference_results = []
-        for path in reference_image_paths:
-            image = Image.open(path)
-            result = wd_tagger.tag_single_image(image)
+        # 分析参考图片（并发提交，由调度器合并为批次）
+        _get_tagger(model)
+        reference_results = await asyncio.gather(*[
+            get_batch_scheduler(model).tag(Image.open(path)) for path in reference_image_paths
+        ])
+        for path, result in zip(reference_image_paths, reference_results):
             result.filename = path
-            reference_results.append(result)
         
         # 创建匹配请求
         match_request = tag_matcher.create_reference_match_request(
@@ -102,27 +171,82 @@ async def create_match_request_from_references(
             "match_request": match_request,
             "reference_analysis": reference_results
         }
+    except TaggerQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"创建匹配请求失败: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.get("/vocabulary")
+async def search_vocabulary(
+    prefix: str = "",
+    category: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=500),
+    model: Optional[str] = None
+):
+    """按前缀补全标签名（空格视为下划线，不区分大小写），可按类别过滤，按标签频次排序"""
+    vocabulary = _get_tagger(model).vocabulary
+    try:
+        total, tags = vocabulary.search(prefix, category=category, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "success": True,
+        "prefix": prefix,
+        "total": total,
+        "tags": tags
+    }
+
 @router.get("/model-info")
-async def get_model_info():
-    """获取WD Tagger模型信息"""
+async def get_model_info(model: Optional[str] = None):
+    """获取WD Tagger模型信息，以及多模型池的占用情况"""
     try:
-        info = wd_tagger.get_model_info()
+        info = _get_tagger(model).get_model_info()
         return {
             "success": True,
-            "model_info": info
+            "model_info": info,
+            "model_pool": get_model_pool().get_stats()
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"获取模型信息失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/batching-stats")
+async def get_batching_stats(model: Optional[str] = None):
+    """获取微批调度器统计（批次填充率、排队等待时间）"""
+    return {
+        "success": True,
+        "stats": get_batch_scheduler(model).get_stats()
+    }
+
+@router.get("/cache-stats")
+async def get_cache_stats():
+    """获取标注结果缓存统计（命中/未命中次数、容量）"""
+    tag_cache = get_tag_cache()
+    return {
+        "success": True,
+        "enabled": tag_cache is not None,
+        "stats": tag_cache.get_stats() if tag_cache is not None else {}
+    }
+
+@router.delete("/cache")
+async def clear_cache():
+    """清空标注结果缓存"""
+    tag_cache = get_tag_cache()
+    if tag_cache is None:
+        raise HTTPException(status_code=400, detail="标注结果缓存未启用")
+    tag_cache.clear()
+    return {"success": True, "message": "标注结果缓存已清空"}
+
 @router.post("/test-match")
 async def test_tag_matching(
     test_image_path: str,
-    match_request: TagMatchRequest
+    match_request: TagMatchRequest,
+    model: Optional[str] = None
 ):
     """测试标签匹配"""
     try:
@@ -130,8 +254,9 @@ async def test_tag_matching(
             raise HTTPException(status_code=400, detail="无效的图片文件路径")
         
         # 分析测试图片
+        _get_tagger(model)
         image = Image.open(test_image_path)
-        image_tags = wd_tagger.tag_single_image(image)
+        image_tags = await get_batch_scheduler(model).tag(image)
         image_tags.filename = test_image_path
         
         # 进行匹配
@@ -142,6 +267,10 @@ async def test_tag_matching(
             "image_tags": image_tags,
             "match_result": match_result
         }
+    except TaggerQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"测试标签匹配失败: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -1,5 +1,5 @@
 """视频处理相关API路由"""
-from fastapi import APIRouter, HTTPException, BackgroundTasks, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, BackgroundTasks, UploadFile, File, Form, Query
 from typing import List, Optional
 import logging
 import os
@@ -9,7 +9,6 @@ from pathlib import Path
 from ..models.video_models import (
     VideoProcessRequest, ProcessingStatus, ProcessingResult, VideoInfo
 )
-from ..services.video_processor import get_video_processor
 from ..services.frame_extractor import VideoFrameExtractor
 from ..utils.config import config
 
@@ -17,9 +16,13 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/video", tags=["video"])
 
 # 获取服务实例
-video_processor = get_video_processor()
 frame_extractor = VideoFrameExtractor()
 
+def _get_video_processor():
+    """首次使用时再导入视频处理服务（依赖torch和标注模型），加快服务启动"""
+    from ..services.video_processor import get_video_processor
+    return get_video_processor()
+
 @router.post("/process", response_model=dict)
 async def start_video_processing(request: VideoProcessRequest):
     """开始视频处理任务"""
@@ -83,12 +86,24 @@ async def start_video_processing(request: VideoProcessRequest):
                     'quality_threshold': request.config.quality_threshold,
                     'tag_threshold': request.config.tag_threshold,
                     'character_tag_threshold': request.config.character_tag_threshold,
-                    'batch_size': request.config.batch_size
+                    'palette_prefilter': getattr(request.config, 'palette_prefilter', config.PALETTE_PREFILTER),
+                    'palette_similarity_threshold': getattr(request.config, 'palette_similarity_threshold',
+                                                            config.PALETTE_SIMILARITY_THRESHOLD),
+                    'embedding_prefilter': getattr(request.config, 'embedding_prefilter', config.EMBEDDING_PREFILTER),
+                    'embedding_keep_ratio': getattr(request.config, 'embedding_keep_ratio', config.EMBEDDING_KEEP_RATIO),
+                    'bucket_preset': getattr(request.config, 'bucket_preset', config.BUCKET_PRESET),
+                    'bucket_crop_mode': getattr(request.config, 'bucket_crop_mode', config.BUCKET_CROP_MODE),
+                    'phash_library': getattr(request.config, 'phash_library', config.PHASH_LIBRARY),
+                    'scene_tagging': getattr(request.config, 'scene_tagging', config.SCENE_TAGGING),
+                    'store_tag_probs': getattr(request.config, 'store_tag_probs', config.TAG_PROBS_STORE),
+                    'store_embeddings': getattr(request.config, 'store_embeddings', config.TAG_EMBEDDINGS_STORE),
+                    'tagger_model': getattr(request.config, 'tagger_model', None) or config.WD_MODEL_NAME,
+                    'batch_size': config.explicit_option(request.config, 'batch_size')
                 })()
             })()
 
             # 启动处理任务
-            task_id = await video_processor.start_video_processing(legacy_request)
+            task_id = await _get_video_processor().start_video_processing(legacy_request)
             task_ids.append(task_id)
             processed_videos.append(video_path)
 
@@ -113,7 +128,7 @@ async def start_video_processing(request: VideoProcessRequest):
 @router.get("/status/{task_id}", response_model=ProcessingStatus)
 async def get_task_status(task_id: str):
     """获取任务处理状态"""
-    status = video_processor.get_task_status(task_id)
+    status = _get_video_processor().get_task_status(task_id)
     if not status:
         raise HTTPException(status_code=404, detail="任务不存在")
     return status
@@ -121,16 +136,95 @@ async def get_task_status(task_id: str):
 @router.get("/tasks", response_model=List[ProcessingStatus])
 async def get_all_tasks():
     """获取所有任务状态"""
-    return video_processor.get_all_tasks()
+    return _get_video_processor().get_all_tasks()
 
 @router.delete("/task/{task_id}")
 async def cancel_task(task_id: str):
     """取消任务"""
-    success = video_processor.cancel_task(task_id)
+    success = _get_video_processor().cancel_task(task_id)
     if not success:
         raise HTTPException(status_code=400, detail="无法取消任务")
     return {"success": True, "message": "任务已取消"}
 
+@router.post("/rethreshold")
+async def rethreshold_task(output_directory: str,
+                           general_threshold: float = config.GENERAL_TAG_THRESHOLD,
+                           character_threshold: float = config.CHARACTER_TAG_THRESHOLD,
+                           rematch: bool = True):
+    """用任务目录中保存的概率矩阵重新阈值化、匹配并导出（不重新推理）"""
+    try:
+        result = await _get_video_processor().rethreshold_task(
+            output_directory, general_threshold, character_threshold, rematch=rematch
+        )
+        return {"success": True, **result}
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"重新阈值化失败: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/tag-cooccurrence")
+async def analyze_tag_cooccurrence(output_directory: str,
+                                   query_tags: List[str] = Query(...),
+                                   general_threshold: float = config.GENERAL_TAG_THRESHOLD,
+                                   character_threshold: float = config.CHARACTER_TAG_THRESHOLD,
+                                   top_k: int = Query(20, ge=1, le=500),
+                                   min_count: int = Query(2, ge=1),
+                                   sort_by: str = "lift"):
+    """统计任务帧中与查询标签（如角色标签）共同出现的标签：共现次数、条件概率、lift、PMI"""
+    try:
+        result = _get_video_processor().analyze_tag_cooccurrence(
+            output_directory, query_tags, general_threshold, character_threshold,
+            top_k=top_k, min_count=min_count, sort_by=sort_by
+        )
+        return {"success": True, **result}
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"标签共现分析失败: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/tag-distribution")
+async def analyze_tag_distribution(output_directory: str,
+                                   general_threshold: float = config.GENERAL_TAG_THRESHOLD,
+                                   character_threshold: float = config.CHARACTER_TAG_THRESHOLD,
+                                   top_k: int = Query(20, ge=1, le=500)):
+    """按给定阈值统计任务帧的标签分布与评级分布（基于保存的概率矩阵，不重新推理）"""
+    try:
+        result = _get_video_processor().analyze_tag_distribution(
+            output_directory, general_threshold, character_threshold, top_k=top_k
+        )
+        return {"success": True, **result}
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"标签分布统计失败: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/similar-frames")
+async def search_similar_frames(output_directory: str,
+                                query_image_paths: Optional[List[str]] = None,
+                                frame_filename: Optional[str] = None,
+                                top_k: int = 20):
+    """按池化特征余弦相似度检索任务中最相似的帧"""
+    try:
+        for path in query_image_paths or []:
+            if not config.validate_file_path(path, "image"):
+                raise HTTPException(status_code=400, detail=f"无效的图片文件路径: {path}")
+        
+        results = _get_video_processor().search_similar_frames(
+            output_directory, query_image_paths=query_image_paths,
+            frame_filename=frame_filename, top_k=top_k
+        )
+        return {"success": True, "results": results}
+    except HTTPException:
+        raise
+    except (FileNotFoundError, KeyError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"相似帧检索失败: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/info")
 async def get_video_info(video_path: str):
     """获取视频基本信息"""
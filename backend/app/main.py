@@ -8,6 +8,7 @@ from pathlib import Path
 
 from .api.video import router as video_router
 from .api.tags import router as tags_router
+from .services.model_warmup import get_model_warmup
 from .utils.config import config
 
 # 配置日志
@@ -54,18 +55,42 @@ async def root():
         "status": "running"
     }
 
+@app.on_event("startup")
+async def start_model_warmup():
+    """启动后在后台线程加载模型，不阻塞端口监听"""
+    if config.TAGGER_BACKGROUND_WARMUP:
+        get_model_warmup().start_background()
+
+@app.get("/api/health/live")
+async def liveness_check():
+    """存活检查：进程可以响应请求即返回200，不依赖模型"""
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+async def readiness_check():
+    """就绪检查：模型加载完成后返回200，加载中或失败时返回503"""
+    warmup_status = get_model_warmup().get_status()
+    if warmup_status['state'] != "ready":
+        return JSONResponse(
+            status_code=503,
+            content={"status": "not_ready", "model": warmup_status}
+        )
+    return {"status": "ready", "model": warmup_status}
+
 @app.get("/api/health")
 async def health_check():
-    """健康检查"""
+    """健康检查（不会触发模型加载，模型就绪后附带模型信息）"""
     try:
-        # 检查模型是否正常加载
-        from .services.wd_tagger import get_wd_tagger
-        tagger = get_wd_tagger()
-        model_info = tagger.get_model_info()
+        warmup = get_model_warmup()
+        model_info = None
+        if warmup.is_ready:
+            from .services.wd_tagger import get_wd_tagger
+            model_info = get_wd_tagger().get_model_info()
         
         return {
             "status": "healthy",
-            "model_loaded": True,
+            "model_loaded": warmup.is_ready,
+            "model_status": warmup.get_status(),
             "model_info": model_info,
             "config": {
                 "device": config.DEVICE,
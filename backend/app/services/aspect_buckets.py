@@ -0,0 +1,132 @@
+"""训练分桶输出服务 - 在保存帧时直接缩放裁剪到SD/SDXL训练宽高比分桶"""
+import cv2
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional, Any
+import logging
+
+from ..utils.config import config
+
+logger = logging.getLogger(__name__)
+
+# 预设分桶的基准分辨率（分桶面积不超过 基准分辨率²）
+BUCKET_PRESETS = {
+    'sd': 512,
+    'sd2': 768,
+    'sdxl': 1024
+}
+
+def generate_buckets(base_resolution: int, step: int = 64,
+                     max_aspect_ratio: float = 2.0) -> List[Tuple[int, int]]:
+    """生成宽高为step倍数、面积不超过base_resolution²的分桶列表（与kohya分桶规则一致）"""
+    max_area = base_resolution * base_resolution
+    min_size = base_resolution // 2
+    max_size = base_resolution * 2
+    buckets = set()
+
+    width = min_size
+    while width <= max_size:
+        height = min(max_size, (max_area // width) // step * step)
+        if height >= min_size and max(width, height) / min(width, height) <= max_aspect_ratio:
+            buckets.add((width, height))
+            buckets.add((height, width))
+        width += step
+
+    return sorted(buckets)
+
+def resolve_cascade_path(cascade_path: str) -> str:
+    """级联文件路径：只给出文件名且本地不存在时，在 OpenCV 自带的级联目录中查找"""
+    path = Path(cascade_path)
+    if not path.exists() and path.name == cascade_path:
+        bundled = Path(cv2.data.haarcascades) / cascade_path
+        if bundled.exists():
+            return str(bundled)
+    return cascade_path
+
+class AspectBucketWriter:
+    """按宽高比选择最接近的分桶，缩放并裁剪帧
+
+    face 裁剪默认使用动漫人脸检测器 lbpcascade_animeface（OpenCV 自带的真人人脸级联在动漫画面上几乎检测不到），
+    级联文件可通过 face_cascade_path 或 BUCKET_FACE_CASCADE 指定；无法加载时回退到中心裁剪。
+    """
+
+    def __init__(self, preset: str = 'sdxl', crop_mode: str = 'center',
+                 face_cascade_path: Optional[str] = None):
+        if preset not in BUCKET_PRESETS:
+            raise ValueError(f"未知的分桶预设: {preset}，可选: {list(BUCKET_PRESETS.keys())}")
+
+        self.preset = preset
+        self.crop_mode = crop_mode
+        self.buckets = generate_buckets(BUCKET_PRESETS[preset])
+        self._bucket_log_ratios = np.log(np.array([w / h for w, h in self.buckets]))
+        self.face_detector = None
+
+        if crop_mode == 'face':
+            try:
+                cascade_path = resolve_cascade_path(face_cascade_path or config.BUCKET_FACE_CASCADE)
+                if not Path(cascade_path).exists():
+                    raise FileNotFoundError(
+                        f"级联文件不存在: {cascade_path}（动漫人脸检测器可从 "
+                        f"https://github.com/nagadomi/lbpcascade_animeface 下载）")
+                detector = cv2.CascadeClassifier(cascade_path)
+                if detector.empty():
+                    raise ValueError(f"级联文件为空: {cascade_path}")
+                self.face_detector = detector
+            except Exception as e:
+                logger.warning(f"无法加载人脸检测模型，回退到中心裁剪: {e}")
+                self.crop_mode = 'center'
+
+        logger.info(f"训练分桶: 预设 {preset}, {len(self.buckets)} 个分桶, 裁剪模式 {self.crop_mode}")
+
+    def assign_bucket(self, width: int, height: int) -> Tuple[int, int]:
+        """选择宽高比（对数距离）最接近的分桶"""
+        index = int(np.argmin(np.abs(self._bucket_log_ratios - np.log(width / height))))
+        return self.buckets[index]
+
+    def _detect_focus(self, image: np.ndarray) -> Optional[Tuple[float, float]]:
+        """检测人脸并返回所有人脸包围框的中心点，未检测到时返回None"""
+        height, width = image.shape[:2]
+        scale = min(1.0, 640 / max(height, width))
+        small = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+
+        faces = self.face_detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(24, 24))
+        if len(faces) == 0:
+            return None
+
+        x0 = min(x for x, _, _, _ in faces)
+        y0 = min(y for _, y, _, _ in faces)
+        x1 = max(x + w for x, _, w, _ in faces)
+        y1 = max(y + h for _, y, _, h in faces)
+        return ((x0 + x1) / 2 / scale, (y0 + y1) / 2 / scale)
+
+    def process(self, image: np.ndarray) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """缩放裁剪到分桶尺寸，返回处理后的图像和分桶信息"""
+        height, width = image.shape[:2]
+        bucket_width, bucket_height = self.assign_bucket(width, height)
+
+        # 在原图坐标中确定与分桶同宽高比的最大裁剪区域，再一次性缩放
+        scale = max(bucket_width / width, bucket_height / height)
+        crop_width = min(width, int(round(bucket_width / scale)))
+        crop_height = min(height, int(round(bucket_height / scale)))
+
+        focus = None
+        if self.face_detector is not None:
+            focus = self._detect_focus(image)
+        center_x, center_y = focus if focus is not None else (width / 2, height / 2)
+
+        x = int(np.clip(round(center_x - crop_width / 2), 0, width - crop_width))
+        y = int(np.clip(round(center_y - crop_height / 2), 0, height - crop_height))
+
+        cropped = image[y:y + crop_height, x:x + crop_width]
+        interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LANCZOS4
+        resized = cv2.resize(cropped, (bucket_width, bucket_height), interpolation=interpolation)
+
+        bucket_info = {
+            'preset': self.preset,
+            'resolution': [bucket_width, bucket_height],
+            'source_size': [width, height],
+            'crop_box': [x, y, crop_width, crop_height],
+            'crop_mode': 'face' if focus is not None else 'center'
+        }
+        return resized, bucket_info
@@ -0,0 +1,177 @@
+"""推理批次大小自动调优 - 按实测吞吐量与峰值内存选择批次大小，并在内存不足时退避"""
+import json
+import time
+from pathlib import Path
+from typing import List, Dict, Optional, Sequence, Any
+import torch
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CANDIDATES = (1, 2, 4, 8, 16, 32, 64)
+
+def is_oom_error(error: BaseException) -> bool:
+    """是否为内存分配失败（CUDA显存不足 / CPU分配失败）"""
+    if isinstance(error, MemoryError):
+        return True
+    if hasattr(torch.cuda, "OutOfMemoryError") and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+def release_memory(device: str):
+    """分配失败后释放缓存的显存"""
+    if device == "cuda" and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def _read_proc_status_mb(key: str) -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+class PeakMemoryMeter:
+    """测量一段推理的峰值内存（MB）
+
+    CUDA使用分配器的峰值统计；CPU在Linux上重置并读取进程RSS高水位（VmHWM），
+    无法重置时退化为推理后的RSS。
+    """
+
+    def __init__(self, device: str):
+        self.device = device
+
+    def reset(self):
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            return
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")  # 把 VmHWM 重置为当前RSS
+        except OSError:
+            pass
+
+    def peak_mb(self) -> float:
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+            return torch.cuda.max_memory_allocated() / 1024 / 1024
+        return _read_proc_status_mb("VmHWM") or _read_proc_status_mb("VmRSS")
+
+    def default_limit_mb(self) -> float:
+        """未配置上限时：CUDA取显存总量的90%，CPU不设上限（只依赖分配失败退避）"""
+        if self.device == "cuda":
+            return torch.cuda.get_device_properties(0).total_memory / 1024 / 1024 * 0.9
+        return 0.0
+
+class BatchSizeAutotuner:
+    """对候选批次大小依次实测吞吐量和峰值内存
+
+    批次从小到大测试，遇到内存超限/分配失败或吞吐量明显下降时停止；
+    在吞吐量不低于最佳值 (1 - tolerance) 的批次中选最小的一个，兼顾延迟和内存。
+    结果按模型/设备/线程数/内存上限缓存到磁盘，重启后无需重新测量。
+    """
+
+    def __init__(self, tagger, candidates: Sequence[int] = DEFAULT_CANDIDATES,
+                 memory_limit_mb: float = 0.0, trials: int = 2, tolerance: float = 0.05,
+                 cache_path: Optional[Path] = None):
+        self.tagger = tagger
+        self.candidates = sorted(candidates)
+        self.meter = PeakMemoryMeter(tagger.device)
+        self.memory_limit_mb = memory_limit_mb or self.meter.default_limit_mb()
+        self.trials = max(1, trials)
+        self.tolerance = tolerance
+        self.cache_path = cache_path
+        self.measurements: List[Dict[str, Any]] = []
+
+    @property
+    def cache_key(self) -> str:
+        return (f"{self.tagger.cache_namespace}|{self.tagger.device}|{self.tagger.cpu_profile}|"
+                f"threads={torch.get_num_threads()}|limit={self.memory_limit_mb:.0f}|{self.candidates}")
+
+    def _load_cached(self) -> Optional[int]:
+        if self.cache_path is None or not self.cache_path.exists():
+            return None
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f).get(self.cache_key)
+        except (OSError, ValueError):
+            return None
+        if entry is None:
+            return None
+        self.measurements = entry['measurements']
+        return entry['batch_size']
+
+    def _save_cached(self, batch_size: int):
+        if self.cache_path is None:
+            return
+        try:
+            data = {}
+            if self.cache_path.exists():
+                with open(self.cache_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            data[self.cache_key] = {'batch_size': batch_size, 'measurements': self.measurements}
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+        except (OSError, ValueError) as e:
+            logger.warning(f"保存批次调优结果失败: {e}")
+
+    def _measure(self, batch_size: int) -> Dict[str, Any]:
+        """预热一次后计时 trials 次，返回吞吐量与峰值内存"""
+        batch_input = torch.randn(batch_size, 3, self.tagger.input_size, self.tagger.input_size)
+        self.tagger.run_model(batch_input)
+        self.meter.reset()
+        start = time.perf_counter()
+        for _ in range(self.trials):
+            self.tagger.run_model(batch_input)
+        elapsed = time.perf_counter() - start
+        return {
+            'batch_size': batch_size,
+            'images_per_sec': batch_size * self.trials / elapsed,
+            'peak_memory_mb': round(self.meter.peak_mb(), 1)
+        }
+
+    def calibrate(self) -> int:
+        """测量并返回最佳批次大小"""
+        cached = self._load_cached()
+        if cached is not None:
+            logger.info(f"使用缓存的批次调优结果: batch_size={cached}")
+            return cached
+
+        limit = f"{self.memory_limit_mb:.0f} MB" if self.memory_limit_mb else "无"
+        logger.info(f"开始批次大小调优: 候选 {self.candidates}, 内存上限 {limit}")
+        self.measurements = []
+        best_throughput = 0.0
+        for batch_size in self.candidates:
+            try:
+                measurement = self._measure(batch_size)
+            except Exception as e:
+                if not is_oom_error(e):
+                    raise
+                release_memory(self.tagger.device)
+                logger.info(f"batch_size={batch_size} 内存分配失败，停止调优")
+                break
+
+            self.measurements.append(measurement)
+            logger.info(f"batch_size={batch_size}: {measurement['images_per_sec']:.2f} 张/秒, "
+                        f"峰值内存 {measurement['peak_memory_mb']:.0f} MB")
+            if self.memory_limit_mb and measurement['peak_memory_mb'] > self.memory_limit_mb:
+                measurement['over_limit'] = True
+                break
+            if measurement['images_per_sec'] < best_throughput * (1 - self.tolerance):
+                break  # 已越过吞吐量拐点
+            best_throughput = max(best_throughput, measurement['images_per_sec'])
+
+        eligible = [m for m in self.measurements if not m.get('over_limit')]
+        if not eligible:
+            return 1
+        best_throughput = max(m['images_per_sec'] for m in eligible)
+        chosen = min(m['batch_size'] for m in eligible
+                     if m['images_per_sec'] >= best_throughput * (1 - self.tolerance))
+        logger.info(f"批次大小调优完成: batch_size={chosen}")
+        self._save_cached(chosen)
+        return chosen
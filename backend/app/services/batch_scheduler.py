@@ -0,0 +1,206 @@
+"""动态微批推理调度器 - 合并并发的单图标注请求为一次前向推理"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Callable, Optional, TYPE_CHECKING
+from PIL import Image
+import numpy as np
+import logging
+
+from ..models.tag_models import ImageTagResult
+from ..utils.config import config
+
+if TYPE_CHECKING:
+    from .wd_tagger import WDTaggerService
+
+logger = logging.getLogger(__name__)
+
+class TaggerQueueFullError(RuntimeError):
+    """推理队列已满"""
+
+@dataclass
+class _PendingRequest:
+    """排队中的单图标注请求"""
+    image: Image.Image
+    filename: str
+    general_threshold: Optional[float]  # 为None时直接返回概率向量
+    character_threshold: Optional[float]
+    future: Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+class TaggerBatchScheduler:
+    """位于 get_wd_tagger() 之前的微批调度器
+
+    后台线程从有界队列中收集请求，直到凑满 max_batch_size 张或等待超过 max_wait_ms，
+    然后执行一次前向推理，并按每个请求各自的阈值解码、回填对应的Future。
+    """
+
+    def __init__(self, tagger_factory: Optional[Callable[[], "WDTaggerService"]] = None,
+                 max_batch_size: int = 16,
+                 max_wait_ms: float = 10.0,
+                 max_queue_size: int = 256):
+        self.tagger_factory = tagger_factory
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[_PendingRequest]" = queue.Queue(maxsize=max_queue_size)
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'rejected': 0,
+            'cancelled': 0,
+            'batches': 0,
+            'total_queue_wait': 0.0,
+            'max_queue_wait': 0.0
+        }
+
+    def _ensure_worker(self):
+        """首次提交时启动后台推理线程"""
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="tagger-batch-scheduler", daemon=True)
+                self._worker.start()
+
+    def submit(self, image: Image.Image, filename: str = "",
+               general_threshold: float = 0.35,
+               character_threshold: float = 0.75) -> Future:
+        """提交单张图片，返回在批次完成后得到 ImageTagResult 的Future"""
+        self._ensure_worker()
+        request = _PendingRequest(image, filename, general_threshold, character_threshold, Future())
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            raise TaggerQueueFullError(f"推理队列已满 ({self._queue.maxsize})，请稍后重试")
+        return request.future
+
+    async def tag(self, image: Image.Image, filename: str = "",
+                  general_threshold: float = 0.35,
+                  character_threshold: float = 0.75) -> ImageTagResult:
+        """异步标注单张图片（不阻塞事件循环）"""
+        return await asyncio.wrap_future(
+            self.submit(image, filename, general_threshold, character_threshold)
+        )
+
+    async def predict(self, image: Image.Image) -> np.ndarray:
+        """异步获取单张图片的完整概率向量（不做阈值解码）"""
+        return await asyncio.wrap_future(self.submit(image, general_threshold=None, character_threshold=None))
+    
+    def _collect_batch(self) -> List[_PendingRequest]:
+        """阻塞等待第一个请求，然后在等待窗口内尽量凑满批次"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            # 标记为运行中，之后不能再被取消；等待方已断开（Future已取消）的请求直接丢弃
+            running = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if len(running) < len(batch):
+                with self._stats_lock:
+                    self._stats['cancelled'] += len(batch) - len(running)
+            batch = running
+            if not batch:
+                continue
+            started_at = time.perf_counter()
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                logger.error(f"微批推理失败: {e}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+            waits = [started_at - request.enqueued_at for request in batch]
+            with self._stats_lock:
+                self._stats['requests'] += len(batch)
+                self._stats['batches'] += 1
+                self._stats['total_queue_wait'] += sum(waits)
+                self._stats['max_queue_wait'] = max(self._stats['max_queue_wait'], max(waits))
+
+    def _process_batch(self, batch: List[_PendingRequest]):
+        """一次前向推理，再按阈值分组向量化解码"""
+        if self.tagger_factory is None:
+            from .wd_tagger import get_wd_tagger  # 延迟导入，避免导入调度器时加载torch
+            self.tagger_factory = get_wd_tagger
+        tagger = self.tagger_factory()
+        # 逐张记录解码/预处理失败，只让出错的请求失败，其余请求照常推理
+        errors: Dict[int, Exception] = {}
+        probs = tagger.predict_images([request.image for request in batch], errors=errors)
+
+        groups: Dict[Tuple[float, float], List[int]] = {}
+        for i, request in enumerate(batch):
+            if i in errors:
+                logger.warning(f"图片无法读取 {request.filename or '(未命名)'}: {errors[i]}")
+                request.future.set_exception(errors[i])
+                continue
+            if request.general_threshold is None:
+                request.future.set_result(probs[i])
+                continue
+            groups.setdefault((request.general_threshold, request.character_threshold), []).append(i)
+
+        for (general_threshold, character_threshold), indices in groups.items():
+            results = tagger.decoder.decode(
+                probs[indices],
+                filenames=[batch[i].filename for i in indices],
+                general_threshold=general_threshold,
+                character_threshold=character_threshold
+            )
+            for i, result in zip(indices, results):
+                batch[i].future.set_result(result)
+
+    def get_stats(self) -> Dict:
+        """批次填充率与排队等待时间统计"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        batches = stats['batches']
+        return {
+            'requests': stats['requests'],
+            'rejected': stats['rejected'],
+            'cancelled': stats['cancelled'],
+            'batches': batches,
+            'queue_size': self._queue.qsize(),
+            'max_queue_size': self._queue.maxsize,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'avg_batch_size': stats['requests'] / batches if batches else 0.0,
+            'avg_fill_rate': stats['requests'] / (batches * self.max_batch_size) if batches else 0.0,
+            'avg_queue_wait_ms': stats['total_queue_wait'] / stats['requests'] * 1000 if stats['requests'] else 0.0,
+            'max_queue_wait_ms': stats['max_queue_wait'] * 1000
+        }
+
+# 全局实例：每个模型一个调度器（同一批次只能使用同一个模型）
+_scheduler_instances: Dict[str, TaggerBatchScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+def get_batch_scheduler(model_name: Optional[str] = None) -> TaggerBatchScheduler:
+    """获取指定模型的微批调度器实例（未指定时为默认模型）"""
+    model_name = model_name or config.WD_MODEL_NAME
+    with _schedulers_lock:
+        scheduler = _scheduler_instances.get(model_name)
+        if scheduler is None:
+            def tagger_factory():
+                from .wd_tagger import get_wd_tagger  # 延迟导入，避免导入调度器时加载torch
+                return get_wd_tagger(model_name)
+            scheduler = TaggerBatchScheduler(
+                tagger_factory=tagger_factory,
+                max_batch_size=config.TAGGER_BATCH_MAX_SIZE,
+                max_wait_ms=config.TAGGER_BATCH_MAX_WAIT_MS,
+                max_queue_size=config.TAGGER_QUEUE_MAX_SIZE
+            )
+            _scheduler_instances[model_name] = scheduler
+    return scheduler
@@ -0,0 +1,105 @@
+"""参考图配色预筛选服务 - 在提取阶段用颜色签名快速排除不含目标角色的帧"""
+import cv2
+import numpy as np
+from typing import List, Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ReferencePaletteFilter:
+    """基于HSV色相/饱和度直方图的参考配色过滤器
+
+    每张参考图被压缩为一个紧凑的配色签名（主要颜色bin索引 + 权重），
+    候选帧只需计算一次小尺寸直方图即可与所有签名比较。
+    """
+
+    def __init__(self, reference_image_paths: List[str],
+                 min_similarity: float = 0.2,
+                 hue_bins: int = 18,
+                 saturation_bins: int = 8,
+                 max_signature_bins: int = 24,
+                 signature_mass: float = 0.85,
+                 expected_coverage: float = 0.1,
+                 min_value: int = 30,
+                 analysis_size: int = 256):
+        self.min_similarity = min_similarity
+        self.hue_bins = hue_bins
+        self.saturation_bins = saturation_bins
+        self.max_signature_bins = max_signature_bins
+        self.signature_mass = signature_mass
+        self.expected_coverage = expected_coverage  # 角色颜色在整帧中预期占比
+        self.min_value = min_value                  # 过暗像素色相不可靠，直接忽略
+        self.analysis_size = analysis_size
+        self.signatures: List[Dict[str, np.ndarray]] = []
+
+        for ref_path in reference_image_paths:
+            image = cv2.imread(str(ref_path), cv2.IMREAD_COLOR)
+            if image is None:
+                logger.warning(f"无法读取参考图片，跳过配色签名: {ref_path}")
+                continue
+            signature = self._build_signature(image)
+            if signature is None:
+                logger.warning(f"参考图片有效像素过少，跳过配色签名: {ref_path}")
+                continue
+            self.signatures.append(signature)
+
+        logger.info(f"已构建 {len(self.signatures)} 个参考配色签名")
+
+    @property
+    def is_active(self) -> bool:
+        """是否有可用的配色签名"""
+        return len(self.signatures) > 0
+
+    def _color_histogram(self, image: np.ndarray) -> np.ndarray:
+        """计算缩小尺寸后的归一化HS直方图（展平）"""
+        height, width = image.shape[:2]
+        scale = self.analysis_size / max(height, width)
+        if scale < 1.0:
+            image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, (0, 0, self.min_value), (180, 256, 256))
+        hist = cv2.calcHist([hsv], [0, 1], mask,
+                            [self.hue_bins, self.saturation_bins],
+                            [0, 180, 0, 256]).ravel()
+
+        total = hist.sum()
+        return hist / total if total > 0 else hist
+
+    def _build_signature(self, image: np.ndarray) -> Optional[Dict[str, np.ndarray]]:
+        """从参考图提取主要颜色bin作为签名"""
+        hist = self._color_histogram(image)
+        if hist.sum() <= 0:
+            return None
+
+        order = np.argsort(hist)[::-1][:self.max_signature_bins]
+
+        # 保留累计占比达到signature_mass的主要颜色
+        cumulative = np.cumsum(hist[order])
+        keep = int(np.searchsorted(cumulative, self.signature_mass) + 1)
+        bins = order[:keep]
+        weights = hist[bins]
+
+        return {
+            'bins': bins.astype(np.int32),
+            'weights': (weights / weights.sum()).astype(np.float32)
+        }
+
+    def score(self, frame: np.ndarray) -> float:
+        """计算帧与参考配色的相似度（0-1，取所有参考图中的最大值）
+
+        每个签名颜色在帧中的占比达到 expected_coverage * 参考占比 即视为完全出现，
+        得分为签名颜色的加权出现程度。
+        """
+        if not self.signatures:
+            return 1.0
+
+        hist = self._color_histogram(frame)
+        best = 0.0
+        for signature in self.signatures:
+            expected = signature['weights'] * self.expected_coverage
+            presence = np.minimum(hist[signature['bins']] / expected, 1.0)
+            best = max(best, float(np.dot(signature['weights'], presence)))
+
+        return best
@@ -0,0 +1,127 @@
+"""紧凑标注结果 - 用词表下标数组 + float16 置信度表示一批图片的标签（CSR布局）"""
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+from ..models.tag_models import ImageTagResult
+
+class CompactTagResults:
+    """一批图片的标注结果，按行（图片）连续存放通过阈值的标签
+
+    - offsets: (N+1,) int64，第 i 张图片的标签位于 [offsets[i], offsets[i+1])
+    - tag_ids: 词表下标（int16，词表超过32767个标签时为int32），类别由词表决定
+    - confidences: 与 tag_ids 对应的 float16 置信度
+    - ratings: (N, R) float16 评级概率，列顺序为 vocabulary.rating_names
+    - confidence_scores: (N,) 通过阈值标签的平均置信度
+    vocabulary 为构建结果的 TagDecoder。只有在API边界（返回给客户端、写出文件）时
+    才转换为字典形式的 ImageTagResult，匹配与统计直接在数组上进行。
+    """
+
+    def __init__(self, vocabulary, filenames: Sequence[str], offsets: np.ndarray,
+                 tag_ids: np.ndarray, confidences: np.ndarray,
+                 ratings: np.ndarray, confidence_scores: np.ndarray):
+        self.vocabulary = vocabulary
+        self.filenames = list(filenames)
+        self.offsets = offsets
+        self.tag_ids = tag_ids
+        self.confidences = confidences
+        self.ratings = ratings
+        self.confidence_scores = confidence_scores
+
+    @classmethod
+    def empty(cls, vocabulary) -> "CompactTagResults":
+        return cls(vocabulary, [], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=vocabulary.id_dtype),
+                   np.zeros(0, dtype=np.float16), np.zeros((0, len(vocabulary.rating_names)), dtype=np.float16),
+                   np.zeros(0, dtype=np.float32))
+
+    @classmethod
+    def concatenate(cls, parts: Sequence["CompactTagResults"], vocabulary=None) -> "CompactTagResults":
+        """按顺序拼接多个批次的结果"""
+        if not parts:
+            return cls.empty(vocabulary)
+        offsets = [np.zeros(1, dtype=np.int64)]
+        base = 0
+        for part in parts:
+            offsets.append(part.offsets[1:] + base)
+            base += int(part.offsets[-1])
+        return cls(
+            parts[0].vocabulary,
+            [filename for part in parts for filename in part.filenames],
+            np.concatenate(offsets),
+            np.concatenate([part.tag_ids for part in parts]),
+            np.concatenate([part.confidences for part in parts]),
+            np.concatenate([part.ratings for part in parts]),
+            np.concatenate([part.confidence_scores for part in parts])
+        )
+
+    def __len__(self) -> int:
+        return len(self.confidence_scores)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.offsets.nbytes + self.tag_ids.nbytes + self.confidences.nbytes +
+                self.ratings.nbytes + self.confidence_scores.nbytes)
+
+    @property
+    def tag_counts(self) -> np.ndarray:
+        """每张图片通过阈值的标签数"""
+        return np.diff(self.offsets)
+
+    def row_indices(self) -> np.ndarray:
+        """每个标签条目所属的图片下标，与 tag_ids 等长"""
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.tag_counts)
+
+    def row(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.tag_ids[start:end], self.confidences[start:end]
+
+    def take(self, indices: Sequence[int], filenames: Optional[Sequence[str]] = None) -> "CompactTagResults":
+        """按下标选取（可重复）图片的结果，filenames 为新结果的文件名"""
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.tag_counts[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(self.offsets[indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return CompactTagResults(
+            self.vocabulary,
+            filenames if filenames is not None else [self.filenames[i] for i in indices],
+            offsets,
+            self.tag_ids[positions],
+            self.confidences[positions],
+            self.ratings[indices],
+            self.confidence_scores[indices]
+        )
+
+    def column_confidences(self, tag_id: int) -> np.ndarray:
+        """某个标签在每张图片上的置信度 (N,)，未通过阈值的图片为NaN"""
+        column = np.full(len(self), np.nan, dtype=np.float32)
+        positions = np.flatnonzero(self.tag_ids == tag_id)
+        column[np.searchsorted(self.offsets, positions, side='right') - 1] = self.confidences[positions]
+        return column
+
+    def rating_column(self, rating_name: str) -> np.ndarray:
+        """某个评级在每张图片上的概率 (N,)，词表中没有该评级时为0"""
+        if rating_name not in self.vocabulary.rating_names:
+            return np.zeros(len(self), dtype=np.float32)
+        return self.ratings[:, self.vocabulary.rating_names.index(rating_name)].astype(np.float32)
+
+    def rating_dict(self, i: int) -> Dict[str, float]:
+        return dict(zip(self.vocabulary.rating_names, self.ratings[i].astype(np.float32).tolist()))
+
+    def tag_items(self, i: int) -> List[Tuple[str, float]]:
+        """第 i 张图片的 (标签名, 置信度) 列表，按置信度从高到低"""
+        tag_ids, confidences = self.row(i)
+        order = np.argsort(-confidences, kind='stable')
+        return list(zip(self.vocabulary.tag_names[tag_ids[order]].tolist(),
+                        confidences[order].astype(np.float32).tolist()))
+
+    def tag_dict(self, i: int) -> Dict[str, float]:
+        return dict(self.tag_items(i))
+
+    def to_image_tag_result(self, i: int) -> ImageTagResult:
+        """转换为字典形式的 ImageTagResult（仅在API边界使用）"""
+        return self.vocabulary.to_image_tag_result(
+            self.filenames[i], *self.row(i), self.rating_dict(i), float(self.confidence_scores[i])
+        )
+
+    def to_image_tag_results(self) -> List[ImageTagResult]:
+        return [self.to_image_tag_result(i) for i in range(len(self))]
@@ -0,0 +1,151 @@
+"""参考图特征相似度预筛选服务 - 在完整WD标注前按与参考图的余弦相似度排序帧"""
+import torch
+import numpy as np
+from PIL import Image
+from typing import List, Tuple, Optional, TYPE_CHECKING
+import torchvision.transforms as transforms
+import logging
+
+from ..models.video_models import ExtractedFrame
+from ..utils.config import config
+from .wd_tagger import get_wd_tagger
+
+if TYPE_CHECKING:
+    from .wd_tagger import WDTaggerService
+
+logger = logging.getLogger(__name__)
+
+def load_image_for_embedding(image_path: str, image_size: int) -> Image.Image:
+    """以低分辨率加载图片（JPEG使用draft模式直接按缩小的DCT尺度解码）"""
+    image = Image.open(image_path)
+    image.draft('RGB', (image_size, image_size))
+    return image.convert('RGB')
+
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    """按行L2归一化"""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+class FrameEmbedder:
+    """帧特征提取器
+
+    model_name 为空时复用WD Tagger主干的池化特征（使用调用方传入的标注器，未传入时为默认模型）；
+    否则在CPU上加载一个独立的轻量timm模型（如 mobilenetv3_small_100）。
+    """
+
+    def __init__(self, model_name: str = "", image_size: int = 224):
+        self.model_name = model_name
+        self.model = None
+        self.transform = None
+
+        if model_name:
+            import timm
+
+            logger.info(f"正在加载特征提取模型: {model_name}")
+            self.model = timm.create_model(model_name, pretrained=True, num_classes=0).eval()
+            data_config = self.model.pretrained_cfg
+            self.image_size = image_size
+            self.transform = transforms.Compose([
+                transforms.Resize((image_size, image_size)),
+                transforms.ToTensor(),
+                transforms.Normalize(
+                    mean=list(data_config.get('mean', (0.485, 0.456, 0.406))),
+                    std=list(data_config.get('std', (0.229, 0.224, 0.225)))
+                )
+            ])
+        else:
+            # WD v3 主干固定使用448x448输入
+            self.image_size = 448
+
+    def supports(self, tagger: Optional["WDTaggerService"] = None) -> bool:
+        """能否提取特征：复用WD Tagger主干时要求其后端支持特征提取（ONNX后端不支持）"""
+        if self.model is not None:
+            return True
+        return (tagger or get_wd_tagger()).embedding_dim > 0
+
+    def embed(self, images: List[Image.Image], batch_size: Optional[int] = None,
+              tagger: Optional["WDTaggerService"] = None) -> np.ndarray:
+        """提取归一化特征，返回 (N, D) float32 数组"""
+        if self.model is None:
+            tagger = tagger or get_wd_tagger()
+            return l2_normalize(tagger.extract_embeddings(images, batch_size=batch_size))
+
+        batch_size = batch_size or 16
+        embeddings = []
+        for i in range(0, len(images), batch_size):
+            batch_input = torch.stack([self.transform(image) for image in images[i:i + batch_size]])
+            with torch.no_grad():
+                embeddings.append(self.model(batch_input).float().numpy())
+
+        if not embeddings:
+            return np.zeros((0, self.model.num_features), dtype=np.float32)
+        return l2_normalize(np.concatenate(embeddings))
+
+    def embed_paths(self, image_paths: List[str], batch_size: Optional[int] = None,
+                    tagger: Optional["WDTaggerService"] = None) -> np.ndarray:
+        """分批低分辨率加载并提取特征，同一时间只保留一个批次的解码图片"""
+        batch_size = batch_size or 16
+        embeddings = []
+        for i in range(0, len(image_paths), batch_size):
+            batch_images = [load_image_for_embedding(path, self.image_size)
+                            for path in image_paths[i:i + batch_size]]
+            embeddings.append(self.embed(batch_images, batch_size=batch_size, tagger=tagger))
+
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+class ReferenceEmbeddingFilter:
+    """参考图特征相似度过滤器：只保留与参考图最相似的一部分帧"""
+
+    def __init__(self, embedder: FrameEmbedder,
+                 reference_image_paths: List[str],
+                 keep_ratio: float = 0.3,
+                 min_keep: int = 8,
+                 batch_size: Optional[int] = None,
+                 tagger: Optional["WDTaggerService"] = None):
+        self.embedder = embedder
+        self.keep_ratio = keep_ratio
+        self.min_keep = min_keep
+        self.batch_size = batch_size
+        self.tagger = tagger
+
+        # 参考图只需提取一次特征
+        self.reference_embeddings = embedder.embed_paths(reference_image_paths, batch_size=batch_size,
+                                                         tagger=tagger)
+        logger.info(f"已提取 {len(self.reference_embeddings)} 张参考图特征")
+
+    def score_paths(self, image_paths: List[str]) -> np.ndarray:
+        """计算每张图片与参考图的最大余弦相似度"""
+        if len(image_paths) == 0 or len(self.reference_embeddings) == 0:
+            return np.ones(len(image_paths), dtype=np.float32)
+
+        candidate_embeddings = self.embedder.embed_paths(image_paths, batch_size=self.batch_size,
+                                                         tagger=self.tagger)
+        similarities = candidate_embeddings @ self.reference_embeddings.T  # (N, R)
+        return similarities.max(axis=1)
+
+    def select_frames(self, frames: List[ExtractedFrame]) -> Tuple[List[ExtractedFrame], np.ndarray]:
+        """按相似度保留前 keep_ratio 比例的帧（保持原有顺序），返回保留的帧及全部得分"""
+        scores = self.score_paths([frame.image_path for frame in frames])
+
+        keep_count = min(len(frames), max(self.min_keep, int(np.ceil(len(frames) * self.keep_ratio))))
+        if keep_count >= len(frames):
+            return list(frames), scores
+
+        top_indices = np.argpartition(-scores, keep_count - 1)[:keep_count]
+        top_indices.sort()
+        return [frames[i] for i in top_indices], scores
+
+# 全局单例实例
+_embedder_instance: Optional[FrameEmbedder] = None
+
+def get_frame_embedder() -> FrameEmbedder:
+    """获取帧特征提取器实例（单例模式）"""
+    global _embedder_instance
+    if _embedder_instance is None:
+        _embedder_instance = FrameEmbedder(
+            model_name=config.EMBEDDING_MODEL_NAME,
+            image_size=config.EMBEDDING_IMAGE_SIZE
+        )
+    return _embedder_instance
@@ -0,0 +1,100 @@
+"""帧特征存储与相似度检索 - 按任务保存归一化的 float16 特征矩阵并做向量化余弦检索"""
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from pathlib import Path
+from typing import List, Dict, Sequence, Tuple
+import logging
+
+from .embedding_prefilter import l2_normalize
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILENAME = "frame_embeddings.npy"
+EMBEDDINGS_INFO_FILENAME = "frame_embeddings.json"
+
+class FrameEmbeddingWriter:
+    """把每帧的池化特征（L2归一化后）写入连续的 float16 矩阵 (num_frames, dim)"""
+
+    def __init__(self, output_dir: str, num_rows: int, dim: int, model_namespace: str = ""):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.model_namespace = model_namespace
+        self.matrix = open_memmap(str(self.output_dir / EMBEDDINGS_FILENAME), mode='w+',
+                                  dtype=np.float16, shape=(num_rows, dim))
+
+    def write(self, start: int, embeddings: np.ndarray):
+        """从第 start 行开始写入一个批次"""
+        self.matrix[start:start + len(embeddings)] = l2_normalize(embeddings)
+
+    def write_rows(self, rows: Sequence[int], embeddings: np.ndarray):
+        """写入到指定的若干行"""
+        self.matrix[np.asarray(rows, dtype=np.int64)] = l2_normalize(embeddings)
+
+    def copy_row(self, source: int, target: int):
+        """复制一行特征（场景级标注中传播给同场景帧）"""
+        self.matrix[target] = self.matrix[source]
+
+    def finalize(self, filenames: List[str]):
+        """刷新矩阵并写入行对应的帧文件名"""
+        self.matrix.flush()
+        info = {
+            'model': self.model_namespace,
+            'shape': list(self.matrix.shape),
+            'filenames': filenames
+        }
+        with open(self.output_dir / EMBEDDINGS_INFO_FILENAME, 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False)
+
+        logger.info(f"帧特征已保存: {self.output_dir / EMBEDDINGS_FILENAME} {tuple(self.matrix.shape)}")
+
+class FrameEmbeddingIndex:
+    """任务帧特征的余弦相似度检索（特征已归一化，余弦相似度即点积）"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = Path(output_dir)
+        info_path = self.output_dir / EMBEDDINGS_INFO_FILENAME
+        if not info_path.exists():
+            raise FileNotFoundError(f"任务目录中没有帧特征: {self.output_dir}")
+
+        with open(info_path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        self.model_namespace: str = info['model']
+        self.filenames: List[str] = info['filenames']
+        self.embeddings = np.load(self.output_dir / EMBEDDINGS_FILENAME, mmap_mode='r')
+
+    def __len__(self) -> int:
+        return self.embeddings.shape[0]
+
+    def embedding_of(self, filename: str) -> np.ndarray:
+        """按帧文件名取出特征向量"""
+        try:
+            return np.asarray(self.embeddings[self.filenames.index(filename)], dtype=np.float32)
+        except ValueError:
+            raise KeyError(f"任务中不存在帧: {filename}")
+
+    def similarities(self, queries: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+        """计算 (Q, D) 查询与全部帧的余弦相似度，返回 (Q, N)，按块读取内存映射矩阵"""
+        queries = l2_normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        scores = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            chunk = np.asarray(self.embeddings[start:start + chunk_size], dtype=np.float32)
+            scores[:, start:start + len(chunk)] = queries @ chunk.T
+        return scores
+
+    def search(self, queries: np.ndarray, top_k: int = 20) -> List[Tuple[str, float]]:
+        """返回与任一查询最相似的前 top_k 帧 (文件名, 相似度)，按相似度降序"""
+        if len(self) == 0:
+            return []
+        scores = self.similarities(queries).max(axis=0)
+        top_k = min(top_k, len(scores))
+        top_indices = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_indices = top_indices[np.argsort(-scores[top_indices])]
+        return [(self.filenames[i], float(scores[i])) for i in top_indices]
+
+    def get_info(self) -> Dict:
+        return {
+            'model': self.model_namespace,
+            'frames': len(self),
+            'dim': self.embeddings.shape[1]
+        }
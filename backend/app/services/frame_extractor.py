@@ -1,11 +1,14 @@
 """智能视频帧提取服务"""
 import cv2
 import numpy as np
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Any
 import logging
 from pathlib import Path
 
 from ..models.video_models import ExtractedFrame, FrameQuality, VideoInfo
+from .color_prefilter import ReferencePaletteFilter
+from .aspect_buckets import AspectBucketWriter
+from .phash_library import PerceptualHashLibrary, compute_phash, hamming_distance, source_video_key
 
 logger = logging.getLogger(__name__)
 
@@ -173,6 +176,9 @@ class VideoFrameExtractor:
     def __init__(self):
         self.scene_detector = SceneChangeDetector()
         self.quality_assessor = ImageQualityAssessor()
+        # 最近一次提取的附加帧信息（frame_id -> 字段），供导出元数据使用
+        self.frame_metadata: Dict[str, Dict[str, Any]] = {}
+        self.pending_phashes: List[Tuple[int, str]] = []  # (哈希, 帧路径)
     
     def get_video_info(self, video_path: str) -> VideoInfo:
         """获取视频基本信息"""
@@ -200,12 +206,24 @@ class VideoFrameExtractor:
             format=Path(video_path).suffix.lower()  # 添加格式字段
         )
     
+    def _match_pending_phash(self, phash: int, radius: int) -> Optional[Dict[str, Any]]:
+        """在本次已提取帧的哈希中查找重复镜头"""
+        for pending_hash, source in self.pending_phashes:
+            distance = hamming_distance(phash, pending_hash)
+            if distance <= radius:
+                return {'distance': distance, 'source': source}
+        return None
+    
     def extract_frames(self, video_path: str, 
                       output_dir: str,
                       max_frames: int = 200,
                       scene_change_threshold: float = 0.3,
                       quality_threshold: float = 0.6,
-                      progress_callback=None) -> Tuple[List[ExtractedFrame], VideoInfo]:
+                      progress_callback=None,
+                      palette_filter: Optional[ReferencePaletteFilter] = None,
+                      bucket_writer: Optional[AspectBucketWriter] = None,
+                      phash_library: Optional[PerceptualHashLibrary] = None,
+                      scene_segment_threshold: float = 0.4) -> Tuple[List[ExtractedFrame], VideoInfo]:
         """从视频中智能提取帧"""
         
         # 获取视频信息
@@ -220,9 +238,19 @@ class VideoFrameExtractor:
         extracted_frames = []
         frame_count = 0
         last_extract_frame = -10  # 避免连续提取
+        palette_rejected = 0
+        library_skipped = 0
+        scene_segment = 0     # 当前场景片段编号（镜头硬切时递增）
+        in_scene_cut = False
         
         # 重置检测器状态
         self.scene_detector = SceneChangeDetector()
+        self.frame_metadata = {}
+        # 本次提取帧的哈希，任务成功导出后才由调用方写入哈希库
+        self.pending_phashes = []
+        video_key = source_video_key(video_path)
+        if palette_filter is not None and not palette_filter.is_active:
+            palette_filter = None
         
         try:
             # 添加跳帧策略，避免处理每一帧
@@ -254,11 +282,25 @@ class VideoFrameExtractor:
                     frame_count += 1
                     continue
                 
+                # 场景片段划分：得分首次越过片段阈值时视为一次镜头切换
+                if scene_change > scene_segment_threshold and not in_scene_cut:
+                    scene_segment += 1
+                in_scene_cut = scene_change > scene_segment_threshold
+                
                 # 只在场景有显著变化时考虑提取
                 if scene_change > scene_change_threshold:
                     # 避免连续提取相似帧（增加最小间隔）
                     min_frame_interval = max(30, int(video_info.fps * 2))  # 至少2秒间隔
                     if frame_count - last_extract_frame > min_frame_interval:
+                        # 参考配色预筛选（比质量评估更廉价，先行排除）
+                        palette_score = None
+                        if palette_filter is not None:
+                            palette_score = palette_filter.score(frame)
+                            if palette_score < palette_filter.min_similarity:
+                                palette_rejected += 1
+                                frame_count += 1
+                                continue
+                        
                         # 质量评估（添加异常处理）
                         try:
                             quality = self.quality_assessor.assess_quality(frame)
@@ -268,14 +310,34 @@ class VideoFrameExtractor:
                             continue
                         
                         if quality.overall > quality_threshold:
+                            # 跨视频哈希库：已在其他视频中提取过的镜头（或本视频中已提取的镜头）直接跳过
+                            phash = None
+                            if phash_library is not None:
+                                phash = compute_phash(frame)
+                                library_match = phash_library.find_match(phash, exclude_video=video_key)
+                                if library_match is None:
+                                    library_match = self._match_pending_phash(phash, phash_library.radius)
+                                if library_match is not None:
+                                    library_skipped += 1
+                                    logger.debug(f"帧 {frame_count} 与哈希库条目重复 "
+                                               f"(距离={library_match['distance']}, 来源={library_match['source']})")
+                                    frame_count += 1
+                                    continue
+                            
                             timestamp = frame_count / video_info.fps
                             
                             # 保存帧（添加异常处理）
                             filename = f"frame_{len(extracted_frames):04d}_{frame_count:06d}.jpg"
                             frame_path = output_path / filename
                             
+                            # 训练分桶：直接写出缩放裁剪后的图像，避免下游二次解码/编码
+                            output_image = frame
+                            bucket_info = None
+                            if bucket_writer is not None:
+                                output_image, bucket_info = bucket_writer.process(frame)
+                            
                             try:
-                                success = cv2.imwrite(str(frame_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+                                success = cv2.imwrite(str(frame_path), output_image, [cv2.IMWRITE_JPEG_QUALITY, 95])
                                 if not success:
                                     logger.warning(f"保存帧失败 (帧{frame_count}): 写入失败")
                                     frame_count += 1
@@ -295,13 +357,21 @@ class VideoFrameExtractor:
                                 image_path=str(frame_path),
                                 scene_change_score=scene_change,
                                 quality_score=quality.overall,
-                                width=frame.shape[1],
-                                height=frame.shape[0],
+                                width=output_image.shape[1],
+                                height=output_image.shape[0],
                                 file_size=file_size
                             )
                             
                             extracted_frames.append(extracted_frame)
                             last_extract_frame = frame_count
+                            self.frame_metadata.setdefault(extracted_frame.frame_id, {})['scene_segment'] = scene_segment
+                            if palette_score is not None:
+                                self.frame_metadata.setdefault(extracted_frame.frame_id, {})['palette_score'] = palette_score
+                            if bucket_info is not None:
+                                self.frame_metadata.setdefault(extracted_frame.frame_id, {})['bucket'] = bucket_info
+                            if phash is not None:
+                                self.pending_phashes.append((phash, str(frame_path)))
+                                self.frame_metadata.setdefault(extracted_frame.frame_id, {})['phash'] = f"{phash:016x}"
                             
                             logger.info(f"提取帧 {frame_count} (t={timestamp:.1f}s, "
                                       f"scene={scene_change:.3f}, quality={quality.overall:.3f})")
@@ -311,5 +381,9 @@ class VideoFrameExtractor:
         finally:
             cap.release()
         
-        logger.info(f"总共提取 {len(extracted_frames)} 帧")
+        if palette_filter is not None:
+            logger.info(f"配色预筛选排除 {palette_rejected} 帧")
+        if phash_library is not None:
+            logger.info(f"哈希库跳过 {library_skipped} 个重复镜头")
+        logger.info(f"总共提取 {len(extracted_frames)} 帧 (共 {scene_segment + 1} 个场景片段)")
         return extracted_frames, video_info
@@ -0,0 +1,194 @@
+"""多模型标注池 - 按需加载不同的WD Tagger变体，按内存预算做LRU淘汰"""
+import gc
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence, TYPE_CHECKING
+import logging
+
+from ..utils.config import config
+
+if TYPE_CHECKING:
+    from .wd_tagger import WDTaggerService
+
+logger = logging.getLogger(__name__)
+
+class TaggerModelPool:
+    """模型名 -> WDTaggerService 的LRU池
+
+    - 同一模型的并发请求共享一次加载（后到的请求等待先到请求的Future）
+    - 加载完成后按各模型 get_model_size_mb() 之和检查内存预算，超出时淘汰最久未使用的模型
+    - 默认模型（WD_MODEL_NAME）常驻，不参与淘汰
+    被淘汰的模型只是从池中移除，仍在执行的请求持有的引用释放后内存才会回收。
+    """
+
+    def __init__(self, memory_budget_mb: float = 0.0,
+                 allowed_models: Sequence[str] = (),
+                 pinned_models: Sequence[str] = (),
+                 tagger_factory: Optional[Callable[[str], "WDTaggerService"]] = None):
+        self.memory_budget_mb = memory_budget_mb  # 0 表示不限制
+        self.allowed_models = set(allowed_models) | set(pinned_models)
+        self.pinned_models = set(pinned_models)
+        self.tagger_factory = tagger_factory
+        self._models: "OrderedDict[str, WDTaggerService]" = OrderedDict()
+        self._sizes_mb: Dict[str, float] = {}
+        self._last_used: Dict[str, float] = {}
+        self._loading: Dict[str, Future] = {}
+        self._errors: Dict[str, Exception] = {}  # 后台加载失败，待下一次请求报告
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'loads': 0, 'shared_loads': 0, 'evictions': 0}
+
+    def _create(self, model_name: str) -> "WDTaggerService":
+        if self.tagger_factory is not None:
+            return self.tagger_factory(model_name)
+        from .wd_tagger import WDTaggerService
+        return WDTaggerService(model_name=model_name)
+
+    def check_allowed(self, model_name: str):
+        """模型不在允许列表中时抛出 ValueError（避免按请求下载任意模型）"""
+        if self.allowed_models and model_name not in self.allowed_models:
+            raise ValueError(f"不支持的标注模型: {model_name}，可选: {sorted(self.allowed_models)}")
+
+    def get(self, model_name: str) -> "WDTaggerService":
+        """获取模型，未加载时加载（阻塞），并更新其最近使用时间"""
+        self.check_allowed(model_name)
+
+        with self._lock:
+            tagger = self._models.get(model_name)
+            if tagger is not None:
+                self._models.move_to_end(model_name)
+                self._last_used[model_name] = time.time()
+                self._stats['hits'] += 1
+                return tagger
+            loading = self._loading.get(model_name)
+            is_owner = loading is None
+            if is_owner:
+                loading = Future()
+                self._loading[model_name] = loading
+            else:
+                self._stats['shared_loads'] += 1
+
+        if not is_owner:
+            return loading.result()
+
+        try:
+            tagger = self._create(model_name)
+        except Exception as e:
+            with self._lock:
+                self._loading.pop(model_name, None)
+            loading.set_exception(e)
+            raise
+
+        with self._lock:
+            self._models[model_name] = tagger
+            self._sizes_mb[model_name] = tagger.get_model_size_mb()
+            self._last_used[model_name] = time.time()
+            self._loading.pop(model_name, None)
+            self._stats['loads'] += 1
+            evicted = self._evict_over_budget(keep=model_name)
+        loading.set_result(tagger)
+
+        if evicted:
+            del evicted
+            gc.collect()
+            if tagger.device == "cuda":
+                from .batch_autotuner import release_memory
+                release_memory("cuda")
+        return tagger
+
+    def get_if_loaded(self, model_name: str) -> Optional["WDTaggerService"]:
+        """不阻塞的获取：已加载时返回模型，否则在后台线程开始加载并返回None
+
+        上一次后台加载失败时抛出该异常（只报告一次，之后的请求会重新加载）。
+        """
+        self.check_allowed(model_name)
+
+        with self._lock:
+            tagger = self._models.get(model_name)
+            if tagger is not None:
+                self._models.move_to_end(model_name)
+                self._last_used[model_name] = time.time()
+                self._stats['hits'] += 1
+                return tagger
+            if model_name in self._loading:
+                return None
+            error = self._errors.pop(model_name, None)
+        if error is not None:
+            raise error
+
+        threading.Thread(target=self._load_in_background, args=(model_name,),
+                         name=f"tagger-pool-load-{model_name}", daemon=True).start()
+        return None
+
+    def _load_in_background(self, model_name: str):
+        try:
+            self.get(model_name)
+        except Exception as e:
+            logger.error(f"后台加载模型失败 {model_name}: {e}")
+            with self._lock:
+                self._errors[model_name] = e
+
+    def _evict_over_budget(self, keep: str) -> List["WDTaggerService"]:
+        """淘汰最久未使用的模型直到满足预算（调用方持有锁），返回被淘汰的实例"""
+        evicted = []
+        if not self.memory_budget_mb:
+            return evicted
+        for model_name in list(self._models):
+            if self.total_size_mb <= self.memory_budget_mb:
+                break
+            if model_name == keep or model_name in self.pinned_models:
+                continue
+            evicted.append(self._models.pop(model_name))
+            size_mb = self._sizes_mb.pop(model_name)
+            self._last_used.pop(model_name, None)
+            self._stats['evictions'] += 1
+            logger.info(f"内存预算不足，已淘汰模型 {model_name} ({size_mb:.0f} MB)")
+        if self.total_size_mb > self.memory_budget_mb:
+            logger.warning(f"常驻模型已超出内存预算: {self.total_size_mb:.0f}/{self.memory_budget_mb:.0f} MB")
+        return evicted
+
+    @property
+    def total_size_mb(self) -> float:
+        return sum(self._sizes_mb.values())
+
+    def loaded_models(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def get_stats(self) -> Dict:
+        """池占用情况：已加载模型（按最近使用排序）、内存占用与加载/淘汰计数"""
+        with self._lock:
+            return {
+                'memory_budget_mb': self.memory_budget_mb,
+                'memory_used_mb': round(self.total_size_mb, 1),
+                'models': [
+                    {
+                        'model_name': model_name,
+                        'size_mb': round(self._sizes_mb[model_name], 1),
+                        'pinned': model_name in self.pinned_models,
+                        'last_used': self._last_used.get(model_name)
+                    }
+                    for model_name in reversed(self._models)
+                ],
+                'loading': list(self._loading),
+                'allowed_models': sorted(self.allowed_models),
+                **self._stats
+            }
+
+# 全局单例实例
+_pool_instance = None
+_pool_lock = threading.Lock()
+
+def get_model_pool() -> TaggerModelPool:
+    """获取多模型标注池实例（单例模式）"""
+    global _pool_instance
+    if _pool_instance is None:
+        with _pool_lock:
+            if _pool_instance is None:
+                _pool_instance = TaggerModelPool(
+                    memory_budget_mb=config.TAGGER_POOL_MEMORY_MB,
+                    allowed_models=config.TAGGER_MODELS,
+                    pinned_models=[config.WD_MODEL_NAME]
+                )
+    return _pool_instance
@@ -0,0 +1,136 @@
+"""本地模型仓库 - 导出一次后离线加载WD Tagger的权重（safetensors）与预处理好的标签词表"""
+import csv
+import json
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import logging
+
+from ..utils.config import config
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+
+WEIGHTS_FILE = "model.safetensors"
+MODEL_CONFIG_FILE = "config.json"
+VOCABULARY_FILE = "vocabulary.npz"
+MANIFEST_FILE = "manifest.json"
+
+Vocabulary = Tuple[List[str], np.ndarray, np.ndarray]  # 标签名, 类别, 出现次数
+
+def read_tags_csv(csv_path: Path) -> Vocabulary:
+    """解析 selected_tags.csv（name / category / count 列）"""
+    names, categories, counts = [], [], []
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            names.append(row['name'])
+            categories.append(int(row['category']))
+            counts.append(int(row.get('count') or 0))
+    return names, np.asarray(categories, dtype=np.int16), np.asarray(counts, dtype=np.int64)
+
+def download_vocabulary(model_name: str) -> Vocabulary:
+    """从 Hugging Face Hub 下载并解析标签文件"""
+    from huggingface_hub import hf_hub_download
+    return read_tags_csv(Path(hf_hub_download(repo_id=model_name, filename="selected_tags.csv")))
+
+class LocalModelStore:
+    """单个模型在本地仓库中的目录：MODEL_STORE_DIR/<组织>--<模型名>/
+
+    - model.safetensors: 权重，加载时内存映射，无需反序列化pickle
+    - config.json: timm 模型配置（架构名、类别数），离线构建网络结构
+    - vocabulary.npz: 预处理好的标签名/类别/出现次数数组，加载时不需要pandas解析CSV
+    - manifest.json: 导出信息，最后写入，存在即表示导出完整
+    """
+
+    def __init__(self, model_name: str, root: Optional[Path] = None):
+        self.model_name = model_name
+        self.root = Path(root or config.MODEL_STORE_DIR)
+        self.path = self.root / model_name.replace('/', '--')
+
+    def exists(self) -> bool:
+        return (self.path / MANIFEST_FILE).exists()
+
+    def read_manifest(self) -> Dict:
+        with open(self.path / MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def read_model_config(self) -> Dict:
+        with open(self.path / MODEL_CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def create_model(self):
+        """按保存的配置构建未加载权重的网络结构（不访问网络）"""
+        import timm
+        model_config = self.read_model_config()
+        return timm.create_model(
+            model_config['architecture'],
+            pretrained=False,
+            num_classes=model_config['num_classes'],
+            **model_config.get('model_args', {})
+        )
+
+    def load_model(self, device: str = "cpu"):
+        """构建网络并从 safetensors 载入权重"""
+        from safetensors.torch import load_model
+        start = time.perf_counter()
+        model = self.create_model()
+        load_model(model, str(self.path / WEIGHTS_FILE), device=device)
+        logger.info(f"已从本地模型仓库加载权重: {self.path} ({time.perf_counter() - start:.1f} 秒)")
+        return model.eval().to(device)
+
+    def load_vocabulary(self) -> Vocabulary:
+        with np.load(self.path / VOCABULARY_FILE) as data:
+            return data['names'].tolist(), data['categories'], data['counts']
+
+    def export(self, overwrite: bool = False) -> Dict:
+        """从 Hugging Face Hub 下载模型并写入本地仓库（需要联网，只需执行一次）"""
+        import timm
+        from huggingface_hub import hf_hub_download
+        from safetensors.torch import save_model
+
+        if self.exists() and not overwrite:
+            raise FileExistsError(f"本地模型仓库已存在: {self.path}")
+
+        # 先写到临时目录，完成后再替换，避免中断时留下不完整的仓库
+        staging = self.path.with_name(self.path.name + ".partial")
+        if staging.exists():
+            shutil.rmtree(staging)
+        staging.mkdir(parents=True)
+
+        shutil.copyfile(hf_hub_download(repo_id=self.model_name, filename=MODEL_CONFIG_FILE),
+                        staging / MODEL_CONFIG_FILE)
+        names, categories, counts = download_vocabulary(self.model_name)
+        np.savez(staging / VOCABULARY_FILE, names=np.asarray(names), categories=categories, counts=counts)
+
+        model = timm.create_model(f'hf-hub:{self.model_name}', pretrained=True).eval()
+        save_model(model, str(staging / WEIGHTS_FILE))
+
+        manifest = {
+            'format_version': STORE_FORMAT_VERSION,
+            'model_name': self.model_name,
+            'num_tags': len(names),
+            'weights_mb': round((staging / WEIGHTS_FILE).stat().st_size / 1024 / 1024, 1),
+            'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        with open(staging / MANIFEST_FILE, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        staging.rename(self.path)
+        logger.info(f"已导出到本地模型仓库: {self.path}")
+        return manifest
+
+def get_model_store(model_name: str) -> Optional[LocalModelStore]:
+    """返回已导出的本地模型仓库；不存在时在离线模式下报错，否则返回None（回退到Hub）"""
+    store = LocalModelStore(model_name)
+    if store.exists():
+        return store
+    if config.TAGGER_OFFLINE:
+        raise FileNotFoundError(
+            f"离线模式下本地模型仓库不存在: {store.path}（先在联网环境运行 export_model_store.py 导出）"
+        )
+    return None
@@ -0,0 +1,102 @@
+"""模型预热服务 - 服务启动后在后台线程加载WD Tagger，并提供就绪状态"""
+import threading
+import time
+from typing import Dict, Optional
+import logging
+
+from ..utils.config import config
+
+logger = logging.getLogger(__name__)
+
+class ModelWarmup:
+    """WD Tagger 的加载状态机：pending -> loading -> ready / failed
+
+    torch/timm 等重量级依赖只在加载时导入，API模块导入时不再触发模型加载，
+    uvicorn 可以立即监听端口。后台加载与请求触发的加载共用同一把锁，只会加载一次。
+    """
+
+    def __init__(self):
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_background(self):
+        """在后台线程中开始加载（重复调用无效果）"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._load_safely, name="model-warmup", daemon=True)
+            self._thread.start()
+
+    def check_ready(self) -> bool:
+        """不阻塞的就绪检查：已就绪返回True，否则在后台开始（或重新开始）加载并返回False
+
+        上一次加载失败时抛出 RuntimeError（只报告一次，之后的调用会在后台重新加载）。
+        """
+        if self.is_ready:
+            return True
+        if self.state == "failed" and self._thread is not None and not self._thread.is_alive():
+            self._thread = None
+            raise RuntimeError(self.error)
+        self.start_background()
+        return False
+
+    def _load_safely(self):
+        try:
+            self.ensure_loaded()
+        except Exception:
+            pass  # 错误已记录在 self.error 中
+
+    def ensure_loaded(self):
+        """阻塞直到模型加载完成；加载失败时抛出异常，之后的调用会重新尝试"""
+        if self.state == "ready":
+            return
+        with self._lock:
+            if self.state == "ready":
+                return
+            self.state = "loading"
+            self.error = None
+            self.started_at = time.time()
+            try:
+                from .wd_tagger import get_wd_tagger
+                tagger = get_wd_tagger()
+                if config.TAGGER_AUTOTUNE:
+                    tagger.resolve_batch_size()
+                self.state = "ready"
+                self.finished_at = time.time()
+                logger.info(f"WD Tagger 已就绪，加载耗时 {self.finished_at - self.started_at:.1f} 秒")
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                self.finished_at = time.time()
+                logger.error(f"WD Tagger 加载失败: {e}")
+                raise
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def is_loading(self) -> bool:
+        return self.state == "loading"
+
+    def get_status(self) -> Dict:
+        load_seconds = None
+        if self.started_at is not None:
+            load_seconds = round((self.finished_at or time.time()) - self.started_at, 1)
+        return {
+            'state': self.state,
+            'error': self.error,
+            'load_seconds': load_seconds
+        }
+
+# 全局单例实例
+_warmup_instance = None
+
+def get_model_warmup() -> ModelWarmup:
+    """获取模型预热服务实例（单例模式）"""
+    global _warmup_instance
+    if _warmup_instance is None:
+        _warmup_instance = ModelWarmup()
+    return _warmup_instance
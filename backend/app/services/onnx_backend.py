@@ -0,0 +1,72 @@
+"""ONNX Runtime CPU推理后端 - 从本地 .onnx 文件加载WD Tagger"""
+import numpy as np
+from pathlib import Path
+from typing import Dict
+import logging
+
+logger = logging.getLogger(__name__)
+
+GRAPH_OPTIMIZATION_LEVELS = ('disable', 'basic', 'extended', 'all')
+
+class OnnxTaggerBackend:
+    """WD Tagger 的 ONNX Runtime 推理后端
+
+    期望由 export_onnx.py 导出的模型：输入为与torch后端相同预处理后的
+    (N, 3, 448, 448) float32 张量；输出名为 logits 时自动做sigmoid，否则视为概率。
+    """
+
+    def __init__(self, model_path: str,
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 graph_optimization: str = 'all'):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("ONNX后端需要安装 onnxruntime: pip install onnxruntime") from e
+
+        if not Path(model_path).exists():
+            raise FileNotFoundError(f"ONNX模型文件不存在: {model_path}（可先运行 export_onnx.py 导出）")
+        if graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"未知的图优化级别: {graph_optimization}，可选: {GRAPH_OPTIMIZATION_LEVELS}")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads  # 0 表示由ONNX Runtime决定
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = {
+            'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        }[graph_optimization]
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.model_path = str(model_path)
+        self.graph_optimization = graph_optimization
+        self.session = ort.InferenceSession(self.model_path, sess_options=options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        output = self.session.get_outputs()[0]
+        self.output_name = output.name
+        self.outputs_logits = output.name == 'logits'
+
+        logger.info(f"已加载ONNX模型: {self.model_path} "
+                    f"(intra={intra_op_threads}, inter={inter_op_threads}, 优化={graph_optimization})")
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """推理一个批次，返回 (N, num_tags) 概率矩阵"""
+        outputs = self.session.run([self.output_name],
+                                   {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+        if self.outputs_logits:
+            outputs = 1.0 / (1.0 + np.exp(-outputs))
+        return outputs
+
+    def get_info(self) -> Dict:
+        """后端信息"""
+        options = self.session.get_session_options()
+        return {
+            'onnx_model_path': self.model_path,
+            'intra_op_threads': options.intra_op_num_threads,
+            'inter_op_threads': options.inter_op_num_threads,
+            'graph_optimization': self.graph_optimization
+        }
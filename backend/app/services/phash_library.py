@@ -0,0 +1,251 @@
+"""跨视频感知哈希库 - 持久化的帧指纹索引，用于跳过各集重复出现的片头/片尾/回顾镜头"""
+import cv2
+import numpy as np
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Dict, Optional, Any, Sequence, Tuple
+import logging
+
+from ..utils.config import config
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+def compute_phash(image: np.ndarray) -> int:
+    """计算64位DCT感知哈希"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8].ravel()
+    # 跳过直流分量计算中位数，避免整体亮度主导结果
+    bits = low_freq > np.median(low_freq[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(a: int, b: int) -> int:
+    """两个哈希之间的汉明距离"""
+    return bin(a ^ b).count('1')
+
+def _to_signed(value: int) -> int:
+    """SQLite INTEGER为有符号64位，存储前转换"""
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+def source_video_key(video_path: str) -> str:
+    """哈希条目记录的来源视频（绝对路径）"""
+    return str(Path(video_path).resolve())
+
+class PerceptualHashLibrary:
+    """基于SQLite的感知哈希库
+
+    哈希被切分为 radius + 1 个分段(band)分别建索引：根据抽屉原理，
+    汉明距离不超过radius的两个哈希至少有一个分段完全相同，
+    因此只需按分段精确查找候选，再计算完整汉明距离。
+    每个条目记录来源视频，查找时可排除同一视频的条目（重新处理同一视频不会被自身跳过）。
+    """
+
+    def __init__(self, db_path: str, radius: int = 6):
+        if not 0 <= radius < HASH_BITS // 2:
+            raise ValueError(f"汉明半径超出范围: {radius}")
+
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.radius = radius
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._init_schema()
+
+        # 分段数量与建库时不一致时需要重建分段索引
+        stored_bands = self._get_meta('num_bands')
+        if stored_bands is None:
+            self._set_meta('num_bands', str(self.num_bands))
+            self._conn.commit()
+        elif int(stored_bands) != self.num_bands:
+            logger.info(f"哈希库分段数 {stored_bands} 与半径 {radius} 不匹配，重建分段索引")
+            self._rebuild_bands()
+
+    @property
+    def num_bands(self) -> int:
+        return self.radius + 1
+
+    def _init_schema(self):
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS hashes (
+                id INTEGER PRIMARY KEY,
+                hash INTEGER NOT NULL,
+                source TEXT,
+                video TEXT,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                band INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                hash_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_bands ON bands (band, value);
+        """)
+        # 旧版本建的库没有来源视频列
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(hashes)")]
+        if 'video' not in columns:
+            self._conn.execute("ALTER TABLE hashes ADD COLUMN video TEXT")
+        self._conn.commit()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _band_values(self, phash: int) -> List[int]:
+        """把64位哈希尽量均匀地切分为 num_bands 段
+
+        radius=0 时只有一个64位分段，转换为有符号值才能存入SQLite（较窄的分段不受影响）。
+        """
+        values = []
+        offset = 0
+        for band in range(self.num_bands):
+            width = HASH_BITS // self.num_bands + (1 if band < HASH_BITS % self.num_bands else 0)
+            values.append(_to_signed((phash >> offset) & ((1 << width) - 1)))
+            offset += width
+        return values
+
+    def find_match(self, phash: int, exclude_video: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """查找汉明距离不超过radius的最近条目（可排除来自 exclude_video 的条目），未找到返回None"""
+        bands = self._band_values(phash)
+        clause = " OR ".join(["(b.band = ? AND b.value = ?)"] * len(bands))
+        params = [item for band, value in enumerate(bands) for item in (band, value)]
+        query = (f"SELECT DISTINCT h.id, h.hash, h.source FROM bands b "
+                 f"JOIN hashes h ON h.id = b.hash_id WHERE ({clause})")
+        if exclude_video is not None:
+            query += " AND (h.video IS NULL OR h.video != ?)"
+            params.append(exclude_video)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        best = None
+        for hash_id, stored_hash, source in rows:
+            distance = hamming_distance(phash, _to_unsigned(stored_hash))
+            if distance <= self.radius and (best is None or distance < best['distance']):
+                best = {'id': hash_id, 'distance': distance, 'source': source}
+        return best
+
+    def _insert(self, phash: int, source: str, video: Optional[str]) -> int:
+        """插入一个哈希及其分段（调用方持有锁）"""
+        cursor = self._conn.execute(
+            "INSERT INTO hashes (hash, source, video, created_at) VALUES (?, ?, ?, ?)",
+            (_to_signed(phash), source, video, time.time())
+        )
+        hash_id = cursor.lastrowid
+        self._conn.executemany(
+            "INSERT INTO bands (band, value, hash_id) VALUES (?, ?, ?)",
+            [(band, value, hash_id) for band, value in enumerate(self._band_values(phash))]
+        )
+        return hash_id
+
+    def add(self, phash: int, source: str = "", video: Optional[str] = None, commit: bool = True) -> int:
+        """增量插入一个哈希，返回条目ID"""
+        with self._lock:
+            hash_id = self._insert(phash, source, video)
+            if commit:
+                self._conn.commit()
+        return hash_id
+
+    def add_many(self, entries: Sequence[Tuple[int, str]], video: Optional[str] = None) -> int:
+        """在一个事务中插入一批 (哈希, 来源) 条目，返回插入数量"""
+        with self._lock:
+            for phash, source in entries:
+                self._insert(phash, source, video)
+            self._conn.commit()
+        return len(entries)
+
+    def flush(self):
+        """提交尚未提交的插入"""
+        with self._lock:
+            self._conn.commit()
+
+    def _rebuild_bands(self):
+        """按当前分段数重建分段索引"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, hash FROM hashes").fetchall()
+            self._conn.execute("DELETE FROM bands")
+            self._conn.executemany(
+                "INSERT INTO bands (band, value, hash_id) VALUES (?, ?, ?)",
+                [(band, value, hash_id)
+                 for hash_id, stored_hash in rows
+                 for band, value in enumerate(self._band_values(_to_unsigned(stored_hash)))]
+            )
+            self._set_meta('num_bands', str(self.num_bands))
+            self._conn.commit()
+
+    def rebuild(self) -> Dict[str, int]:
+        """重建/压缩哈希库：合并半径内的重复条目（保留最早的），重建分段索引并回收空间"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, hash FROM hashes ORDER BY id").fetchall()
+
+        # 内存中的分段索引：(分段, 值) -> 已保留的哈希
+        band_index: Dict[tuple, List[int]] = {}
+        kept_count = 0
+        removed_ids = []
+        for hash_id, stored_hash in rows:
+            phash = _to_unsigned(stored_hash)
+            keys = list(enumerate(self._band_values(phash)))
+            is_duplicate = any(
+                hamming_distance(phash, candidate) <= self.radius
+                for key in keys for candidate in band_index.get(key, ())
+            )
+            if is_duplicate:
+                removed_ids.append(hash_id)
+                continue
+            kept_count += 1
+            for key in keys:
+                band_index.setdefault(key, []).append(phash)
+
+        with self._lock:
+            self._conn.executemany("DELETE FROM hashes WHERE id = ?", [(hash_id,) for hash_id in removed_ids])
+            self._conn.commit()
+        self._rebuild_bands()
+        with self._lock:
+            self._conn.execute("VACUUM")
+
+        logger.info(f"哈希库重建完成: 保留 {kept_count} 条, 合并 {len(removed_ids)} 条重复")
+        return {'kept': kept_count, 'removed': len(removed_ids)}
+
+    def stats(self) -> Dict[str, Any]:
+        """哈希库统计信息"""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        return {
+            'db_path': str(self.db_path),
+            'entries': count,
+            'radius': self.radius,
+            'num_bands': self.num_bands,
+            'file_size': self.db_path.stat().st_size if self.db_path.exists() else 0
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+# 全局单例实例
+_library_instance = None
+
+def get_phash_library() -> PerceptualHashLibrary:
+    """获取跨视频感知哈希库实例（单例模式）"""
+    global _library_instance
+    if _library_instance is None:
+        _library_instance = PerceptualHashLibrary(
+            config.PHASH_LIBRARY_PATH,
+            radius=config.PHASH_LIBRARY_RADIUS
+        )
+    return _library_instance
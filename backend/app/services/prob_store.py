@@ -0,0 +1,96 @@
+"""标注概率矩阵存储 - 按任务持久化完整概率向量，调整阈值时无需重新推理"""
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from pathlib import Path
+from typing import List, Dict, Optional, Sequence, Iterator, Tuple, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROBS_FILENAME = "tag_probs.npy"
+REFERENCE_PROBS_FILENAME = "reference_probs.npy"
+STORE_INFO_FILENAME = "tag_probs.json"
+
+class ProbabilityMatrixWriter:
+    """把每帧的概率向量写入 float16 内存映射矩阵 (num_frames, num_tags)
+
+    行号与任务的帧列表一一对应，推理结果按批次写入，完成后调用 finalize 写入标签词表和帧信息。
+    """
+
+    def __init__(self, output_dir: str, num_rows: int,
+                 tag_names: Sequence[str], categories: Sequence[int],
+                 model_namespace: str = ""):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.tag_names = list(tag_names)
+        self.categories = [int(category) for category in categories]
+        self.model_namespace = model_namespace
+        self.matrix = open_memmap(str(self.output_dir / PROBS_FILENAME), mode='w+',
+                                  dtype=np.float16, shape=(num_rows, len(self.tag_names)))
+
+    def write(self, start: int, probs: np.ndarray):
+        """从第 start 行开始写入一个批次"""
+        self.matrix[start:start + len(probs)] = probs
+
+    def write_rows(self, rows: Sequence[int], probs: np.ndarray):
+        """写入到指定的若干行（用于只标注部分帧的场景）"""
+        self.matrix[np.asarray(rows, dtype=np.int64)] = probs
+
+    def copy_row(self, source: int, target: int):
+        """复制一行概率（场景级标注中传播给同场景帧）"""
+        self.matrix[target] = self.matrix[source]
+
+    def finalize(self, frames: List[Dict[str, Any]],
+                 frame_metadata: Optional[Dict[str, Dict]] = None,
+                 reference_filenames: Optional[List[str]] = None,
+                 reference_probs: Optional[np.ndarray] = None):
+        """刷新矩阵并写入标签词表、帧信息和参考图概率"""
+        self.matrix.flush()
+        if reference_probs is not None and len(reference_probs):
+            np.save(self.output_dir / REFERENCE_PROBS_FILENAME, np.asarray(reference_probs, dtype=np.float16))
+
+        info = {
+            'model': self.model_namespace,
+            'shape': list(self.matrix.shape),
+            'tag_names': self.tag_names,
+            'categories': self.categories,
+            'frames': frames,
+            'frame_metadata': frame_metadata or {},
+            'reference_filenames': reference_filenames or []
+        }
+        with open(self.output_dir / STORE_INFO_FILENAME, 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False, default=str)
+
+        logger.info(f"概率矩阵已保存: {self.output_dir / PROBS_FILENAME} {tuple(self.matrix.shape)}")
+
+class ProbabilityMatrixStore:
+    """只读打开任务目录中的概率矩阵"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = Path(output_dir)
+        info_path = self.output_dir / STORE_INFO_FILENAME
+        if not info_path.exists():
+            raise FileNotFoundError(f"任务目录中没有概率矩阵: {self.output_dir}")
+
+        with open(info_path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        self.model_namespace: str = info['model']
+        self.tag_names: List[str] = info['tag_names']
+        self.categories: List[int] = info['categories']
+        self.frames: List[Dict[str, Any]] = info['frames']
+        self.frame_metadata: Dict[str, Dict] = info['frame_metadata']
+        self.reference_filenames: List[str] = info['reference_filenames']
+
+        self.matrix = np.load(self.output_dir / PROBS_FILENAME, mmap_mode='r')
+        reference_path = self.output_dir / REFERENCE_PROBS_FILENAME
+        self.reference_probs = np.load(reference_path) if reference_path.exists() else None
+
+    @staticmethod
+    def exists(output_dir: str) -> bool:
+        return (Path(output_dir) / STORE_INFO_FILENAME).exists()
+
+    def iter_chunks(self, chunk_size: int = 1024) -> Iterator[Tuple[int, np.ndarray]]:
+        """按块读取 float32 概率，避免一次性把整个矩阵载入内存"""
+        for start in range(0, self.matrix.shape[0], chunk_size):
+            yield start, np.asarray(self.matrix[start:start + chunk_size], dtype=np.float32)
@@ -0,0 +1,155 @@
+"""场景级标注服务 - 每个场景片段只标注代表帧，并把标签传播给同场景的其他帧"""
+import cv2
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional, Any, Callable
+import logging
+
+from ..models.video_models import ExtractedFrame
+from .wd_tagger import WDTaggerService
+from .compact_tags import CompactTagResults
+
+logger = logging.getLogger(__name__)
+
+class SceneGroupTagger:
+    """按场景片段分组标注
+
+    每组选出至多 representatives_per_scene 个代表帧送入WD Tagger，
+    其余帧复制与其像素差异最小的代表帧的标签；若差异超过 verify_threshold，
+    则该帧单独补标，保证镜头内变化较大的帧不会拿到错误的标签。
+    """
+
+    def __init__(self, tagger: WDTaggerService,
+                 representatives_per_scene: int = 1,
+                 verify_threshold: Optional[float] = 0.12,
+                 diff_size: int = 64):
+        self.tagger = tagger
+        self.representatives_per_scene = max(1, representatives_per_scene)
+        self.verify_threshold = verify_threshold
+        self.diff_size = diff_size
+
+    def _thumbnail(self, image_path: str) -> Optional[np.ndarray]:
+        """低分辨率灰度缩略图，用于计算帧间像素差异"""
+        image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if image is None:
+            return None
+        return cv2.resize(image, (self.diff_size, self.diff_size), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    @staticmethod
+    def _pixel_difference(a: Optional[np.ndarray], b: Optional[np.ndarray]) -> float:
+        """平均绝对像素差异（0-1），缩略图缺失时视为完全不同"""
+        if a is None or b is None:
+            return 1.0
+        return float(np.mean(np.abs(a - b)) / 255.0)
+
+    def _group_by_scene(self, frames: List[ExtractedFrame],
+                        frame_metadata: Dict[str, Dict[str, Any]]) -> List[List[int]]:
+        """按场景片段分组，缺少片段信息的帧单独成组"""
+        groups: Dict[Any, List[int]] = {}
+        for i, frame in enumerate(frames):
+            segment = frame_metadata.get(frame.frame_id, {}).get('scene_segment')
+            key = ('segment', segment) if segment is not None else ('frame', i)
+            groups.setdefault(key, []).append(i)
+        return list(groups.values())
+
+    def _tag_indices(self, frames: List[ExtractedFrame], indices: List[int],
+                     general_threshold: float, character_threshold: float,
+                     batch_size: Optional[int], prob_writer=None,
+                     embedding_writer=None) -> CompactTagResults:
+        """对指定帧运行WD Tagger，prob_writer/embedding_writer 按帧下标写入完整概率和池化特征"""
+        if not indices:
+            return CompactTagResults.empty(self.tagger.decoder)
+        probs_callback: Optional[Callable[[int, np.ndarray], None]] = None
+        embeddings_callback: Optional[Callable[[int, np.ndarray], None]] = None
+        if prob_writer is not None:
+            probs_callback = lambda start, probs: prob_writer.write_rows(indices[start:start + len(probs)], probs)
+        if embedding_writer is not None:
+            embeddings_callback = lambda start, embeddings: embedding_writer.write_rows(
+                indices[start:start + len(embeddings)], embeddings)
+        results = self.tagger.batch_tag_images(
+            images=(frames[i].image_path for i in indices),
+            filenames=[Path(frames[i].image_path).name for i in indices],
+            general_threshold=general_threshold,
+            character_threshold=character_threshold,
+            batch_size=batch_size,
+            probs_callback=probs_callback,
+            embeddings_callback=embeddings_callback,
+            compact=True,
+            bypass_cache=True  # 视频帧只标注一次，不经过结果缓存
+        )
+        return results
+
+    def tag_frames(self, frames: List[ExtractedFrame],
+                   frame_metadata: Dict[str, Dict[str, Any]],
+                   general_threshold: float = 0.35,
+                   character_threshold: float = 0.75,
+                   batch_size: Optional[int] = None,
+                   prob_writer=None,
+                   embedding_writer=None) -> Tuple[CompactTagResults, Dict[str, int]]:
+        """标注所有帧，返回与frames顺序一致的紧凑结果和统计信息
+
+        传入 prob_writer / embedding_writer 时，传播帧复制代表帧的概率行和特征行。
+        """
+        groups = self._group_by_scene(frames, frame_metadata)
+        thumbnails: Dict[int, Optional[np.ndarray]] = {}
+
+        # 1. 选择代表帧：质量最高的帧，其后依次选与已选代表差异最大的帧
+        representatives: Dict[int, List[int]] = {}
+        for group_id, members in enumerate(groups):
+            ordered = sorted(members, key=lambda i: frames[i].quality_score, reverse=True)
+            chosen = [ordered[0]]
+            if len(members) > 1:
+                for i in members:
+                    thumbnails[i] = self._thumbnail(frames[i].image_path)
+                while len(chosen) < min(self.representatives_per_scene, len(members)):
+                    candidates = [i for i in members if i not in chosen]
+                    chosen.append(max(candidates, key=lambda i: min(
+                        self._pixel_difference(thumbnails[i], thumbnails[c]) for c in chosen)))
+            representatives[group_id] = chosen
+
+        rep_indices = sorted(i for chosen in representatives.values() for i in chosen)
+        rep_results = self._tag_indices(frames, rep_indices, general_threshold, character_threshold,
+                                        batch_size, prob_writer, embedding_writer)
+
+        # 2. 传播标签给同场景的其他帧，差异过大的帧留待补标
+        propagated: Dict[int, int] = {}
+        verify_indices = []
+        for group_id, members in enumerate(groups):
+            chosen = representatives[group_id]
+            for i in members:
+                if i in chosen:
+                    continue
+                source, difference = min(
+                    ((c, self._pixel_difference(thumbnails.get(i), thumbnails.get(c))) for c in chosen),
+                    key=lambda item: item[1]
+                )
+                if self.verify_threshold is not None and difference > self.verify_threshold:
+                    verify_indices.append(i)
+                else:
+                    propagated[i] = source
+
+        verify_results = self._tag_indices(frames, verify_indices, general_threshold,
+                                           character_threshold, batch_size, prob_writer, embedding_writer)
+        tagged = CompactTagResults.concatenate([rep_results, verify_results], self.tagger.decoder)
+        # 帧下标 -> 已标注结果中的行号，传播帧指向其代表帧的行
+        row_of = {i: row for row, i in enumerate(rep_indices + verify_indices)}
+        for i, source in propagated.items():
+            if prob_writer is not None:
+                prob_writer.copy_row(source, i)
+            if embedding_writer is not None:
+                embedding_writer.copy_row(source, i)
+            row_of[i] = row_of[source]
+            frame_metadata.setdefault(frames[i].frame_id, {})['tag_source'] = frames[source].frame_id
+
+        stats = {
+            'scenes': len(groups),
+            'tagged_frames': len(rep_indices) + len(verify_indices),
+            'propagated_frames': len(propagated),
+            'verified_frames': len(verify_indices)
+        }
+        logger.info(f"场景级标注: {stats['scenes']} 个场景, 实际标注 {stats['tagged_frames']} 帧, "
+                    f"传播 {stats['propagated_frames']} 帧, 补标 {stats['verified_frames']} 帧")
+
+        results = tagged.take([row_of[i] for i in range(len(frames))],
+                              filenames=[Path(frame.image_path).name for frame in frames])
+        return results, stats
@@ -0,0 +1,400 @@
+"""多进程CPU分片推理 - 多个固定线程数的模型副本并行标注，批次按空闲程度分发"""
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from itertools import count, islice
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional, Callable, Iterable, Iterator, Union, Any, Set
+from PIL import Image
+import numpy as np
+import logging
+
+from ..models.tag_models import ImageTagResult
+from ..utils.config import config
+from .tag_decoder import TagDecoder
+from .compact_tags import CompactTagResults
+
+logger = logging.getLogger(__name__)
+
+WORKER_CHECK_INTERVAL = 5.0  # 检查工作进程存活的间隔（秒）
+
+def _shard_worker(worker_id: int, model_name: str, backend: str, precision: str, num_threads: int,
+                  task_queue: "mp.Queue", result_queue: "mp.Queue", current: Any):
+    """工作进程：加载一份模型副本，循环处理批次直到收到None
+
+    开始处理批次前把 (任务ID, 批次序号) 写入共享数组 current 中本进程的位置，
+    进程被强制结束时主进程据此找到丢失的批次（写共享内存是同步的，不会像队列消息那样丢失）。
+    """
+    import torch
+    torch.set_num_threads(num_threads)
+    config.ONNX_INTRA_OP_THREADS = num_threads
+    from .wd_tagger import WDTaggerService
+
+    try:
+        tagger = WDTaggerService(model_name=model_name, device="cpu", backend=backend, precision=precision,
+                                 sidecar=False)
+    except Exception as e:
+        result_queue.put(('error', None, (worker_id, f"{type(e).__name__}: {e}")))
+        return
+    result_queue.put(('ready', None, (worker_id, tagger.tag_names, tagger.tag_categories, tagger.cache_namespace)))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, batch_index, items, skip_errors, bypass_cache = task
+        current[2 * worker_id], current[2 * worker_id + 1] = task_id, batch_index
+        try:
+            result_queue.put(('result', task_id,
+                              (batch_index, _predict_items(tagger, items, skip_errors, bypass_cache))))
+        except Exception as e:
+            result_queue.put(('failed', task_id, (batch_index, f"{type(e).__name__}: {e}")))
+
+def _predict_items(tagger, items: List[Any], skip_errors: bool,
+                   bypass_cache: bool = False) -> Tuple[np.ndarray, Dict[int, str]]:
+    """推理一个批次，返回 (概率矩阵, {下标: 错误信息})；skip_errors 时无法读取的图片只记录错误，对应行为NaN"""
+    errors: Optional[Dict[int, Exception]] = {} if skip_errors else None
+    images: Dict[int, Image.Image] = {}
+    for i, item in enumerate(items):
+        try:
+            images[i] = item if isinstance(item, Image.Image) else Image.open(item)
+        except Exception as e:
+            if errors is None:
+                raise
+            errors[i] = e
+    indices = sorted(images)
+    probs = np.full((len(items), len(tagger.tag_names)), np.nan, dtype=np.float32)
+    if indices:
+        image_errors = {} if skip_errors else None
+        probs[indices] = tagger.predict_images([images[i] for i in indices], errors=image_errors,
+                                               bypass_cache=bypass_cache)
+        for j, e in (image_errors or {}).items():
+            errors[indices[j]] = e
+    return probs, {i: f"{type(e).__name__}: {e}" for i, e in (errors or {}).items()}
+
+class ShardedTaggerPool:
+    """常驻的多进程标注池
+
+    每个工作进程持有一份模型副本并固定 torch 线程数；所有进程从同一个任务队列取批次，
+    先空闲的进程先取，实现负载均衡。结果按批次序号重排，输出顺序与输入一致。
+    工作进程在多个任务之间复用，模型只加载一次。
+    工作进程意外退出（如被OOM killer结束）时自动重启，只有它正在处理的批次失败；
+    重启后加载模型失败的进程不再重启，所有进程都不可用时 get_sharded_tagger() 会重建标注池。
+    """
+
+    def __init__(self, num_workers: int, threads_per_worker: int = 0,
+                 model_name: str = None, backend: str = None, precision: str = None):
+        self.num_workers = max(1, num_workers)
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.model_name = model_name or config.WD_MODEL_NAME
+        self.backend = backend or config.TAGGER_BACKEND
+        self.precision = precision or config.TAGGER_PRECISION
+
+        self._ctx = mp.get_context("spawn")
+        self._task_queue = self._ctx.Queue()
+        self._result_queue = self._ctx.Queue()
+        self._current = self._ctx.Array('q', [-1] * (2 * self.num_workers), lock=False)
+        logger.info(f"正在启动 {self.num_workers} 个标注进程 (每个 {self.threads_per_worker} 线程)")
+        self._workers = [self._spawn(i) for i in range(self.num_workers)]
+
+        vocab = self._wait_ready()
+        self.tag_names, self.tag_categories, self.cache_namespace = vocab
+        self.decoder = TagDecoder(self.tag_names, self.tag_categories)
+
+        # 结果路由线程：按任务ID把工作进程的结果分发给对应的调用方，并重启意外退出的工作进程
+        self._task_results: Dict[int, "queue.Queue"] = {}
+        self._task_ids = count()
+        self._outstanding: Set[Tuple[int, int]] = set()  # 已提交、尚未返回结果的 (任务ID, 批次序号)
+        self._failed_slots: Set[int] = set()  # 重启后加载模型失败的工作进程，不再重启
+        self._restarts = 0
+        self._closed = False
+        self._registry_lock = threading.Lock()
+        self._router = threading.Thread(target=self._route_results, name="tagger-shard-router", daemon=True)
+        self._router.start()
+
+    def _spawn(self, worker_id: int) -> mp.Process:
+        worker = self._ctx.Process(
+            target=_shard_worker,
+            args=(worker_id, self.model_name, self.backend, self.precision, self.threads_per_worker,
+                  self._task_queue, self._result_queue, self._current),
+            name=f"tagger-shard-{worker_id}",
+            daemon=True
+        )
+        worker.start()
+        return worker
+
+    def _wait_ready(self) -> Tuple[List[str], List[int], str]:
+        """等待所有工作进程加载完模型"""
+        ready = 0
+        vocab = None
+        while ready < self.num_workers:
+            try:
+                kind, _, payload = self._result_queue.get(timeout=5)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if kind == 'error':
+                self.shutdown()
+                raise RuntimeError(f"标注进程 {payload[0]} 加载模型失败: {payload[1]}")
+            ready += 1
+            vocab = payload[1:]
+        logger.info(f"{self.num_workers} 个标注进程已就绪")
+        return vocab
+
+    def _check_workers(self):
+        """启动阶段：任一工作进程退出即失败"""
+        dead = [worker.name for worker in self._workers if not worker.is_alive()]
+        if dead:
+            raise RuntimeError(f"标注进程意外退出: {', '.join(dead)}")
+
+    @property
+    def is_healthy(self) -> bool:
+        """是否还有可用（或可以重启）的工作进程"""
+        return not self._closed and len(self._failed_slots) < self.num_workers
+
+    def _route_results(self):
+        last_check = time.monotonic()
+        while not self._closed:
+            try:
+                self._route(*self._result_queue.get(timeout=WORKER_CHECK_INTERVAL))
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_check >= WORKER_CHECK_INTERVAL:
+                self._restart_dead_workers()
+                last_check = time.monotonic()
+
+    def _route(self, kind: str, task_id: Optional[int], payload: Any):
+        if kind == 'ready':
+            logger.info(f"标注进程 {payload[0]} 已重新就绪")
+            return
+        if kind == 'error':
+            logger.error(f"标注进程 {payload[0]} 重启后加载模型失败，不再重启: {payload[1]}")
+            with self._registry_lock:
+                self._failed_slots.add(payload[0])
+            return
+        with self._registry_lock:
+            self._outstanding.discard((task_id, payload[0]))
+            results = self._task_results.get(task_id)
+        if results is not None:  # 已放弃的任务的结果直接丢弃
+            results.put((kind, payload))
+
+    def _restart_dead_workers(self):
+        """重启意外退出的工作进程，并让它正在处理的批次失败（其余批次不受影响）"""
+        dead = [worker_id for worker_id, worker in enumerate(self._workers)
+                if not worker.is_alive() and worker_id not in self._failed_slots]
+        if not dead or self._closed:
+            return
+        # 先转发队列中已到达的结果：进程可能在返回结果之后才退出
+        while True:
+            try:
+                self._route(*self._result_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        with self._registry_lock:
+            for worker_id in dead:
+                worker = self._workers[worker_id]
+                reason = f"标注进程 {worker.name} 意外退出 (exitcode={worker.exitcode})"
+                lost = (self._current[2 * worker_id], self._current[2 * worker_id + 1])
+                if lost in self._outstanding:
+                    self._outstanding.discard(lost)
+                    results = self._task_results.get(lost[0])
+                    if results is not None:
+                        results.put(('failed', (lost[1], reason)))
+                logger.warning(f"{reason}，正在重新启动")
+                self._current[2 * worker_id] = self._current[2 * worker_id + 1] = -1
+                self._workers[worker_id] = self._spawn(worker_id)
+                self._restarts += 1
+
+    @staticmethod
+    def _to_transferable(item: Union[Image.Image, str, Path]) -> Any:
+        """来自文件的图片只传路径，由工作进程自行解码"""
+        if isinstance(item, Image.Image):
+            filename = getattr(item, 'filename', None)
+            return filename if filename else item
+        return str(item)
+
+    def iter_tag_images(self, images: Iterable[Union[Image.Image, str, Path]],
+                        filenames: Optional[Iterable[str]] = None,
+                        general_threshold: float = 0.35,
+                        character_threshold: float = 0.75,
+                        batch_size: Optional[int] = None,
+                        probs_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                        embeddings_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                        compact: bool = False,
+                        on_error: Optional[Callable[[str, Exception], None]] = None,
+                        bypass_cache: bool = False
+                        ) -> Iterator[Union[List[ImageTagResult], CompactTagResults]]:
+        """与 WDTaggerService.iter_tag_images 相同的流式接口，批次在工作进程间并行推理"""
+        if embeddings_callback is not None:
+            raise ValueError("分片推理模式不支持提取特征")
+
+        batch_size = batch_size or 16  # 各工作进程独立加载模型，这里不做自动调优
+        image_iter = iter(images)
+        filename_iter = iter(filenames) if filenames is not None else None
+        task_results: "queue.Queue" = queue.Queue()
+        with self._registry_lock:
+            task_id = next(self._task_ids)
+            self._task_results[task_id] = task_results
+
+        max_in_flight = self.num_workers * 2  # 限制在途批次数，内存不随图片总数增长
+        batch_filenames: Dict[int, List[str]] = {}
+        finished: Dict[int, Tuple[np.ndarray, Dict[int, str]]] = {}
+        submitted = 0
+        read_count = 0
+        next_index = 0
+        offset = 0
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and submitted - next_index < max_in_flight:
+                    items = list(islice(image_iter, batch_size))
+                    if not items:
+                        exhausted = True
+                        break
+                    if filename_iter is not None:
+                        batch_filenames[submitted] = list(islice(filename_iter, len(items)))
+                    else:
+                        batch_filenames[submitted] = [
+                            f"image_{read_count + j}.jpg" if isinstance(item, Image.Image)
+                            else Path(item).name
+                            for j, item in enumerate(items)
+                        ]
+                    with self._registry_lock:
+                        self._outstanding.add((task_id, submitted))
+                    self._task_queue.put((task_id, submitted, [self._to_transferable(item) for item in items],
+                                          on_error is not None, bypass_cache))
+                    submitted += 1
+                    read_count += len(items)
+
+                if next_index == submitted:
+                    break
+
+                # 等待下一个批次（按序号）完成，乱序到达的结果暂存
+                while next_index not in finished:
+                    try:
+                        kind, (batch_index, payload) = task_results.get(timeout=5)
+                    except queue.Empty:
+                        if not self.is_healthy:
+                            raise RuntimeError("所有标注进程均已退出且无法重启")
+                        continue
+                    if kind == 'failed':
+                        if on_error is None:
+                            raise RuntimeError(f"分片推理批次 {batch_index} 失败: {payload}")
+                        # 跳过模式下整个批次按无法读取处理（如处理该批次的工作进程崩溃），任务继续
+                        count = len(batch_filenames[batch_index])
+                        payload = (np.full((count, len(self.tag_names)), np.nan, dtype=np.float32),
+                                   {i: payload for i in range(count)})
+                    finished[batch_index] = payload
+
+                probs_batch, errors = finished.pop(next_index)
+                names = batch_filenames.pop(next_index)
+                if errors:
+                    for i in sorted(errors):
+                        on_error(names[i], RuntimeError(errors[i]))
+                    keep = [i for i in range(len(names)) if i not in errors]
+                    probs_batch = probs_batch[keep]
+                    names = [names[i] for i in keep]
+                if probs_callback is not None:
+                    probs_callback(offset, probs_batch)
+                decode = self.decoder.decode_compact if compact else self.decoder.decode
+                results = decode(
+                    probs_batch,
+                    filenames=names,
+                    general_threshold=general_threshold,
+                    character_threshold=character_threshold
+                )
+                offset += len(probs_batch)
+                next_index += 1
+                logger.info(f"已处理 {offset} 张图片")
+                yield results
+        finally:
+            with self._registry_lock:
+                self._task_results.pop(task_id, None)
+                self._outstanding = {key for key in self._outstanding if key[0] != task_id}
+
+    def batch_tag_images(self, images: Iterable[Union[Image.Image, str, Path]],
+                         filenames: List[str] = None,
+                         general_threshold: float = 0.35,
+                         character_threshold: float = 0.75,
+                         batch_size: Optional[int] = None,
+                         probs_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                         embeddings_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                         compact: bool = False,
+                         bypass_cache: bool = False) -> Union[List[ImageTagResult], CompactTagResults]:
+        """批量标注图片，返回全部结果（compact 时为拼接后的紧凑结果）"""
+        results = []
+        try:
+            for batch_results in self.iter_tag_images(
+                images, filenames=filenames,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold,
+                batch_size=batch_size,
+                probs_callback=probs_callback,
+                embeddings_callback=embeddings_callback,
+                compact=compact,
+                bypass_cache=bypass_cache
+            ):
+                if compact:
+                    results.append(batch_results)
+                else:
+                    results.extend(batch_results)
+            return CompactTagResults.concatenate(results, self.decoder) if compact else results
+        except Exception as e:
+            logger.error(f"分片批量标注失败: {e}")
+            raise
+
+    @property
+    def embedding_dim(self) -> int:
+        return 0
+
+    def get_info(self) -> Dict:
+        return {
+            'num_workers': self.num_workers,
+            'threads_per_worker': self.threads_per_worker,
+            'alive_workers': sum(1 for worker in self._workers if worker.is_alive()),
+            'restarts': self._restarts,
+            'failed_workers': len(self._failed_slots),
+            'model_name': self.model_name,
+            'backend': self.backend
+        }
+
+    def shutdown(self):
+        """通知工作进程退出并等待结束"""
+        self._closed = True
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+# 全局单例实例
+_pool_instance: Optional[ShardedTaggerPool] = None
+
+def get_sharded_tagger() -> Optional[ShardedTaggerPool]:
+    """获取多进程标注池（单例模式），TAGGER_SHARDS 为0时返回None"""
+    global _pool_instance
+    if config.TAGGER_SHARDS <= 0:
+        return None
+    if _pool_instance is not None and not _pool_instance.is_healthy:
+        logger.warning("多进程标注池已不可用，正在重建")
+        _pool_instance.shutdown()
+        _pool_instance = None
+    if _pool_instance is None:
+        _pool_instance = ShardedTaggerPool(
+            num_workers=config.TAGGER_SHARDS,
+            threads_per_worker=config.TAGGER_SHARD_THREADS
+        )
+    return _pool_instance
+
+def get_bulk_tagger():
+    """批量标注使用的标注器：启用分片时为多进程标注池，否则为单进程WD Tagger"""
+    pool = get_sharded_tagger()
+    if pool is not None:
+        return pool
+    from .wd_tagger import get_wd_tagger
+    return get_wd_tagger()
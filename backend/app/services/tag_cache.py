@@ -0,0 +1,176 @@
+"""标注结果持久化缓存 - 以图片内容哈希 + 模型 + 预处理版本为键缓存完整概率向量"""
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Dict, Optional
+from PIL import Image
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+def image_content_hash(image: Image.Image) -> str:
+    """图片内容哈希：来自文件的图片直接哈希文件字节，否则哈希解码后的像素
+
+    尚未解码的内存图片（如从 BytesIO 打开的上传图片）哈希其编码字节，
+    不调用 tobytes() 触发完整解码，之后的预处理仍可以使用draft模式。
+    """
+    digest = hashlib.sha256()
+    filename = getattr(image, 'filename', None)
+    fp = getattr(image, 'fp', None)
+    if filename and Path(filename).is_file():
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    elif getattr(image, 'tile', None) and fp is not None and hasattr(fp, 'seek'):
+        position = fp.tell()
+        fp.seek(0)
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+        fp.seek(position)
+    else:
+        digest.update(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def array_content_hash(array: np.ndarray) -> str:
+    """像素数组内容哈希（包含形状和数据类型）"""
+    digest = hashlib.sha256()
+    digest.update(f"{array.dtype}:{array.shape}".encode())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+class TagResultCache:
+    """基于SQLite的标注结果缓存（按总字节数限制的LRU）
+
+    缓存的是与阈值无关的完整概率向量（float16），命中后可按任意阈值重新解码。
+    """
+
+    def __init__(self, db_path: str, max_size_mb: float = 2048):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                probs BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_access ON entries (last_access);
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image: Image.Image, namespace: str) -> str:
+        """缓存键：命名空间（模型名/后端/预处理版本）+ 图片内容哈希"""
+        return f"{namespace}|{image_content_hash(image)}"
+
+    @staticmethod
+    def make_array_key(array: np.ndarray, namespace: str) -> str:
+        """像素数组的缓存键"""
+        return f"{namespace}|{array_content_hash(array)}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """批量查询，返回命中的 {键: float32概率向量}，并刷新命中条目的访问时间"""
+        unique_keys = list(dict.fromkeys(keys))
+        if not unique_keys:
+            return {}
+
+        placeholders = ",".join("?" * len(unique_keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, probs FROM entries WHERE key IN ({placeholders})", unique_keys
+            ).fetchall()
+            if rows:
+                now = time.time()
+                self._conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?",
+                                       [(now, key) for key, _ in rows])
+                self._conn.commit()
+            found = {key: np.frombuffer(blob, dtype=np.float16).astype(np.float32) for key, blob in rows}
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        """批量写入概率向量，超出容量时按最久未访问淘汰"""
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for key, probs in items.items():
+            blob = np.asarray(probs, dtype=np.float16).tobytes()
+            rows.append((key, blob, len(blob), now))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, probs, size, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """淘汰最久未访问的条目直到总大小不超过上限（调用方持有锁）"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_size_bytes:
+            oldest = self._conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not oldest:
+                break
+            evict_keys = []
+            for key, size in oldest:
+                if total <= self.max_size_bytes:
+                    break
+                evict_keys.append((key,))
+                total -= size
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", evict_keys)
+            self.evictions += len(evict_keys)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+
+    def get_stats(self) -> Dict:
+        """命中/未命中计数与容量信息"""
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'db_path': str(self.db_path),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': entries,
+                'size_mb': total / 1024 / 1024,
+                'max_size_mb': self.max_size_bytes / 1024 / 1024
+            }
+
+# 全局单例实例
+_cache_instance: Optional[TagResultCache] = None
+
+def get_tag_cache() -> Optional[TagResultCache]:
+    """获取标注结果缓存实例（单例模式），未启用时返回None"""
+    global _cache_instance
+    from ..utils.config import config
+
+    if not config.TAG_CACHE:
+        return None
+    if _cache_instance is None:
+        _cache_instance = TagResultCache(config.TAG_CACHE_PATH, max_size_mb=config.TAG_CACHE_MAX_MB)
+    return _cache_instance
@@ -0,0 +1,151 @@
+"""向量化标签解码引擎 - 把 (B, num_tags) 概率矩阵一次性解码为每张图片的标签结果"""
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+import logging
+
+from ..models.tag_models import ImageTagResult
+from .compact_tags import CompactTagResults
+
+logger = logging.getLogger(__name__)
+
+# selected_tags.csv 中的类别编号
+GENERAL_CATEGORY = 0
+CHARACTER_CATEGORY = 4
+RATING_CATEGORY = 9
+
+RATING_TAGS = ('general', 'sensitive', 'questionable', 'explicit')
+
+# 解码时的标签分组（评级标签和其他类别不参与阈值筛选）
+KIND_OTHER = 0
+KIND_GENERAL = 1
+KIND_CHARACTER = 2
+
+class TagDecoder:
+    """在模型加载时构建一次的标签解码器
+
+    预先计算评级/角色/一般标签的索引数组，解码时对整个批次做NumPy掩码阈值，
+    只在最终组装字典时按图片切片，不存在逐标签的Python判断。
+    """
+
+    def __init__(self, tag_names: Sequence[str], categories: Sequence[int]):
+        self.tag_names = np.asarray(tag_names, dtype=object)
+        categories = np.asarray(categories)
+
+        # 评级标签按名称识别（与类别无关），并从其他类别中排除
+        is_rating = np.isin(self.tag_names, RATING_TAGS)
+        self.rating_indices = np.flatnonzero(is_rating)
+        self.character_indices = np.flatnonzero((categories == CHARACTER_CATEGORY) & ~is_rating)
+        self.general_indices = np.flatnonzero((categories == GENERAL_CATEGORY) & ~is_rating)
+
+        self.rating_names = self.tag_names[self.rating_indices].tolist()
+        self.character_names = self.tag_names[self.character_indices]
+        self.general_names = self.tag_names[self.general_indices]
+
+        # 紧凑结果使用的词表下标：每个下标的分组，以及标签名到下标的索引
+        self.kind = np.full(len(self.tag_names), KIND_OTHER, dtype=np.int8)
+        self.kind[self.general_indices] = KIND_GENERAL
+        self.kind[self.character_indices] = KIND_CHARACTER
+        self.id_dtype = np.int16 if len(self.tag_names) <= np.iinfo(np.int16).max else np.int32
+        self.tag_index: Dict[str, int] = {name: i for i, name in enumerate(self.tag_names.tolist())}
+
+    @property
+    def num_tags(self) -> int:
+        return len(self.tag_names)
+
+    @staticmethod
+    def _split_rows(mask: np.ndarray, values: np.ndarray, names: np.ndarray) -> List[dict]:
+        """把 (B, K) 掩码中通过的标签按行拆分为 {标签名: 置信度} 字典"""
+        rows, cols = np.nonzero(mask)
+        passed_values = values[rows, cols].tolist()
+        passed_names = names[cols].tolist()
+        bounds = np.searchsorted(rows, np.arange(mask.shape[0] + 1)).tolist()
+        return [dict(zip(passed_names[start:end], passed_values[start:end]))
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def decode(self, probs: np.ndarray,
+               filenames: Optional[List[str]] = None,
+               general_threshold: float = 0.35,
+               character_threshold: float = 0.75) -> List[ImageTagResult]:
+        """解码概率矩阵，probs 形状为 (B, num_tags) 或 (num_tags,)"""
+        probs = np.asarray(probs, dtype=np.float32)
+        if probs.ndim == 1:
+            probs = probs[np.newaxis, :]
+        batch_size = probs.shape[0]
+        filenames = filenames or [""] * batch_size
+
+        character_probs = probs[:, self.character_indices]
+        general_probs = probs[:, self.general_indices]
+        character_mask = character_probs > character_threshold
+        general_mask = general_probs > general_threshold
+
+        # 通过阈值的标签平均置信度
+        passed_count = character_mask.sum(axis=1) + general_mask.sum(axis=1)
+        passed_sum = (np.where(character_mask, character_probs, 0).sum(axis=1, dtype=np.float64) +
+                      np.where(general_mask, general_probs, 0).sum(axis=1, dtype=np.float64))
+        confidence_scores = np.divide(passed_sum, passed_count,
+                                      out=np.zeros(batch_size), where=passed_count > 0).tolist()
+
+        character_dicts = self._split_rows(character_mask, character_probs, self.character_names)
+        general_dicts = self._split_rows(general_mask, general_probs, self.general_names)
+        rating_values = probs[:, self.rating_indices].tolist()
+
+        return [
+            ImageTagResult(
+                image_path=filenames[i],
+                character_tags=character_dicts[i],
+                general_tags=general_dicts[i],
+                rating_tags=dict(zip(self.rating_names, rating_values[i])),
+                copyright_tags={},  # 暂时为空
+                artist_tags={},     # 暂时为空
+                confidence_score=confidence_scores[i],
+                processing_time=0.0  # 将在调用时设置
+            )
+            for i in range(batch_size)
+        ]
+
+    def decode_compact(self, probs: np.ndarray,
+                       filenames: Optional[List[str]] = None,
+                       general_threshold: float = 0.35,
+                       character_threshold: float = 0.75) -> CompactTagResults:
+        """解码为紧凑结果：通过阈值的标签只保存词表下标和float16置信度，不构建字典"""
+        probs = np.asarray(probs, dtype=np.float32)
+        if probs.ndim == 1:
+            probs = probs[np.newaxis, :]
+        batch_size = probs.shape[0]
+        filenames = filenames or [""] * batch_size
+
+        thresholds = np.full(probs.shape[1], np.inf, dtype=np.float32)
+        thresholds[self.general_indices] = general_threshold
+        thresholds[self.character_indices] = character_threshold
+        rows, cols = np.nonzero(probs > thresholds)  # 行优先，天然按图片分组
+        values = probs[rows, cols]
+
+        counts = np.bincount(rows, minlength=batch_size)
+        sums = np.bincount(rows, weights=values, minlength=batch_size)
+        offsets = np.zeros(batch_size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return CompactTagResults(
+            self, filenames, offsets,
+            cols.astype(self.id_dtype),
+            values.astype(np.float16),
+            probs[:, self.rating_indices].astype(np.float16),
+            np.divide(sums, counts, out=np.zeros(batch_size), where=counts > 0).astype(np.float32)
+        )
+
+    def to_image_tag_result(self, filename: str, tag_ids: np.ndarray, confidences: np.ndarray,
+                            ratings: Dict[str, float], confidence_score: float) -> ImageTagResult:
+        """把一张图片的紧凑结果按类别拆回字典形式"""
+        names = self.tag_names[tag_ids].tolist()
+        values = confidences.astype(np.float32).tolist()
+        kinds = self.kind[tag_ids].tolist()
+        return ImageTagResult(
+            image_path=filename,
+            character_tags={name: value for name, value, kind in zip(names, values, kinds) if kind == KIND_CHARACTER},
+            general_tags={name: value for name, value, kind in zip(names, values, kinds) if kind == KIND_GENERAL},
+            rating_tags=ratings,
+            copyright_tags={},
+            artist_tags={},
+            confidence_score=confidence_score,
+            processing_time=0.0
+        )
@@ -1,9 +1,12 @@
 """标签直接匹配服务 - 基于WD标签的精确匹配"""
-from typing import List, Dict, Set, Optional, Tuple
+from typing import List, Dict, Set, Optional, Tuple, Sequence
 import logging
 from collections import defaultdict
+import numpy as np
 
 from ..models.tag_models import ImageTagResult, TagMatchRequest, TagMatchResult, TagCategory
+from .compact_tags import CompactTagResults
+from .tag_decoder import KIND_CHARACTER
 
 logger = logging.getLogger(__name__)
 
@@ -146,6 +149,70 @@ class DirectTagMatcher:
         
         return matching_results
     
+    def _compact_hits(self, results: CompactTagResults, tags: List[str],
+                      match_request: TagMatchRequest, character_only: bool = False) -> np.ndarray:
+        """(len(tags), N) 布尔矩阵：每个请求标签在每帧是否达到阈值（角色标签使用角色阈值）"""
+        vocabulary = results.vocabulary
+        hits = np.zeros((len(tags), len(results)), dtype=bool)
+        for k, tag_name in enumerate(tags):
+            tag_id = vocabulary.tag_index.get(tag_name)
+            if tag_id is None:
+                continue
+            is_character = vocabulary.kind[tag_id] == KIND_CHARACTER
+            if character_only and not is_character:
+                continue
+            threshold = (match_request.character_tag_threshold if is_character
+                         else match_request.general_tag_threshold)
+            hits[k] = results.column_confidences(tag_id) >= threshold  # 未通过解码阈值的为NaN，比较结果为False
+        return hits
+    
+    def find_matching_frames_compact(self, frames: Sequence[any], results: CompactTagResults,
+                                     match_request: TagMatchRequest) -> List[Tuple[any, TagMatchResult]]:
+        """在紧凑结果上对所有帧做向量化匹配，规则与得分同 match_single_image
+
+        只为匹配成功的帧构建 TagMatchResult，按得分从高到低排序。
+        """
+        count = min(len(frames), len(results))
+        if count < len(results):
+            results = results.take(range(count))
+        
+        required_hits = self._compact_hits(results, match_request.required_tags, match_request)
+        character_hits = self._compact_hits(results, match_request.character_tags, match_request,
+                                            character_only=True)
+        excluded_hits = self._compact_hits(results, match_request.excluded_tags, match_request)
+        general_rating = results.rating_column('general')
+        sensitive_rating = results.rating_column('sensitive')
+        
+        rating_pass = ((general_rating >= match_request.min_rating_general) &
+                       (sensitive_rating <= match_request.max_rating_sensitive))
+        matched = (required_hits.all(axis=0) & character_hits.all(axis=0) &
+                   ~excluded_hits.any(axis=0) & rating_pass)
+        
+        # 得分：必需标签40%、角色标签30%、排除标签20%、评级10%
+        score = np.zeros(count, dtype=np.float64)
+        score += (required_hits.mean(axis=0) if match_request.required_tags else 1.0) * 0.4
+        score += (character_hits.mean(axis=0) if match_request.character_tags else 1.0) * 0.3
+        score += ((1.0 - excluded_hits.mean(axis=0)) if match_request.excluded_tags else 1.0) * 0.2
+        general_score = np.minimum(general_rating / match_request.min_rating_general, 1.0)
+        sensitive_penalty = np.maximum(0, 1.0 - sensitive_rating / match_request.max_rating_sensitive)
+        score += (general_score + sensitive_penalty) / 2 * 0.1
+        score = np.minimum(score, 1.0)
+        
+        matching_results = []
+        for i in np.flatnonzero(matched)[np.argsort(-score[matched], kind='stable')].tolist():
+            matching_results.append((frames[i], TagMatchResult(
+                matched=True,
+                score=float(score[i]),
+                matched_required_tags=[tag for k, tag in enumerate(match_request.required_tags)
+                                       if required_hits[k, i]],
+                matched_character_tags=[tag for k, tag in enumerate(match_request.character_tags)
+                                        if character_hits[k, i]],
+                excluded_tags_found=[],
+                rating_scores=results.rating_dict(i)
+            )))
+        
+        return matching_results
+    
     def create_reference_match_request(self, reference_tags: List[ImageTagResult],
                                      min_confidence: float = 0.7) -> TagMatchRequest:
         """根据参考图片自动创建匹配请求"""
@@ -259,6 +326,127 @@ class DirectTagMatcher:
             }
         
         return result
+    
+    def analyze_compact_distribution(self, results: CompactTagResults, top_k: int = 20) -> Dict:
+        """在紧凑结果上统计标签分布（出现次数、频率、平均置信度），返回格式同 analyze_tag_distribution"""
+        vocabulary = results.vocabulary
+        total_frames = len(results)
+        counts = np.bincount(results.tag_ids, minlength=len(vocabulary.tag_names))
+        confidence_sums = np.bincount(results.tag_ids, weights=results.confidences.astype(np.float32),
+                                      minlength=len(vocabulary.tag_names))
+        present = np.flatnonzero(counts)
+        avg_confidences = np.zeros(len(counts))
+        avg_confidences[present] = confidence_sums[present] / counts[present]
+        
+        result = {
+            'total_frames': total_frames,
+            'tag_distribution': {},
+            'rating_distribution': {},
+            'most_common_tags': [],
+            'character_tags': [],
+            'general_tags': []
+        }
+        
+        # 按出现次数、再按平均置信度从高到低
+        for tag_id in present[np.lexsort((-avg_confidences[present], -counts[present]))].tolist():
+            category = 'character' if vocabulary.kind[tag_id] == KIND_CHARACTER else 'general'
+            tag_info = {
+                'count': int(counts[tag_id]),
+                'frequency': float(counts[tag_id] / total_frames),
+                'avg_confidence': float(avg_confidences[tag_id]),
+                'category': category
+            }
+            tag_name = vocabulary.tag_names[tag_id]
+            result['tag_distribution'][tag_name] = tag_info
+            result[f'{category}_tags'].append((tag_name, tag_info))
+            if len(result['most_common_tags']) < top_k:
+                result['most_common_tags'].append((tag_name, tag_info))
+        
+        for k, rating_name in enumerate(vocabulary.rating_names):
+            values = results.ratings[:, k].astype(np.float32)
+            if len(values):
+                result['rating_distribution'][rating_name] = {
+                    'avg': float(values.mean()),
+                    'min': float(values.min()),
+                    'max': float(values.max()),
+                    'count': len(values)
+                }
+        
+        return result
+    
+    @staticmethod
+    def _frame_tag_matrix(results: CompactTagResults):
+        """紧凑结果 -> 稀疏 帧×标签 0/1 矩阵（直接复用CSR的下标数组）"""
+        from scipy import sparse
+        return sparse.csr_matrix(
+            (np.ones(len(results.tag_ids), dtype=np.int32), results.tag_ids.astype(np.int32), results.offsets),
+            shape=(len(results), len(results.vocabulary.tag_names))
+        )
+    
+    def analyze_tag_cooccurrence(self, results: CompactTagResults, query_tags: Sequence[str],
+                                 top_k: int = 20, min_count: int = 2,
+                                 sort_by: str = 'lift') -> Dict:
+        """统计与查询标签共同出现的标签
+        
+        共现次数由一次稀疏矩阵乘积 X^T · X[:, 查询标签] 得到（X 为帧×标签 0/1 矩阵），
+        在此基础上计算条件概率 P(标签|查询标签)、提升度 lift、PMI 与归一化PMI。
+        min_count 过滤共现次数过少的标签（少见标签的 lift 不可靠），sort_by 可选 count/lift/npmi。
+        """
+        if sort_by not in ('count', 'lift', 'npmi'):
+            raise ValueError(f"不支持的排序方式: {sort_by}，可选: count, lift, npmi")
+        vocabulary = results.vocabulary
+        missing = [tag for tag in query_tags if tag not in vocabulary.tag_index]
+        if missing:
+            raise ValueError(f"词表中没有这些标签: {missing}")
+        query_ids = [vocabulary.tag_index[tag] for tag in query_tags]
+        
+        total_frames = len(results)
+        frame_tags = self._frame_tag_matrix(results)
+        tag_counts = np.bincount(results.tag_ids, minlength=frame_tags.shape[1])
+        # (num_tags, Q)，查询标签数很少，结果可以是稠密的
+        cooccurrence = (frame_tags.T @ frame_tags[:, query_ids]).toarray()
+        
+        result = {
+            'total_frames': total_frames,
+            'sort_by': sort_by,
+            'queries': []
+        }
+        for k, (query_tag, query_id) in enumerate(zip(query_tags, query_ids)):
+            query_count = int(tag_counts[query_id])
+            query_info = {
+                'tag': query_tag,
+                'frame_count': query_count,
+                'frequency': query_count / total_frames if total_frames else 0.0,
+                'associations': []
+            }
+            result['queries'].append(query_info)
+            if not query_count:
+                continue
+            
+            candidates = np.flatnonzero(cooccurrence[:, k] >= max(min_count, 1))
+            candidates = candidates[candidates != query_id]
+            joint = cooccurrence[candidates, k].astype(np.float64)
+            lift = joint * total_frames / (query_count * tag_counts[candidates])
+            pmi = np.log2(lift)
+            # 归一化PMI: pmi / -log2 P(x,y)，所有帧都同时出现时为1
+            joint_information = -np.log2(joint / total_frames)
+            npmi = np.divide(pmi, joint_information, out=np.ones_like(pmi), where=joint_information > 0)
+            
+            key = {'count': joint, 'lift': lift, 'npmi': npmi}[sort_by]
+            for i in np.lexsort((-joint, -key))[:top_k].tolist():
+                tag_id = int(candidates[i])
+                query_info['associations'].append({
+                    'tag': vocabulary.tag_names[tag_id],
+                    'category': 'character' if vocabulary.kind[tag_id] == KIND_CHARACTER else 'general',
+                    'cooccurrence': int(joint[i]),
+                    'tag_frame_count': int(tag_counts[tag_id]),
+                    'conditional_probability': float(joint[i] / query_count),
+                    'lift': float(lift[i]),
+                    'pmi': float(pmi[i]),
+                    'npmi': float(npmi[i])
+                })
+        
+        return result
 
 # 全局单例实例
 _matcher_instance = None
@@ -0,0 +1,93 @@
+"""标签词表索引 - 按名称排序的词表，支持前缀补全、类别过滤和按标签频次排序"""
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+# selected_tags.csv 中的类别编号与名称
+CATEGORY_NAMES = {
+    0: 'general',
+    1: 'artist',
+    3: 'copyright',
+    4: 'character',
+    5: 'meta',
+    9: 'rating'
+}
+CATEGORY_CODES = {name: code for code, name in CATEGORY_NAMES.items()}
+
+def normalize_tag_query(text: str) -> str:
+    """用户输入转为词表中的写法：小写，空格替换为下划线"""
+    return text.strip().lower().replace(' ', '_')
+
+class TagVocabularyIndex:
+    """在模型加载时构建一次的词表索引
+
+    标签名（小写）排序后保存为列表，前缀查询用 bisect 定位连续区间，
+    区间内的类别过滤和按频次取前 limit 个在NumPy数组上完成，不遍历整个词表。
+    """
+
+    def __init__(self, tag_names: Sequence[str], categories: Sequence[int],
+                 counts: Optional[Sequence[int]] = None):
+        self.tag_names = np.asarray(tag_names, dtype=object)
+        self.categories = np.asarray(categories, dtype=np.int16)
+        self.counts = (np.asarray(counts, dtype=np.int64) if counts is not None
+                       else np.zeros(len(self.tag_names), dtype=np.int64))
+
+        keys = [name.lower() for name in self.tag_names.tolist()]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._keys = [keys[i] for i in order]
+        self._ids = np.asarray(order, dtype=np.int64)
+        self._sorted_categories = self.categories[self._ids]
+        self._sorted_counts = self.counts[self._ids]
+        self._tag_index: Dict[str, int] = {key: i for i, key in enumerate(keys)}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def category_code(category: str) -> int:
+        """类别名转为编号，未知类别抛出 ValueError"""
+        if category not in CATEGORY_CODES:
+            raise ValueError(f"未知的标签类别: {category}，可选: {list(CATEGORY_CODES)}")
+        return CATEGORY_CODES[category]
+
+    def describe(self, tag_id: int) -> Dict:
+        category = int(self.categories[tag_id])
+        return {
+            'name': self.tag_names[tag_id],
+            'category': CATEGORY_NAMES.get(category, str(category)),
+            'count': int(self.counts[tag_id])
+        }
+
+    def lookup(self, name: str) -> Optional[Dict]:
+        """精确查找标签，不存在时返回None"""
+        tag_id = self._tag_index.get(normalize_tag_query(name))
+        return self.describe(tag_id) if tag_id is not None else None
+
+    def search(self, prefix: str = "", category: Optional[str] = None,
+               limit: int = 20) -> Tuple[int, List[Dict]]:
+        """前缀补全，返回 (匹配总数, 按频次从高到低的前 limit 个标签)"""
+        key = normalize_tag_query(prefix)
+        start = bisect_left(self._keys, key)
+        end = bisect_left(self._keys, key + '\U0010ffff') if key else len(self._keys)
+
+        positions = np.arange(start, end)
+        if category is not None:
+            positions = positions[self._sorted_categories[start:end] == self.category_code(category)]
+        total = len(positions)
+
+        counts = self._sorted_counts[positions]
+        if total > limit:
+            top = np.argpartition(-counts, limit - 1)[:limit]
+            positions, counts = positions[top], counts[top]
+        # 频次相同按名称排序（positions 本身即名称顺序）
+        positions = positions[np.lexsort((positions, -counts))]
+        return total, [self.describe(tag_id) for tag_id in self._ids[positions].tolist()]
+
+    def get_stats(self) -> Dict:
+        """各类别的标签数"""
+        codes, numbers = np.unique(self.categories, return_counts=True)
+        return {
+            'num_tags': len(self),
+            'categories': {CATEGORY_NAMES.get(int(code), str(int(code))): int(number)
+                           for code, number in zip(codes, numbers)}
+        }
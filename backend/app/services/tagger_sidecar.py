@@ -0,0 +1,277 @@
+"""进程外推理 - WD Tagger 在独立的本地进程中运行，通过Unix套接字通信、共享内存传递张量"""
+import multiprocessing as mp
+import os
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _serve_connection(conn, tagger, inference_lock: threading.Lock):
+    """处理一个客户端连接上的请求，直到连接关闭"""
+    import torch
+    segments: Dict[str, SharedMemory] = {}
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            kind, args = message[0], message[1:]
+            try:
+                if kind == 'predict':
+                    shm_name, shape, with_embeddings = args
+                    if shm_name not in segments:
+                        # 客户端扩容时换了新的共享内存块，旧块不再使用
+                        for segment in segments.values():
+                            segment.close()
+                        segments = {shm_name: SharedMemory(name=shm_name)}
+                    buffer = segments[shm_name].buf
+                    batch = torch.from_numpy(np.ndarray(shape, dtype=np.float32, buffer=buffer))
+                    with inference_lock:
+                        if with_embeddings:
+                            probs, embeddings = tagger.predict_with_embeddings(batch)
+                        else:
+                            probs, embeddings = tagger.predict_probs(batch), None
+                    del batch
+                    # 输入已用完，结果写回同一块共享内存（结果远小于输入）
+                    offset = 0
+                    shapes = []
+                    for output in (probs, embeddings):
+                        if output is None:
+                            shapes.append(None)
+                            continue
+                        view = np.ndarray(output.shape, dtype=np.float32, buffer=buffer, offset=offset)
+                        view[:] = output
+                        del view
+                        offset += output.nbytes
+                        shapes.append(output.shape)
+                    reply = ('ok', tuple(shapes))
+                elif kind == 'info':
+                    reply = ('ok', {
+                        'tag_names': tagger.tag_names,
+                        'tag_categories': tagger.tag_categories,
+                        'tag_counts': tagger.tag_counts,
+                        'cache_namespace': tagger.cache_namespace,
+                        'embedding_dim': tagger.embedding_dim,
+                        'model_size_mb': tagger.get_model_size_mb(),
+                        'model_info': tagger.get_model_info()
+                    })
+                elif kind == 'resolve_batch_size':
+                    with inference_lock:
+                        reply = ('ok', tagger.resolve_batch_size(*args))
+                else:
+                    reply = ('error', f"未知的请求类型: {kind}")
+            except Exception as e:
+                reply = ('error', f"{type(e).__name__}: {e}")
+            conn.send(reply)
+    finally:
+        for segment in segments.values():
+            segment.close()
+        conn.close()
+
+def _sidecar_main(socket_path: str, authkey: bytes, model_name: str):
+    """标注进程入口：加载模型后监听套接字，每个连接一个线程，推理串行执行"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - sidecar - %(levelname)s - %(message)s')
+    from .wd_tagger import WDTaggerService
+
+    tagger = WDTaggerService(model_name=model_name, sidecar=False)
+    inference_lock = threading.Lock()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = Listener(socket_path, family='AF_UNIX', authkey=authkey)
+    logger.info(f"标注进程已就绪: {socket_path}")
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=_serve_connection, args=(conn, tagger, inference_lock), daemon=True).start()
+
+def _stop_worker(state: Dict[str, Any]):
+    """终止标注进程并释放共享内存（客户端被回收或服务退出时调用）"""
+    process = state.get('process')
+    if process is not None and process.is_alive():
+        process.terminate()
+        process.join(timeout=10)
+    shm = state.get('shm')
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+        state['shm'] = None
+    if os.path.exists(state['socket_path']):
+        os.unlink(state['socket_path'])
+
+def _supervise(backend_ref: "weakref.ref", interval: float):
+    """定期检查标注进程，意外退出时重启；客户端被回收后结束"""
+    while True:
+        time.sleep(interval)
+        backend = backend_ref()
+        if backend is None or backend.closed:
+            return
+        try:
+            backend.ensure_worker()
+        except Exception as e:
+            logger.error(f"重启标注进程失败: {e}")
+        del backend
+
+class SidecarTaggerBackend:
+    """进程外WD Tagger的客户端
+
+    由API进程启动并监督一个常驻的标注进程（spawn）：模型只存在于该进程中，
+    推理不与请求处理争用GIL，本地代码崩溃也不会带倒API进程。
+    批次张量写入复用的共享内存块，套接字上只传递块名和形状；结果写回同一块内存。
+    标注进程退出后由监督线程或下一次请求自动重启，请求会重试一次。
+    """
+
+    def __init__(self, model_name: str, start_timeout: float = 600.0,
+                 socket_dir: Optional[str] = None, supervise_interval: float = 2.0):
+        self.model_name = model_name
+        self.start_timeout = start_timeout
+        socket_dir = socket_dir or tempfile.gettempdir()
+        self.socket_path = str(Path(socket_dir) / f"wd-tagger-{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self._authkey = os.urandom(32)
+        self._ctx = mp.get_context("spawn")
+        self._state: Dict[str, Any] = {'process': None, 'shm': None, 'socket_path': self.socket_path}
+        self._conn = None
+        self._lock = threading.Lock()          # 单连接上的请求串行
+        self._restart_lock = threading.Lock()
+        self.restarts = 0
+        self.closed = False
+        self._finalizer = weakref.finalize(self, _stop_worker, self._state)
+
+        self._start_worker()
+        self.info = self._call(('info',))
+        threading.Thread(target=_supervise, args=(weakref.ref(self), supervise_interval),
+                         name="tagger-sidecar-supervisor", daemon=True).start()
+
+    @property
+    def pid(self) -> Optional[int]:
+        process = self._state['process']
+        return process.pid if process is not None else None
+
+    def _start_worker(self):
+        """启动标注进程并等待其开始监听"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # 被强制结束的进程留下的套接字文件
+        process = self._ctx.Process(
+            target=_sidecar_main,
+            args=(self.socket_path, self._authkey, self.model_name),
+            name="tagger-sidecar",
+            daemon=True
+        )
+        process.start()
+        self._state['process'] = process
+        logger.info(f"正在启动标注进程 (pid={process.pid}): {self.model_name}")
+
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            if not process.is_alive():
+                raise RuntimeError(f"标注进程启动失败，退出码 {process.exitcode}")
+            if os.path.exists(self.socket_path):
+                try:
+                    Client(self.socket_path, family='AF_UNIX', authkey=self._authkey).close()
+                    return
+                except OSError:
+                    pass
+            time.sleep(0.2)
+        process.terminate()
+        raise TimeoutError(f"标注进程在 {self.start_timeout:.0f} 秒内未就绪")
+
+    def ensure_worker(self):
+        """标注进程已退出时重启"""
+        with self._restart_lock:
+            process = self._state['process']
+            if self.closed or (process is not None and process.is_alive()):
+                return
+            logger.warning(f"标注进程已退出 (退出码 {process.exitcode if process else None})，正在重启")
+            self.restarts += 1
+            self._start_worker()
+
+    def _drop_connection(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
+    def _call(self, message: Tuple, before_send: Optional[Callable[[], None]] = None) -> Any:
+        """发送请求并等待结果（调用方持有 self._lock 或处于初始化阶段），通信失败时重启并重试一次"""
+        for attempt in range(2):
+            try:
+                if before_send is not None:
+                    before_send()
+                if self._conn is None:
+                    self._conn = Client(self.socket_path, family='AF_UNIX', authkey=self._authkey)
+                self._conn.send(message)
+                kind, payload = self._conn.recv()
+                break
+            except (EOFError, OSError) as e:
+                self._drop_connection()
+                if attempt:
+                    raise RuntimeError(f"与标注进程通信失败: {e}") from e
+                logger.warning(f"与标注进程通信失败，重试: {e}")
+                self.ensure_worker()
+        if kind == 'error':
+            raise RuntimeError(f"标注进程推理失败: {payload}")
+        return payload
+
+    def _buffer(self, nbytes: int) -> SharedMemory:
+        """复用的共享内存块，容量不足时按需扩容"""
+        shm = self._state['shm']
+        if shm is None or shm.size < nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = SharedMemory(create=True, size=nbytes)
+            self._state['shm'] = shm
+        return shm
+
+    def predict(self, batch: np.ndarray, with_embeddings: bool = False):
+        """推理一个预处理后的 (N, 3, H, W) 批次，返回概率矩阵（及池化特征）"""
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        output_bytes = len(batch) * 4 * (len(self.info['tag_names']) + self.info['embedding_dim'])
+        with self._lock:
+            shm = self._buffer(max(batch.nbytes, output_bytes))
+
+            def write_input():
+                view = np.ndarray(batch.shape, dtype=np.float32, buffer=shm.buf)
+                view[:] = batch  # 重试时重新写入（标注进程可能已覆盖为结果）
+                del view
+
+            probs_shape, embeddings_shape = self._call(
+                ('predict', shm.name, batch.shape, with_embeddings), before_send=write_input
+            )
+            probs = np.ndarray(probs_shape, dtype=np.float32, buffer=shm.buf).copy()
+            if embeddings_shape is None:
+                return probs
+            embeddings = np.ndarray(embeddings_shape, dtype=np.float32, buffer=shm.buf,
+                                    offset=probs.nbytes).copy()
+            return probs, embeddings
+
+    def resolve_batch_size(self, batch_size: Optional[int] = None) -> int:
+        """批次调优在标注进程中进行（测量的是该进程的峰值内存）"""
+        with self._lock:
+            return self._call(('resolve_batch_size', batch_size))
+
+    def close(self):
+        self.closed = True
+        with self._lock:
+            self._drop_connection()
+        self._finalizer()
+
+    def get_info(self) -> Dict:
+        process = self._state['process']
+        return {
+            'sidecar_pid': self.pid,
+            'sidecar_alive': process is not None and process.is_alive(),
+            'sidecar_restarts': self.restarts,
+            'sidecar_socket': self.socket_path,
+            'sidecar_model_info': self.info['model_info']
+        }
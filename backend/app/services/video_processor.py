@@ -7,16 +7,30 @@ from typing import List, Dict, Optional, Callable
 import logging
 from datetime import datetime
 from PIL import Image
+import numpy as np
 
 from ..models.video_models import (
     VideoProcessRequest, ProcessingStatus, ProcessingStatusEnum, ProcessingResult, 
     ExtractedFrame, VideoInfo, ProcessingConfig
 )
-from ..models.tag_models import TagMatchRequest, ImageTagResult
+from ..models.tag_models import TagMatchRequest
 from ..utils.config import config
 from .frame_extractor import VideoFrameExtractor
-from .wd_tagger import get_wd_tagger
+from .color_prefilter import ReferencePaletteFilter
+from .aspect_buckets import AspectBucketWriter
+from .phash_library import get_phash_library, source_video_key
+from .scene_tagger import SceneGroupTagger
+from .embedding_prefilter import ReferenceEmbeddingFilter, get_frame_embedder
+from .wd_tagger import WDTaggerService, get_wd_tagger
+from .sharded_tagger import get_bulk_tagger
+from .tag_decoder import TagDecoder
+from .tag_vocabulary import TagVocabularyIndex
+from .compact_tags import CompactTagResults
+from .prob_store import ProbabilityMatrixWriter, ProbabilityMatrixStore
+from .frame_embeddings import FrameEmbeddingWriter, FrameEmbeddingIndex
 from .tag_matcher import get_tag_matcher
+from .batch_scheduler import get_batch_scheduler
+from .model_pool import get_model_pool
 
 logger = logging.getLogger(__name__)
 
@@ -25,10 +39,14 @@ class VideoProcessingService:
     
     def __init__(self):
         self.frame_extractor = VideoFrameExtractor()
-        self.wd_tagger = get_wd_tagger()
         self.tag_matcher = get_tag_matcher()
         self.processing_tasks: Dict[str, ProcessingStatus] = {}
     
+    @property
+    def wd_tagger(self) -> WDTaggerService:
+        """首次处理任务时才加载模型（与后台预热共用同一个单例）"""
+        return get_wd_tagger()
+    
     async def start_video_processing(self, request: VideoProcessRequest) -> str:
         """开始视频处理任务（异步）"""
         
@@ -40,6 +58,8 @@ class VideoProcessingService:
             if not config.validate_file_path(ref_path, "image"):
                 raise ValueError(f"无效的参考图片路径: {ref_path}")
         
+        get_model_pool().check_allowed(getattr(request.config, 'tagger_model', None) or config.WD_MODEL_NAME)
+        
         # 创建任务ID
         task_id = str(uuid.uuid4())
         
@@ -77,14 +97,41 @@ class VideoProcessingService:
                 status.progress = 0.1 + progress * 0.3  # 0.1-0.4
                 status.current_step = f"提取视频帧: {step_info}"
             
+            # 参考图配色预筛选（可选）
+            palette_filter = None
+            if (request.reference_image_paths and
+                    getattr(request.config, 'palette_prefilter', config.PALETTE_PREFILTER)):
+                palette_filter = ReferencePaletteFilter(
+                    request.reference_image_paths,
+                    min_similarity=getattr(request.config, 'palette_similarity_threshold',
+                                           config.PALETTE_SIMILARITY_THRESHOLD)
+                )
+            
+            # 训练分桶输出（可选）
+            bucket_writer = None
+            bucket_preset = getattr(request.config, 'bucket_preset', config.BUCKET_PRESET)
+            if bucket_preset:
+                bucket_writer = AspectBucketWriter(
+                    preset=bucket_preset,
+                    crop_mode=getattr(request.config, 'bucket_crop_mode', config.BUCKET_CROP_MODE)
+                )
+            
+            phash_library = (get_phash_library()
+                             if getattr(request.config, 'phash_library', config.PHASH_LIBRARY) else None)
             frames, video_info = self.frame_extractor.extract_frames(
                 video_path=request.video_path,
                 output_dir=request.output_directory,
                 max_frames=request.config.max_frames,
                 scene_change_threshold=request.config.scene_change_threshold,
                 quality_threshold=request.config.quality_threshold,
-                progress_callback=progress_callback
+                progress_callback=progress_callback,
+                palette_filter=palette_filter,
+                bucket_writer=bucket_writer,
+                phash_library=phash_library,
+                scene_segment_threshold=config.SCENE_SEGMENT_THRESHOLD
             )
+            frame_metadata = self.frame_extractor.frame_metadata
+            pending_phashes = self.frame_extractor.pending_phashes
             
             status.completed_steps = 1
             status.progress = 0.4
@@ -92,57 +139,130 @@ class VideoProcessingService:
             if not frames:
                 raise ValueError("没有提取到任何有效帧")
             
+            model_name = getattr(request.config, 'tagger_model', None) or config.WD_MODEL_NAME
+            # 模型可能仍在加载（后台预热或多模型池），在线程池中等待，不阻塞事件循环
+            tagger = await asyncio.get_running_loop().run_in_executor(None, get_wd_tagger, model_name)
+            
+            # 参考图特征相似度预筛选（可选）：只有最相似的一部分帧进入完整标注
+            embedder = None
+            if (request.reference_image_paths and
+                    getattr(request.config, 'embedding_prefilter', config.EMBEDDING_PREFILTER)):
+                embedder = get_frame_embedder()
+                if not embedder.supports(tagger):
+                    logger.warning(f"任务 {task_id}: 当前标注后端 {tagger.backend} 不支持特征提取，跳过特征预筛选")
+                    embedder = None
+            if embedder is not None:
+                status.current_step = "参考图特征相似度预筛选"
+                embedding_filter = ReferenceEmbeddingFilter(
+                    embedder,
+                    request.reference_image_paths,
+                    keep_ratio=getattr(request.config, 'embedding_keep_ratio', config.EMBEDDING_KEEP_RATIO),
+                    min_keep=config.EMBEDDING_MIN_KEEP,
+                    batch_size=request.config.batch_size,
+                    tagger=tagger
+                )
+                kept_frames, similarity_scores = embedding_filter.select_frames(frames)
+                for frame, similarity in zip(frames, similarity_scores):
+                    frame_metadata.setdefault(frame.frame_id, {})['embedding_similarity'] = float(similarity)
+                logger.info(f"任务 {task_id}: 特征预筛选保留 {len(kept_frames)}/{len(frames)} 帧")
+                frames = kept_frames
+            
             # 步骤2: 批量标注提取的帧
             status.current_step = "对提取的帧进行WD标注"
             status.progress = 0.4
+            frames = [frame for frame in frames if Path(frame.image_path).exists()]
             logger.info(f"任务 {task_id}: 开始标注 {len(frames)} 张图片")
             
-            # 加载图片
-            frame_images = []
-            frame_filenames = []
-            output_path = Path(request.output_directory)
+            # 完整概率矩阵（可选）：之后调整阈值/重新匹配/重新导出无需重新推理
+            prob_writer = None
+            if getattr(request.config, 'store_tag_probs', config.TAG_PROBS_STORE):
+                prob_writer = ProbabilityMatrixWriter(
+                    request.output_directory, len(frames),
+                    tagger.tag_names, tagger.tag_categories,
+                    model_namespace=tagger.cache_namespace
+                )
             
-            for frame in frames:
-                # 使用image_path而不是filename
-                img_path = Path(frame.image_path)
-                if img_path.exists():
-                    image = Image.open(img_path)
-                    frame_images.append(image)
-                    frame_filenames.append(img_path.name)  # 只使用文件名部分
+            # 帧特征（可选）：与标注共用一次前向推理，用于相似帧检索
+            embedding_writer = None
+            if (getattr(request.config, 'store_embeddings', config.TAG_EMBEDDINGS_STORE) and
+                    tagger.embedding_dim > 0):
+                embedding_writer = FrameEmbeddingWriter(
+                    request.output_directory, len(frames), tagger.embedding_dim,
+                    model_namespace=tagger.cache_namespace
+                )
             
-            # 批量标注
-            frame_tag_results = self.wd_tagger.batch_tag_images(
-                images=frame_images,
-                filenames=frame_filenames,
-                general_threshold=request.config.general_tag_threshold,
-                character_threshold=request.config.character_tag_threshold,
-                batch_size=request.config.batch_size
-            )
+            if getattr(request.config, 'scene_tagging', config.SCENE_TAGGING):
+                # 场景级标注：标注次数随场景数而非帧数增长
+                scene_tagger = SceneGroupTagger(
+                    tagger,
+                    representatives_per_scene=config.SCENE_TAG_REPRESENTATIVES,
+                    verify_threshold=(config.SCENE_TAG_VERIFY_THRESHOLD
+                                      if config.SCENE_TAG_VERIFY_THRESHOLD >= 0 else None)
+                )
+                frame_tag_results, _ = scene_tagger.tag_frames(
+                    frames, frame_metadata,
+                    general_threshold=request.config.general_tag_threshold,
+                    character_threshold=request.config.character_tag_threshold,
+                    batch_size=request.config.batch_size,
+                    prob_writer=prob_writer,
+                    embedding_writer=embedding_writer
+                )
+            else:
+                # 流式批量标注：按批次打开图片，概率/特征逐批写入磁盘；提取特征或非默认模型时使用单进程模型
+                use_bulk = embedding_writer is None and model_name == config.WD_MODEL_NAME
+                bulk_tagger = (await asyncio.get_running_loop().run_in_executor(None, get_bulk_tagger)
+                               if use_bulk else tagger)  # 首次使用时启动分片进程
+                frame_tag_results = bulk_tagger.batch_tag_images(
+                    images=(frame.image_path for frame in frames),
+                    filenames=[Path(frame.image_path).name for frame in frames],  # 只使用文件名部分
+                    general_threshold=request.config.general_tag_threshold,
+                    character_threshold=request.config.character_tag_threshold,
+                    batch_size=request.config.batch_size,
+                    probs_callback=prob_writer.write if prob_writer is not None else None,
+                    embeddings_callback=embedding_writer.write if embedding_writer is not None else None,
+                    compact=True,
+                    bypass_cache=True  # 视频帧只标注一次，不经过结果缓存
+                )
             
-            # 将标签结果添加到帧数据
-            for i, tag_result in enumerate(frame_tag_results):
-                if i < len(frames):
-                    frames[i].tags = {tag.name: tag.confidence for tag in tag_result.tags}
+            if embedding_writer is not None:
+                embedding_writer.finalize([Path(frame.image_path).name for frame in frames])
+            
+            # 将标签结果添加到帧数据（紧凑结果在此转换为返回给客户端的字典）
+            for i in range(min(len(frames), len(frame_tag_results))):
+                frames[i].tags = frame_tag_results.tag_dict(i)
             
             status.completed_steps = 2
             status.progress = 0.6
             
             # 步骤3: 处理参考图像
             reference_tag_results = []
+            reference_probs = None
             if request.reference_image_paths:
                 status.current_step = "处理参考图像"
                 status.progress = 0.6
                 logger.info(f"任务 {task_id}: 处理 {len(request.reference_image_paths)} 张参考图像")
                 
-                for ref_path in request.reference_image_paths:
-                    ref_image = Image.open(ref_path)
-                    ref_tags = self.wd_tagger.tag_single_image(
-                        image=ref_image,
-                        general_threshold=request.config.general_tag_threshold,
-                        character_threshold=request.config.character_tag_threshold
-                    )
+                # 并发提交给微批调度器，与其他请求合并推理；保留概率向量以便之后重新匹配
+                reference_probs = np.stack(await asyncio.gather(*[
+                    get_batch_scheduler(model_name).predict(Image.open(ref_path))
+                    for ref_path in request.reference_image_paths
+                ]))
+                reference_tag_results = tagger.decoder.decode(
+                    reference_probs,
+                    filenames=[Path(ref_path).name for ref_path in request.reference_image_paths],
+                    general_threshold=request.config.general_tag_threshold,
+                    character_threshold=request.config.character_tag_threshold
+                )
+                for ref_path, ref_tags in zip(request.reference_image_paths, reference_tag_results):
                     ref_tags.filename = Path(ref_path).name
-                    reference_tag_results.append(ref_tags)
+            
+            if prob_writer is not None:
+                prob_writer.finalize(
+                    frames=[frame.dict() for frame in frames],
+                    frame_metadata=frame_metadata,
+                    reference_filenames=[Path(ref_path).name for ref_path in request.reference_image_paths],
+                    reference_probs=reference_probs
+                )
             
             status.completed_steps = 3
             status.progress = 0.7
@@ -160,13 +280,9 @@ class VideoProcessingService:
                     reference_tag_results, min_confidence=0.6
                 )
                 
-                # 进行匹配
-                frames_with_tags = [(frame, frame_tag_results[i]) 
-                                   for i, frame in enumerate(frames) 
-                                   if i < len(frame_tag_results)]
-                
-                matching_results = self.tag_matcher.find_matching_frames(
-                    frames_with_tags, match_request
+                # 在紧凑结果上向量化匹配
+                matching_results = self.tag_matcher.find_matching_frames_compact(
+                    frames, frame_tag_results, match_request
                 )
                 
                 matched_frames = [frame_data for frame_data, _ in matching_results]
@@ -181,9 +297,15 @@ class VideoProcessingService:
             status.progress = 0.9
             
             await self._export_final_dataset(
-                matched_frames, frame_tag_results, request.output_directory
+                matched_frames, frame_tag_results, request.output_directory,
+                frame_metadata=frame_metadata
             )
             
+            # 数据集导出成功后才把本次提取的帧写入跨视频哈希库（失败的任务不影响之后重试）
+            if phash_library is not None and pending_phashes:
+                phash_library.add_many(pending_phashes, video=source_video_key(request.video_path))
+                logger.info(f"任务 {task_id}: 哈希库新增 {len(pending_phashes)} 条")
+            
             # 完成处理
             status.status = ProcessingStatusEnum.COMPLETED
             status.progress = 1.0
@@ -219,20 +341,20 @@ class VideoProcessingService:
             status.end_time = datetime.now()
     
     async def _export_final_dataset(self, frames: List[ExtractedFrame], 
-                                   tag_results: List[ImageTagResult],
-                                   output_dir: str):
-        """导出最终数据集"""
+                                   tag_results: CompactTagResults,
+                                   output_dir: str,
+                                   frame_metadata: Optional[Dict[str, Dict]] = None):
+        """导出最终数据集（frames 可以是 tag_results 中帧的子集，按文件名对应结果行）"""
+        frame_metadata = frame_metadata or {}
         output_path = Path(output_dir)
+        row_of = {filename: row for row, filename in enumerate(tag_results.filenames)}
         
         # 创建标签文件
-        for i, frame in enumerate(frames):
-            if i < len(tag_results):
-                tag_result = tag_results[i]
-                
+        for frame in frames:
+            row = row_of.get(Path(frame.image_path).name)
+            if row is not None:
                 # 创建标签文本
-                tag_strings = []
-                for tag in tag_result.tags:
-                    tag_strings.append(f"{tag.name}:{tag.confidence:.3f}")
+                tag_strings = [f"{name}:{confidence:.3f}" for name, confidence in tag_results.tag_items(row)]
                 
                 # 保存标签文件
                 tag_filename = frame.filename.replace('.jpg', '.txt')
@@ -250,7 +372,8 @@ class VideoProcessingService:
                 'timestamp': frame.timestamp,
                 'scene_change': frame.scene_change,
                 'quality': frame.quality.dict(),
-                'tag_count': len(frame.tags) if frame.tags else 0
+                'tag_count': len(frame.tags) if frame.tags else 0,
+                **frame_metadata.get(frame.frame_id, {})
             })
         
         metadata_path = output_path / 'metadata.json'
@@ -259,6 +382,158 @@ class VideoProcessingService:
         
         logger.info(f"数据集导出完成，共 {len(frames)} 张图片")
     
+    @staticmethod
+    def _decode_stored_probs(store: ProbabilityMatrixStore, decoder: TagDecoder,
+                             frames: List[ExtractedFrame],
+                             general_threshold: float,
+                             character_threshold: float,
+                             chunk_size: int = 1024) -> CompactTagResults:
+        """按块读取已保存的概率矩阵并解码为紧凑结果"""
+        return CompactTagResults.concatenate([
+            decoder.decode_compact(
+                probs,
+                filenames=[Path(frame.image_path).name for frame in frames[start:start + len(probs)]],
+                general_threshold=general_threshold,
+                character_threshold=character_threshold
+            )
+            for start, probs in store.iter_chunks(chunk_size)
+        ], decoder)
+    
+    @staticmethod
+    def _clear_exported_tags(frames: List[ExtractedFrame], output_dir: str) -> int:
+        """删除任务中各帧已导出的标签文件（只删除与帧同名的.txt），返回删除数量"""
+        removed = 0
+        for frame in frames:
+            tag_path = Path(output_dir) / frame.filename.replace('.jpg', '.txt')
+            if tag_path.exists():
+                tag_path.unlink()
+                removed += 1
+        return removed
+    
+    async def rethreshold_task(self, output_directory: str,
+                               general_threshold: float,
+                               character_threshold: float,
+                               rematch: bool = True,
+                               chunk_size: int = 1024) -> Dict:
+        """用已保存的概率矩阵重新阈值化、重新匹配并重新导出，不加载模型"""
+        store = ProbabilityMatrixStore(output_directory)
+        decoder = TagDecoder(store.tag_names, store.categories)
+        frames = [ExtractedFrame(**frame) for frame in store.frames]
+        
+        frame_tag_results = self._decode_stored_probs(
+            store, decoder, frames, general_threshold, character_threshold, chunk_size
+        )
+        for i, frame in enumerate(frames):
+            frame.tags = frame_tag_results.tag_dict(i)
+        
+        # 清除上一次导出的标签文件，不再匹配的帧不能留下旧的标签
+        self._clear_exported_tags(frames, output_directory)
+        
+        matched_frames = frames
+        if rematch and store.reference_probs is not None:
+            reference_tag_results = decoder.decode(
+                store.reference_probs,
+                filenames=store.reference_filenames,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold
+            )
+            match_request = self.tag_matcher.create_reference_match_request(
+                reference_tag_results, min_confidence=0.6
+            )
+            matching_results = self.tag_matcher.find_matching_frames_compact(
+                frames, frame_tag_results, match_request
+            )
+            matched_frames = [frame_data for frame_data, _ in matching_results]
+        
+        await self._export_final_dataset(
+            matched_frames, frame_tag_results, output_directory,
+            frame_metadata=store.frame_metadata
+        )
+        
+        logger.info(f"重新阈值化完成: {output_directory}，匹配 {len(matched_frames)}/{len(frames)} 帧")
+        return {
+            'output_directory': output_directory,
+            'total_frames': len(frames),
+            'matched_frames': len(matched_frames),
+            'general_threshold': general_threshold,
+            'character_threshold': character_threshold,
+            'model': store.model_namespace
+        }
+    
+    def analyze_tag_cooccurrence(self, output_directory: str,
+                                 query_tags: List[str],
+                                 general_threshold: float,
+                                 character_threshold: float,
+                                 top_k: int = 20,
+                                 min_count: int = 2,
+                                 sort_by: str = 'lift',
+                                 chunk_size: int = 1024) -> Dict:
+        """在任务保存的概率矩阵上统计与查询标签共现的标签，不加载模型"""
+        store = ProbabilityMatrixStore(output_directory)
+        decoder = TagDecoder(store.tag_names, store.categories)
+        frames = [ExtractedFrame(**frame) for frame in store.frames]
+        
+        # 查询标签按词表写法规范化（"Hatsune Miku" -> hatsune_miku），词表中没有的标签原样交给匹配器报错
+        vocabulary = TagVocabularyIndex(store.tag_names, store.categories)
+        query_tags = [(vocabulary.lookup(tag) or {'name': tag})['name'] for tag in query_tags]
+        
+        frame_tag_results = self._decode_stored_probs(
+            store, decoder, frames, general_threshold, character_threshold, chunk_size
+        )
+        result = self.tag_matcher.analyze_tag_cooccurrence(
+            frame_tag_results, query_tags, top_k=top_k, min_count=min_count, sort_by=sort_by
+        )
+        result.update({
+            'output_directory': output_directory,
+            'general_threshold': general_threshold,
+            'character_threshold': character_threshold,
+            'model': store.model_namespace
+        })
+        return result
+    
+    def analyze_tag_distribution(self, output_directory: str,
+                                 general_threshold: float,
+                                 character_threshold: float,
+                                 top_k: int = 20,
+                                 chunk_size: int = 1024) -> Dict:
+        """在任务保存的概率矩阵上按给定阈值统计标签分布（出现次数、频率、平均置信度），不加载模型"""
+        store = ProbabilityMatrixStore(output_directory)
+        decoder = TagDecoder(store.tag_names, store.categories)
+        frames = [ExtractedFrame(**frame) for frame in store.frames]
+        
+        frame_tag_results = self._decode_stored_probs(
+            store, decoder, frames, general_threshold, character_threshold, chunk_size
+        )
+        result = self.tag_matcher.analyze_compact_distribution(frame_tag_results, top_k=top_k)
+        result.update({
+            'output_directory': output_directory,
+            'general_threshold': general_threshold,
+            'character_threshold': character_threshold,
+            'model': store.model_namespace
+        })
+        return result
+    
+    def search_similar_frames(self, output_directory: str,
+                              query_image_paths: Optional[List[str]] = None,
+                              frame_filename: Optional[str] = None,
+                              top_k: int = 20) -> List[Dict]:
+        """在任务保存的帧特征中检索与查询图片（或任务中某一帧）最相似的帧"""
+        index = FrameEmbeddingIndex(output_directory)
+        if frame_filename:
+            queries = index.embedding_of(frame_filename)
+        elif query_image_paths:
+            # 查询图片必须用构建帧特征的同一模型（及推理配置）提取，否则不在同一特征空间
+            tagger = get_wd_tagger(index.model_namespace.split('|')[0] or None)
+            if tagger.cache_namespace != index.model_namespace:
+                raise ValueError(f"任务帧特征由 {index.model_namespace or '未知模型'} 提取，"
+                                 f"与当前模型 {tagger.cache_namespace} 不一致，无法检索查询图片")
+            queries = tagger.extract_embeddings([Image.open(path) for path in query_image_paths])
+        else:
+            raise ValueError("需要提供查询图片路径或帧文件名")
+        
+        return [{'filename': filename, 'similarity': similarity}
+                for filename, similarity in index.search(queries, top_k=top_k)]
+    
     def get_task_status(self, task_id: str) -> Optional[ProcessingStatus]:
         """获取任务状态"""
         return self.processing_tasks.get(task_id)
@@ -1,60 +1,157 @@
 """WD EVA02-Large Tagger v3 推理服务"""
 import torch
 import timm
-import pandas as pd
 import numpy as np
 from PIL import Image
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Callable, Iterable, Iterator, Union, Any, Sequence, Set
+from itertools import islice
+from pathlib import Path
 import torchvision.transforms as transforms
-from huggingface_hub import hf_hub_download
+import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
+import threading
 import logging
 
-from ..models.tag_models import TagResult, TagCategory, ImageTagResult
+from ..models.tag_models import ImageTagResult
 from ..utils.config import config
+from .tag_decoder import TagDecoder
+from .tag_vocabulary import TagVocabularyIndex
+from .compact_tags import CompactTagResults
+from .onnx_backend import OnnxTaggerBackend
+from .model_store import get_model_store, download_vocabulary
+from .tag_cache import get_tag_cache
+from .batch_autotuner import BatchSizeAutotuner, is_oom_error, release_memory
 
 logger = logging.getLogger(__name__)
 
+INPUT_SIZE = 448  # WD v3 使用448x448
+NORMALIZE_MEAN = (0.485, 0.456, 0.406)
+NORMALIZE_STD = (0.229, 0.224, 0.225)
+PREPROCESS_VERSION = 1  # 预处理流程变化时递增，使旧的缓存结果失效
+
+ImageSource = Union[Image.Image, str, Path]
+
+def cpu_supports_bf16() -> bool:
+    """CPU是否具备原生bf16指令（AVX512-BF16 / AMX），没有时bf16 autocast反而更慢"""
+    if not torch.backends.mkldnn.is_available():
+        return False
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
 class WDTaggerService:
     """WD EVA02-Large Tagger v3 推理服务"""
     
-    def __init__(self, model_name: str = None, device: str = None):
+    def __init__(self, model_name: str = None, device: str = None, backend: str = None,
+                 precision: str = None, cpu_profile: str = None, sidecar: Optional[bool] = None):
         self.model_name = model_name or config.WD_MODEL_NAME
         self.device = device or config.DEVICE
+        self.backend = backend or config.TAGGER_BACKEND  # torch / onnx
+        self.precision = precision or config.TAGGER_PRECISION  # fp32 / int8
+        self.cpu_profile = cpu_profile or config.TAGGER_CPU_PROFILE  # default / optimized
+        self.use_sidecar = config.TAGGER_SIDECAR if sidecar is None else sidecar  # 模型运行在独立的标注进程中
+        self.cpu_optimizations = {
+            'inference_mode': False,
+            'channels_last': False,
+            'bf16_autocast': False,
+            'compiled': False
+        }
         self.model = None
+        self.onnx_backend = None
+        self.sidecar = None
+        self.model_store = None
         self.tag_names = []
+        self.tag_categories = []
+        self.tag_counts = None
         self.general_tags = []
         self.character_tags = []
+        self.decoder = None
+        self.vocabulary = None
         self.transform = None
+        self.draft_decode = config.TAGGER_DRAFT_DECODE
+        self.input_size = INPUT_SIZE
+        self.tuned_batch_size: Optional[int] = None  # 自动调优得到的批次大小
+        self.max_batch_size: Optional[int] = None    # 内存分配失败后退避得到的批次上限
+        self._logged_batch_overrides: Set[int] = set()
+        self.autotune_measurements: List[Dict] = []
+        self._autotune_lock = threading.Lock()
+        self.tag_cache = get_tag_cache()
+        # 解码/预处理线程池（PIL解码释放GIL），与上一批次的推理重叠执行
+        self._preprocess_pool = ThreadPoolExecutor(
+            max_workers=config.TAGGER_PREPROCESS_WORKERS,
+            thread_name_prefix="tagger-preprocess"
+        )
         
         # 确保设备可用
         if self.device == "cuda" and not torch.cuda.is_available():
             self.device = "cpu"
             logger.warning("CUDA不可用，切换到CPU")
+        if self.backend == "onnx":
+            self.device = "cpu"  # ONNX后端仅用于CPU部署
+        if self.backend == "torch" and self.precision == "int8" and self.device != "cpu":
+            self.device = "cpu"
+            logger.warning("int8动态量化仅支持CPU推理，切换到CPU")
         
         self._load_model()
     
     def _load_model(self):
-        """加载WD Tagger模型和标签"""
+        """加载WD Tagger模型和标签（优先使用本地模型仓库）"""
         try:
-            logger.info(f"正在加载WD Tagger: {self.model_name}")
-            
-            # 使用timm加载模型
-            self.model = timm.create_model(
-                f'hf-hub:{self.model_name}', 
-                pretrained=True
-            ).eval().to(self.device)
-            
-            # 加载标签文件
-            tags_csv_path = hf_hub_download(
-                repo_id=self.model_name, 
-                filename="selected_tags.csv"
-            )
+            logger.info(f"正在加载WD Tagger: {self.model_name} (后端: {self.backend})")
+            self.model_store = None if self.use_sidecar else get_model_store(self.model_name)
             
-            # 读取标签
-            df = pd.read_csv(tags_csv_path)
-            self.tag_names = df['name'].tolist()
-            self.general_tags = df[df['category'] == 0]['name'].tolist()
-            self.character_tags = df[df['category'] == 4]['name'].tolist()
+            if self.use_sidecar:
+                # 模型和词表都在标注进程中加载，本进程只做解码/预处理
+                from .tagger_sidecar import SidecarTaggerBackend
+                self.sidecar = SidecarTaggerBackend(
+                    self.model_name,
+                    start_timeout=config.TAGGER_SIDECAR_START_TIMEOUT,
+                    socket_dir=config.TAGGER_SIDECAR_SOCKET_DIR or None
+                )
+            elif self.backend == "onnx":
+                self.onnx_backend = OnnxTaggerBackend(
+                    config.onnx_model_path(self.model_name),
+                    intra_op_threads=config.ONNX_INTRA_OP_THREADS,
+                    inter_op_threads=config.ONNX_INTER_OP_THREADS,
+                    graph_optimization=config.ONNX_GRAPH_OPTIMIZATION
+                )
+            elif self.backend == "torch" and self.precision == "int8":
+                self.model = self._load_quantized_model()
+            elif self.backend == "torch":
+                if self.model_store is not None:
+                    self.model = self.model_store.load_model(self.device)
+                else:
+                    # 使用timm从Hugging Face Hub加载模型
+                    self.model = timm.create_model(
+                        f'hf-hub:{self.model_name}', 
+                        pretrained=True
+                    ).eval().to(self.device)
+            else:
+                raise ValueError(f"未知的推理后端: {self.backend}")
+            
+            # 加载标签（本地仓库中为预处理好的数组，否则下载并解析 selected_tags.csv）
+            if self.sidecar is not None:
+                names = self.sidecar.info['tag_names']
+                categories = np.asarray(self.sidecar.info['tag_categories'], dtype=np.int16)
+                counts = self.sidecar.info['tag_counts']
+            elif self.model_store is not None:
+                names, categories, counts = self.model_store.load_vocabulary()
+            else:
+                names, categories, counts = download_vocabulary(self.model_name)
+            self.tag_names = names
+            self.tag_categories = categories.tolist()
+            self.tag_counts = counts
+            self.general_tags = [name for name, category in zip(names, self.tag_categories) if category == 0]
+            self.character_tags = [name for name, category in zip(names, self.tag_categories) if category == 4]
+            
+            # 构建向量化标签解码器（类别索引数组只计算一次）
+            self.decoder = TagDecoder(self.tag_names, categories)
+            # 词表索引（前缀补全、类别与频次查询）
+            self.vocabulary = TagVocabularyIndex(self.tag_names, categories, counts)
             
             logger.info(f"已加载 {len(self.tag_names)} 个标签 "
                        f"({len(self.general_tags)} 个一般标签, "
@@ -62,190 +159,624 @@ class WDTaggerService:
             
             # 数据预处理管道
             self.transform = transforms.Compose([
-                transforms.Resize((448, 448)),  # WD v3 使用448x448
+                transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
                 transforms.ToTensor(),
                 transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], 
-                    std=[0.229, 0.224, 0.225]
+                    mean=list(NORMALIZE_MEAN), 
+                    std=list(NORMALIZE_STD)
                 )
             ])
             
+            self._apply_cpu_profile()
+            
         except Exception as e:
             logger.error(f"加载WD Tagger失败: {e}")
             raise
     
+    def _create_model(self, pretrained: bool) -> torch.nn.Module:
+        """构建CPU上的模型，本地模型仓库存在时不访问网络"""
+        if self.model_store is not None:
+            return self.model_store.load_model("cpu") if pretrained else self.model_store.create_model().eval()
+        return timm.create_model(f'hf-hub:{self.model_name}', pretrained=pretrained).eval()
+    
+    def _load_quantized_model(self) -> torch.nn.Module:
+        """加载Linear层动态int8量化的模型，量化权重缓存在磁盘上避免重复量化"""
+        cache_path = config.MODEL_CACHE_DIR / f"{self.model_name.replace('/', '--')}.int8.pt"
+        
+        if cache_path.exists():
+            # 只构建网络结构，再量化结构并载入缓存的量化权重
+            model = self._create_model(pretrained=False)
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            # 缓存文件由本服务生成，包含量化打包参数，需要完整反序列化
+            model.load_state_dict(torch.load(cache_path, map_location='cpu', weights_only=False))
+            logger.info(f"已从缓存加载int8量化权重: {cache_path}")
+            return model
+        
+        model = self._create_model(pretrained=True)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(model.state_dict(), cache_path)
+        logger.info(f"已完成int8动态量化并缓存: {cache_path}")
+        return model
+    
+    def _apply_cpu_profile(self):
+        """optimized 配置：inference_mode、channels_last、bf16 autocast 和 torch.compile
+        
+        逐项检测主机是否支持，加载时预热（同时触发编译），预热失败时逐级回退到eager/fp32。
+        """
+        if self.cpu_profile != "optimized" or self.device != "cpu" or self.model is None:
+            return
+        
+        self.cpu_optimizations['inference_mode'] = True
+        try:
+            self.model = self.model.to(memory_format=torch.channels_last)
+            self.cpu_optimizations['channels_last'] = True
+        except Exception as e:
+            logger.warning(f"channels_last 不可用: {e}")
+        
+        # 量化模型已是int8计算，不再叠加bf16
+        self.cpu_optimizations['bf16_autocast'] = self.precision == "fp32" and cpu_supports_bf16()
+        
+        eager_model = self.model
+        if config.TAGGER_COMPILE and hasattr(torch, "compile"):
+            try:
+                self.model = torch.compile(eager_model, dynamic=True)
+                self.cpu_optimizations['compiled'] = True
+            except Exception as e:
+                logger.warning(f"torch.compile 不可用: {e}")
+        
+        try:
+            self._warmup()
+        except Exception as e:
+            if self.cpu_optimizations['compiled']:
+                logger.warning(f"编译模型预热失败，回退到eager模式: {e}")
+                self.model = eager_model
+                self.cpu_optimizations['compiled'] = False
+            if self.cpu_optimizations['bf16_autocast']:
+                logger.warning("关闭bf16 autocast后重试预热")
+                self.cpu_optimizations['bf16_autocast'] = False
+            self._warmup()
+        
+        enabled = [name for name, on in self.cpu_optimizations.items() if on]
+        logger.info(f"CPU优化推理已启用: {', '.join(enabled)}")
+    
+    def _warmup(self, batch_size: int = 2):
+        """用空白输入跑一次推理（batch_size>1 避免编译时把批次维度特化为1）"""
+        self.predict_probs(torch.zeros(batch_size, 3, INPUT_SIZE, INPUT_SIZE))
+    
+    def _inference_context(self) -> ExitStack:
+        """推理上下文：inference_mode 或 no_grad，按需叠加 bf16 autocast"""
+        stack = ExitStack()
+        stack.enter_context(torch.inference_mode() if self.cpu_optimizations['inference_mode'] else torch.no_grad())
+        if self.cpu_optimizations['bf16_autocast']:
+            stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+        return stack
+    
+    def _prepare_input(self, batch_input: torch.Tensor) -> torch.Tensor:
+        batch_input = batch_input.to(self.device)
+        if self.cpu_optimizations['channels_last']:
+            batch_input = batch_input.contiguous(memory_format=torch.channels_last)
+        return batch_input
+    
+    def get_model_size_mb(self) -> float:
+        """模型权重占用的内存（MB），量化打包参数按实际字节计算"""
+        if self.sidecar is not None:
+            return self.sidecar.info['model_size_mb']
+        if self.model is None:
+            return 0.0
+        
+        def tensor_bytes(value) -> int:
+            if isinstance(value, torch.Tensor):
+                return value.numel() * value.element_size()
+            if isinstance(value, (tuple, list)):
+                return sum(tensor_bytes(item) for item in value)
+            return 0
+        
+        return sum(tensor_bytes(value) for value in self.model.state_dict().values()) / 1024 / 1024
+    
+    def preprocess_image(self, image: Image.Image) -> torch.Tensor:
+        """把PIL图片转换为模型输入张量 (3, 448, 448)
+        
+        尚未解码的JPEG使用draft模式，按不小于448px的最小DCT缩放比例解码，
+        1080p/4K帧的解码开销可降低数倍。
+        """
+        if self.draft_decode and image.format == 'JPEG':
+            image.draft('RGB', (INPUT_SIZE, INPUT_SIZE))  # 已解码的图片上调用无效果
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return self.transform(image)
+    
+    def _submit_preprocess(self, images: List[Image.Image]) -> List[Future]:
+        """把一批图片的解码/预处理提交到线程池"""
+        return [self._preprocess_pool.submit(self.preprocess_image, image) for image in images]
+    
+    def preprocess_batch(self, images: List[Image.Image]) -> torch.Tensor:
+        """在线程池中并行预处理一批图片，返回 (N, 3, 448, 448) 张量"""
+        return torch.stack([future.result() for future in self._submit_preprocess(images)])
+    
+    @property
+    def cache_namespace(self) -> str:
+        """缓存命名空间：模型、后端/精度与预处理版本（draft解码会改变输入像素）"""
+        if self.sidecar is not None:
+            return self.sidecar.info['cache_namespace']  # 与标注进程中的实际推理配置一致
+        precision = self.precision if self.backend == "torch" else "-"
+        if self.cpu_optimizations['bf16_autocast']:
+            precision += "-bf16"
+        return (f"{self.model_name}|{self.backend}|{precision}|"
+                f"v{PREPROCESS_VERSION}{'-draft' if self.draft_decode else ''}")
+    
+    @staticmethod
+    def _collect(futures: Dict[int, Future], errors: Optional[Dict[int, Exception]]) -> Dict[int, Any]:
+        """等待线程池结果；传入 errors 时单张图片的异常记录到 errors[下标]，而不是向上抛出"""
+        results = {}
+        for i, future in futures.items():
+            if errors is None:
+                results[i] = future.result()
+                continue
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                errors[i] = e
+        return results
+    
+    def _start_batch(self, images: List[Image.Image], use_cache: bool = True,
+                     errors: Optional[Dict[int, Exception]] = None, bypass_cache: bool = False
+                     ) -> Tuple[List[Optional[str]], Dict[str, np.ndarray], Dict[int, Future]]:
+        """查询缓存，并把未命中的图片提交到线程池预处理（use_cache=False 时全部推理，结果仍写入缓存）
+        
+        bypass_cache=True 时完全不经过缓存（不计算内容哈希、不查询也不写入）。
+        传入 errors 时无法读取的图片记录到 errors 中并跳过，其余图片照常推理。
+        """
+        if self.tag_cache is None or bypass_cache or not images:
+            return [None] * len(images), {}, dict(enumerate(self._submit_preprocess(images)))
+        
+        namespace = self.cache_namespace
+        key_futures = {i: self._preprocess_pool.submit(self.tag_cache.make_key, image, namespace)
+                       for i, image in enumerate(images)}
+        hashed = self._collect(key_futures, errors)
+        keys = [hashed.get(i) for i in range(len(images))]
+        cached = self.tag_cache.get_many([key for key in keys if key is not None]) if use_cache else {}
+        pending = {i: self._preprocess_pool.submit(self.preprocess_image, image)
+                   for i, image in enumerate(images) if i in hashed and keys[i] not in cached}
+        return keys, cached, pending
+    
+    def _finish_batch(self, keys: List[Optional[str]], cached: Dict[str, np.ndarray],
+                      pending: Dict[int, Future], with_embeddings: bool = False,
+                      errors: Optional[Dict[int, Exception]] = None):
+        """只对缓存未命中的图片推理，并与命中结果合并为 (N, num_tags) 概率矩阵
+        
+        with_embeddings=True 时返回 (概率矩阵, 未命中图片的池化特征)，调用方应关闭缓存查询以得到全部特征。
+        传入 errors 时预处理失败的图片不参与推理，其概率行为NaN，特征中不含这些图片。
+        """
+        probs = np.full((len(keys), len(self.tag_names)), np.nan, dtype=np.float32)
+        embeddings = None
+        inputs = self._collect(pending, errors)
+        if inputs:
+            miss_indices = sorted(inputs)
+            batch_input = torch.stack([inputs[i] for i in miss_indices])
+            if with_embeddings:
+                miss_probs, embeddings = self.predict_with_embeddings(batch_input)
+            else:
+                miss_probs = self.predict_probs(batch_input)
+            probs[miss_indices] = miss_probs
+            if self.tag_cache is not None:
+                self.tag_cache.put_many({keys[i]: miss_probs[j] for j, i in enumerate(miss_indices)
+                                         if keys[i] is not None})
+        for i, key in enumerate(keys):
+            if i not in pending and key in cached:
+                probs[i] = cached[key]
+        return (probs, embeddings) if with_embeddings else probs
+    
+    def preprocess_arrays(self, arrays: Union[np.ndarray, Sequence[np.ndarray]],
+                          color_order: str = "bgr", chunk_size: int = 4) -> torch.Tensor:
+        """把 uint8 (N, H, W, 3) 数组或数组列表批量转换为模型输入 (N, 3, 448, 448)
+        
+        与PIL路径等价（Resize双线性+抗锯齿、ToTensor、Normalize），但全部为批量张量运算：
+        torch.from_numpy 直接共享输入内存，同尺寸的帧按 chunk_size 分块转换，限制全分辨率浮点副本的大小。
+        """
+        if color_order not in ("bgr", "rgb"):
+            raise ValueError(f"未知的颜色顺序: {color_order}")
+        count = len(arrays)
+        batch_input = torch.empty((count, 3, INPUT_SIZE, INPUT_SIZE), dtype=torch.float32)
+        mean = torch.tensor(NORMALIZE_MEAN).view(1, 3, 1, 1)
+        std = torch.tensor(NORMALIZE_STD).view(1, 3, 1, 1)
+        
+        # 按尺寸分组，每组可以堆叠为一个批次
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for i in range(count):
+            groups.setdefault(tuple(arrays[i].shape), []).append(i)
+        
+        for shape, indices in groups.items():
+            if len(shape) != 3 or shape[2] != 3:
+                raise ValueError(f"需要 (H, W, 3) 的uint8数组，实际形状: {shape}")
+            for start in range(0, len(indices), chunk_size):
+                chunk_indices = indices[start:start + chunk_size]
+                if isinstance(arrays, np.ndarray) and chunk_indices == list(range(chunk_indices[0], chunk_indices[-1] + 1)):
+                    chunk = torch.from_numpy(arrays[chunk_indices[0]:chunk_indices[-1] + 1])
+                else:
+                    chunk = torch.from_numpy(np.stack([arrays[i] for i in chunk_indices]))
+                chunk = chunk.permute(0, 3, 1, 2)  # NHWC -> NCHW（视图，不复制）
+                if color_order == "bgr":
+                    chunk = chunk.flip(1)
+                chunk = chunk.float()
+                if chunk.shape[-2:] != (INPUT_SIZE, INPUT_SIZE):
+                    chunk = F.interpolate(chunk, size=(INPUT_SIZE, INPUT_SIZE), mode="bilinear",
+                                          align_corners=False, antialias=True)
+                batch_input[chunk_indices] = (chunk.div_(255.0) - mean) / std
+        return batch_input
+    
+    def predict_arrays(self, arrays: Union[np.ndarray, Sequence[np.ndarray]],
+                       color_order: str = "bgr") -> np.ndarray:
+        """推理一批像素数组（经过结果缓存），返回 (N, num_tags) 概率矩阵"""
+        probs = np.empty((len(arrays), len(self.tag_names)), dtype=np.float32)
+        keys: List[Optional[str]] = [None] * len(arrays)
+        cached: Dict[str, np.ndarray] = {}
+        if self.tag_cache is not None:
+            namespace = f"{self.cache_namespace}|array-{color_order}"
+            keys = [self.tag_cache.make_array_key(arrays[i], namespace) for i in range(len(arrays))]
+            cached = self.tag_cache.get_many(keys)
+        
+        miss_indices = [i for i, key in enumerate(keys) if key not in cached]
+        if miss_indices:
+            miss_probs = self.predict_probs(self.preprocess_arrays([arrays[i] for i in miss_indices], color_order))
+            probs[miss_indices] = miss_probs
+            if self.tag_cache is not None:
+                self.tag_cache.put_many({keys[i]: miss_probs[j] for j, i in enumerate(miss_indices)})
+        for i, key in enumerate(keys):
+            if key in cached:
+                probs[i] = cached[key]
+        return probs
+    
+    def predict_images(self, images: List[Image.Image],
+                       errors: Optional[Dict[int, Exception]] = None,
+                       bypass_cache: bool = False) -> np.ndarray:
+        """预处理并推理一批图片（经过结果缓存），返回 (N, num_tags) 概率矩阵
+        
+        传入 errors 时单张图片解码失败不影响其余图片：异常记录在 errors[下标]，对应行为NaN。
+        """
+        return self._finish_batch(*self._start_batch(images, errors=errors, bypass_cache=bypass_cache),
+                                  errors=errors)
+    
+    def run_model(self, batch_input: torch.Tensor) -> np.ndarray:
+        """直接对整个批次做一次前向推理，返回 (N, num_tags) 概率矩阵"""
+        if self.onnx_backend is not None:
+            return self.onnx_backend.predict(batch_input.numpy())
+        if self.sidecar is not None:
+            return self.sidecar.predict(batch_input.numpy())
+        
+        with self._inference_context():
+            outputs = self.model(self._prepare_input(batch_input))
+            return torch.sigmoid(outputs.float()).cpu().numpy()
+    
+    def _run_with_backoff(self, run: Callable[[torch.Tensor], Any], batch_input: torch.Tensor):
+        """按退避上限拆分批次推理；内存分配失败时把上限减半后重试，而不是让整个任务失败"""
+        limit = self.max_batch_size
+        if limit and len(batch_input) > limit:
+            parts = [self._run_with_backoff(run, chunk) for chunk in batch_input.split(limit)]
+            if isinstance(parts[0], tuple):
+                return tuple(np.concatenate(items) for items in zip(*parts))
+            return np.concatenate(parts)
+        
+        try:
+            return run(batch_input)
+        except Exception as e:
+            if not is_oom_error(e) or len(batch_input) <= 1:
+                raise
+            release_memory(self.device)
+            self.max_batch_size = max(1, len(batch_input) // 2)
+            logger.warning(f"批次 {len(batch_input)} 内存分配失败，批次上限退避为 {self.max_batch_size}")
+            return self._run_with_backoff(run, batch_input)
+    
+    def predict_probs(self, batch_input: torch.Tensor) -> np.ndarray:
+        """对预处理后的批次推理（内存不足时自动拆分），返回 (N, num_tags) 概率矩阵"""
+        return self._run_with_backoff(self.run_model, batch_input)
+    
+    def predict_with_embeddings(self, batch_input: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        """一次前向推理同时返回概率矩阵和分类头之前的池化特征 (N, D)"""
+        if self.sidecar is not None:
+            return self._run_with_backoff(
+                lambda batch: self.sidecar.predict(batch.numpy(), with_embeddings=True), batch_input
+            )
+        if self.model is None:
+            raise RuntimeError(f"{self.backend} 后端不支持特征提取，请使用 torch 后端")
+        return self._run_with_backoff(self._run_model_with_embeddings, batch_input)
+    
+    def _run_model_with_embeddings(self, batch_input: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        with self._inference_context():
+            features = self.model.forward_features(self._prepare_input(batch_input))
+            pooled = self.model.forward_head(features, pre_logits=True)
+            # ConvNeXt/SwinV2 的 head 需要特征图输入，池化后只能接最后的分类层
+            outputs = self.model.get_classifier()(pooled)
+            return torch.sigmoid(outputs.float()).cpu().numpy(), pooled.float().cpu().numpy()
+    
+    def resolve_batch_size(self, batch_size: Optional[int] = None) -> int:
+        """实际使用的批次大小
+        
+        调用方未指定（None）时：启用 TAGGER_AUTOTUNE 则使用调优结果（首次调用时调优，结果缓存到磁盘），
+        否则为16；调用方显式指定时使用指定值。若发生过内存退避，则不超过退避后的上限。
+        """
+        if self.sidecar is not None:
+            return self.sidecar.resolve_batch_size(batch_size)
+        if config.TAGGER_AUTOTUNE:
+            with self._autotune_lock:
+                if self.tuned_batch_size is None:
+                    autotuner = BatchSizeAutotuner(
+                        self,
+                        candidates=[size for size in (1, 2, 4, 8, 16, 32, 64, 128)
+                                    if size <= config.TAGGER_AUTOTUNE_MAX_BATCH],
+                        memory_limit_mb=config.TAGGER_MEMORY_LIMIT_MB,
+                        cache_path=config.MODEL_CACHE_DIR / "batch_autotune.json"
+                    )
+                    self.tuned_batch_size = autotuner.calibrate()
+                    self.autotune_measurements = autotuner.measurements
+            if batch_size is None:
+                batch_size = self.tuned_batch_size
+            elif batch_size != self.tuned_batch_size and batch_size not in self._logged_batch_overrides:
+                self._logged_batch_overrides.add(batch_size)
+                logger.info(f"使用调用方指定的批次大小 {batch_size}（自动调优结果为 {self.tuned_batch_size}）")
+        batch_size = batch_size or 16
+        if self.max_batch_size:
+            batch_size = min(batch_size, self.max_batch_size)
+        return batch_size
+    
+    @property
+    def embedding_dim(self) -> int:
+        """池化特征维度"""
+        if self.sidecar is not None:
+            return self.sidecar.info['embedding_dim']
+        return self.model.num_features if self.model is not None else 0
+    
     def tag_single_image(self, image: Image.Image, 
                         general_threshold: float = 0.35,
                         character_threshold: float = 0.75) -> ImageTagResult:
         """对单张图片进行标注"""
         try:
-            # 预处理图像
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            input_tensor = self.transform(image).unsqueeze(0).to(self.device)
-            
-            # 推理
-            with torch.no_grad():
-                outputs = self.model(input_tensor)
-                probs = torch.sigmoid(outputs[0]).cpu().numpy()
-            
-            # 处理结果
-            all_tags = []
-            character_tags = []
-            general_tags = []
-            ratings = {}
-            
-            for i, prob in enumerate(probs):
-                tag_name = self.tag_names[i]
-                
-                # 评级标签特殊处理
-                if tag_name in ['general', 'sensitive', 'questionable', 'explicit']:
-                    ratings[tag_name] = float(prob)
-                    continue
-                
-                # 角色标签
-                if tag_name in self.character_tags and prob > character_threshold:
-                    tag_result = TagResult(
-                        tag=tag_name,  # 修正字段名
-                        confidence=float(prob),
-                        category=TagCategory.CHARACTER
-                    )
-                    all_tags.append(tag_result)
-                    character_tags.append(tag_result)
-                
-                # 一般标签
-                elif tag_name in self.general_tags and prob > general_threshold:
-                    tag_result = TagResult(
-                        tag=tag_name,  # 修正字段名
-                        confidence=float(prob),
-                        category=TagCategory.GENERAL
-                    )
-                    all_tags.append(tag_result)
-                    general_tags.append(tag_result)
-            
-            # 转换为字典格式
-            character_dict = {tag.tag: tag.confidence for tag in character_tags}
-            general_dict = {tag.tag: tag.confidence for tag in general_tags}
-            
-            return ImageTagResult(
-                image_path="",  # 将在调用时设置
-                character_tags=character_dict,
-                general_tags=general_dict,
-                rating_tags=ratings,
-                copyright_tags={},  # 暂时为空
-                artist_tags={},     # 暂时为空
-                confidence_score=sum(tag.confidence for tag in all_tags) / len(all_tags) if all_tags else 0.0,
-                processing_time=0.0  # 将在调用时设置
-            )
+            # 预处理并推理（命中缓存时跳过模型）
+            probs = self.predict_images([image])
+            
+            return self.decoder.decode(
+                probs,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold
+            )[0]
             
         except Exception as e:
             logger.error(f"图片标注失败: {e}")
             raise
     
-    def batch_tag_images(self, images: List[Image.Image], 
+    def iter_tag_images(self, images: Iterable[ImageSource],
+                        filenames: Optional[Iterable[str]] = None,
+                        general_threshold: float = 0.35,
+                        character_threshold: float = 0.75,
+                        batch_size: Optional[int] = None,
+                        probs_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                        embeddings_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                        compact: bool = False,
+                        on_error: Optional[Callable[[str, Exception], None]] = None,
+                        bypass_cache: bool = False
+                        ) -> Iterator[Union[List[ImageTagResult], CompactTagResults]]:
+        """流式批量标注：从可迭代对象逐批读取PIL图片或图片路径，逐批产出结果
+        
+        同一时间只有当前批次和预取的下一批次处于打开/解码状态，内存与文件句柄不随图片总数增长。
+        probs_callback 以 (批次起始下标, 概率矩阵) 接收每个批次的完整概率，用于持久化；
+        embeddings_callback 以同样方式接收同一次前向推理得到的池化特征（此时不使用结果缓存）。
+        compact 为True时每个批次产出 CompactTagResults（词表下标 + float16置信度），不构建字典。
+        on_error 为None时任意一张图片无法读取都会中止标注；设置时以 (文件名, 异常) 回调并跳过该图片，
+        结果与回调下标中不含被跳过的图片。
+        bypass_cache 为True时不经过结果缓存（视频帧等只标注一次的图片，省去内容哈希的文件读取和缓存写入）。
+        """
+        image_iter = iter(images)
+        filename_iter = iter(filenames) if filenames is not None else None
+        use_cache = embeddings_callback is None
+        batch_size = self.resolve_batch_size(batch_size)
+        read_count = 0
+        
+        def read_batch() -> Tuple[List[Image.Image], List[str]]:
+            nonlocal read_count
+            while True:
+                items = list(islice(image_iter, batch_size))
+                if filename_iter is not None:
+                    names = list(islice(filename_iter, len(items)))
+                else:
+                    names = [f"image_{read_count + j}.jpg" if isinstance(item, Image.Image) else Path(item).name
+                             for j, item in enumerate(items)]
+                read_count += len(items)
+                batch_images, batch_filenames = [], []
+                for item, name in zip(items, names):
+                    try:
+                        batch_images.append(item if isinstance(item, Image.Image) else Image.open(item))
+                    except Exception as e:
+                        if on_error is None:
+                            raise
+                        on_error(name, e)
+                        continue
+                    batch_filenames.append(name)
+                # 整个批次都无法读取时继续读下一批，空批次只表示输入已读完
+                if batch_images or not items:
+                    return batch_images, batch_filenames
+        
+        def start_batch(batch_images: List[Image.Image]):
+            errors = {} if on_error is not None else None
+            return self._start_batch(batch_images, use_cache=use_cache, errors=errors,
+                                     bypass_cache=bypass_cache), errors
+        
+        # 预处理流水线：推理当前批次时，下一批次已在线程池中解码（缓存命中的图片不解码）
+        offset = 0
+        batch_images, batch_filenames = read_batch()
+        current, errors = start_batch(batch_images)
+        while batch_images:
+            next_images, next_filenames = read_batch()
+            upcoming, next_errors = start_batch(next_images)
+            
+            # 批量推理
+            embeddings_batch = None
+            if embeddings_callback is not None:
+                probs_batch, embeddings_batch = self._finish_batch(*current, with_embeddings=True, errors=errors)
+            else:
+                probs_batch = self._finish_batch(*current, errors=errors)
+            if errors:
+                # 解码/预处理失败的图片不进入结果（特征中本就不含这些图片）
+                for i in sorted(errors):
+                    on_error(batch_filenames[i], errors[i])
+                keep = [i for i in range(len(batch_filenames)) if i not in errors]
+                probs_batch = probs_batch[keep]
+                batch_filenames = [batch_filenames[i] for i in keep]
+            if embeddings_callback is not None:
+                if embeddings_batch is None:  # 整个批次预处理失败
+                    embeddings_batch = np.zeros((0, self.embedding_dim), dtype=np.float32)
+                embeddings_callback(offset, embeddings_batch)
+            if probs_callback is not None:
+                probs_callback(offset, probs_batch)
+            
+            # 向量化解码整个批次
+            decode = self.decoder.decode_compact if compact else self.decoder.decode
+            results = decode(
+                probs_batch,
+                filenames=batch_filenames,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold
+            )
+            offset += len(batch_filenames)
+            logger.info(f"已处理 {offset} 张图片")
+            yield results
+            
+            # 释放已完成批次的图片，只保留预取的下一批次
+            batch_images, batch_filenames = next_images, next_filenames
+            current, errors = upcoming, next_errors
+    
+    def batch_tag_images(self, images: Iterable[ImageSource],
                         filenames: List[str] = None,
                         general_threshold: float = 0.35,
                         character_threshold: float = 0.75,
-                        batch_size: int = 16) -> List[ImageTagResult]:
-        """批量标注图片"""
+                        batch_size: Optional[int] = None,
+                        probs_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                        embeddings_callback: Optional[Callable[[int, np.ndarray], None]] = None,
+                        compact: bool = False,
+                        bypass_cache: bool = False) -> Union[List[ImageTagResult], CompactTagResults]:
+        """批量标注图片（PIL图片或图片路径），返回全部结果，参数含义同 iter_tag_images
+
+        compact 为True时返回拼接后的 CompactTagResults。
+        """
         results = []
-        filenames = filenames or [f"image_{i}.jpg" for i in range(len(images))]
         
         try:
-            for i in range(0, len(images), batch_size):
-                batch_images = images[i:i + batch_size]
-                batch_filenames = filenames[i:i + batch_size]
-                batch_tensors = []
-                
-                # 预处理批次
-                for image in batch_images:
-                    if image.mode != 'RGB':
-                        image = image.convert('RGB')
-                    tensor = self.transform(image)
-                    batch_tensors.append(tensor)
-                
-                # 批量推理
-                batch_input = torch.stack(batch_tensors).to(self.device)
-                with torch.no_grad():
-                    outputs = self.model(batch_input)
-                    probs_batch = torch.sigmoid(outputs).cpu().numpy()
-                
-                # 处理每张图片的结果
-                for j, (probs, filename) in enumerate(zip(probs_batch, batch_filenames)):
-                    all_tags = []
-                    character_tags = []
-                    general_tags = []
-                    ratings = {}
-                    
-                    for k, prob in enumerate(probs):
-                        tag_name = self.tag_names[k]
-                        
-                        # 评级标签
-                        if tag_name in ['general', 'sensitive', 'questionable', 'explicit']:
-                            ratings[tag_name] = float(prob)
-                            continue
-                        
-                        # 角色标签
-                        if tag_name in self.character_tags and prob > character_threshold:
-                            tag_result = TagResult(
-                                tag=tag_name,  # 修正字段名
-                                confidence=float(prob),
-                                category=TagCategory.CHARACTER
-                            )
-                            all_tags.append(tag_result)
-                            character_tags.append(tag_result)
-                        
-                        # 一般标签
-                        elif tag_name in self.general_tags and prob > general_threshold:
-                            tag_result = TagResult(
-                                tag=tag_name,  # 修正字段名
-                                confidence=float(prob),
-                                category=TagCategory.GENERAL
-                            )
-                            all_tags.append(tag_result)
-                            general_tags.append(tag_result)
-                    
-                    # 转换为字典格式
-                    character_dict = {tag.tag: tag.confidence for tag in character_tags}
-                    general_dict = {tag.tag: tag.confidence for tag in general_tags}
-                    
-                    result = ImageTagResult(
-                        image_path=filename,
-                        character_tags=character_dict,
-                        general_tags=general_dict,
-                        rating_tags=ratings,
-                        copyright_tags={},  # 暂时为空
-                        artist_tags={},     # 暂时为空
-                        confidence_score=sum(tag.confidence for tag in all_tags) / len(all_tags) if all_tags else 0.0,
-                        processing_time=0.0  # 将在处理完成后设置
-                    )
-                    results.append(result)
-                    
-                logger.info(f"已处理 {min(i + batch_size, len(images))}/{len(images)} 张图片")
+            for batch_results in self.iter_tag_images(
+                images, filenames=filenames,
+                general_threshold=general_threshold,
+                character_threshold=character_threshold,
+                batch_size=batch_size,
+                probs_callback=probs_callback,
+                embeddings_callback=embeddings_callback,
+                compact=compact,
+                bypass_cache=bypass_cache
+            ):
+                if compact:
+                    results.append(batch_results)
+                else:
+                    results.extend(batch_results)
             
-            return results
+            return CompactTagResults.concatenate(results, self.decoder) if compact else results
             
         except Exception as e:
             logger.error(f"批量标注失败: {e}")
             raise
     
+    def batch_tag_arrays(self, arrays: Union[np.ndarray, Sequence[np.ndarray]],
+                         filenames: List[str] = None,
+                         general_threshold: float = 0.35,
+                         character_threshold: float = 0.75,
+                         batch_size: Optional[int] = None,
+                         color_order: str = "bgr") -> List[ImageTagResult]:
+        """批量标注已解码的像素数组（如OpenCV读取的BGR帧），不经过PIL"""
+        results = []
+        filenames = filenames or [f"image_{i}.jpg" for i in range(len(arrays))]
+        batch_size = self.resolve_batch_size(batch_size)
+        
+        try:
+            for i in range(0, len(arrays), batch_size):
+                probs_batch = self.predict_arrays(arrays[i:i + batch_size], color_order)
+                results.extend(self.decoder.decode(
+                    probs_batch,
+                    filenames=filenames[i:i + batch_size],
+                    general_threshold=general_threshold,
+                    character_threshold=character_threshold
+                ))
+                logger.info(f"已处理 {min(i + batch_size, len(arrays))}/{len(arrays)} 张图片")
+            
+            return results
+            
+        except Exception as e:
+            logger.error(f"批量标注像素数组失败: {e}")
+            raise
+    
+    def tag_images_with_embeddings(self, images: Iterable[ImageSource],
+                                   filenames: List[str] = None,
+                                   general_threshold: float = 0.35,
+                                   character_threshold: float = 0.75,
+                                   batch_size: Optional[int] = None) -> Tuple[List[ImageTagResult], np.ndarray]:
+        """批量标注并返回同一次前向推理的池化特征 (N, D) float32"""
+        embeddings = []
+        results = self.batch_tag_images(
+            images, filenames=filenames,
+            general_threshold=general_threshold,
+            character_threshold=character_threshold,
+            batch_size=batch_size,
+            embeddings_callback=lambda start, batch: embeddings.append(batch)
+        )
+        if not embeddings:
+            return results, np.zeros((0, self.embedding_dim), dtype=np.float32)
+        return results, np.concatenate(embeddings)
+    
+    def extract_embeddings(self, images: List[Image.Image],
+                           batch_size: Optional[int] = None) -> np.ndarray:
+        """提取主干网络的池化特征（分类头之前），返回 (N, D) float32 数组（支持标注进程模式）"""
+        embeddings = []
+        batch_size = self.resolve_batch_size(batch_size)
+        
+        try:
+            for i in range(0, len(images), batch_size):
+                _, pooled = self.predict_with_embeddings(self.preprocess_batch(images[i:i + batch_size]))
+                embeddings.append(pooled)
+            
+            if not embeddings:
+                return np.zeros((0, self.embedding_dim), dtype=np.float32)
+            return np.concatenate(embeddings)
+            
+        except Exception as e:
+            logger.error(f"提取图片特征失败: {e}")
+            raise
+    
     def get_model_info(self) -> Dict:
         """获取模型信息"""
-        return {
+        info = {
             'model_name': self.model_name,
+            'backend': self.backend,
+            'precision': self.precision if self.backend == "torch" else None,
             'device': self.device,
+            'model_source': str(self.model_store.path) if self.model_store is not None else 'hf-hub',
+            'cpu_profile': self.cpu_profile,
+            'cpu_optimizations': dict(self.cpu_optimizations),
+            'model_size_mb': round(self.get_model_size_mb(), 1),
+            'batch_size': self.tuned_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'autotune_measurements': self.autotune_measurements,
             'total_tags': len(self.tag_names),
             'general_tags_count': len(self.general_tags),
-            'character_tags_count': len(self.character_tags)
+            'character_tags_count': len(self.character_tags),
+            'vocabulary': self.vocabulary.get_stats() if self.vocabulary is not None else None,
+            'embedding_dim': self.embedding_dim,
+            'tag_cache': self.tag_cache is not None
         }
+        if self.onnx_backend is not None:
+            info.update(self.onnx_backend.get_info())
+        if self.sidecar is not None:
+            info.update(self.sidecar.get_info())
+        return info
 
-# 全局单例实例
-_tagger_instance = None
+def get_wd_tagger(model_name: Optional[str] = None) -> WDTaggerService:
+    """获取WD Tagger服务实例，未指定模型时为默认模型 WD_MODEL_NAME
 
-def get_wd_tagger() -> WDTaggerService:
-    """获取WD Tagger服务实例（单例模式）"""
-    global _tagger_instance
-    if _tagger_instance is None:
-        _tagger_instance = WDTaggerService()
-    return _tagger_instance
+    实例由多模型标注池管理：同一模型只加载一次（并发调用共享同一次加载），默认模型常驻。
+    """
+    from .model_pool import get_model_pool
+    return get_model_pool().get(model_name or config.WD_MODEL_NAME)
@@ -14,16 +14,90 @@ class Config:
     # 模型配置
     WD_MODEL_NAME = os.getenv("WD_MODEL_NAME", "SmilingWolf/wd-eva02-large-tagger-v3")
     DEVICE = os.getenv("DEVICE", "cuda")
+    TAGGER_BACKEND = os.getenv("TAGGER_BACKEND", "torch")  # torch / onnx
+    TAGGER_PRECISION = os.getenv("TAGGER_PRECISION", "fp32")  # fp32 / int8（Linear层动态量化，仅CPU）
+    TAGGER_CPU_PROFILE = os.getenv("TAGGER_CPU_PROFILE", "default")  # default / optimized（channels_last、bf16、compile）
+    TAGGER_COMPILE = os.getenv("TAGGER_COMPILE", "true").lower() == "true"  # optimized 配置下是否使用 torch.compile
+    TAGGER_DRAFT_DECODE = os.getenv("TAGGER_DRAFT_DECODE", "true").lower() == "true"  # JPEG按缩小的DCT尺度解码
+    TAGGER_PREPROCESS_WORKERS = int(os.getenv("TAGGER_PREPROCESS_WORKERS", "4"))
+    TAGGER_SHARDS = int(os.getenv("TAGGER_SHARDS", "0"))  # 批量标注的CPU工作进程数，0表示不分片
+    TAGGER_SHARD_THREADS = int(os.getenv("TAGGER_SHARD_THREADS", "0"))  # 每个进程的torch线程数，0表示按CPU核数均分
+    TAGGER_SIDECAR = os.getenv("TAGGER_SIDECAR", "false").lower() == "true"  # 模型运行在独立的标注进程中
+    TAGGER_SIDECAR_START_TIMEOUT = float(os.getenv("TAGGER_SIDECAR_START_TIMEOUT", "600"))
+    TAGGER_SIDECAR_SOCKET_DIR = os.getenv("TAGGER_SIDECAR_SOCKET_DIR", "")  # 为空时使用系统临时目录
+    # 可按请求选择的标注模型（逗号分隔，默认模型总是可用）与多模型池的内存预算（0 表示不限制）
+    TAGGER_MODELS = [name.strip() for name in os.getenv(
+        "TAGGER_MODELS",
+        "SmilingWolf/wd-eva02-large-tagger-v3,SmilingWolf/wd-vit-large-tagger-v3,"
+        "SmilingWolf/wd-swinv2-tagger-v3,SmilingWolf/wd-convnext-tagger-v3,SmilingWolf/wd-vit-tagger-v3"
+    ).split(",") if name.strip()]
+    TAGGER_POOL_MEMORY_MB = float(os.getenv("TAGGER_POOL_MEMORY_MB", "4096"))
+    TAGGER_BACKGROUND_WARMUP = os.getenv("TAGGER_BACKGROUND_WARMUP", "true").lower() == "true"  # 启动后在后台加载模型
     
     # 文件路径配置
     BASE_DIR = Path(__file__).parent.parent.parent
     DEFAULT_OUTPUT_DIR = BASE_DIR / "outputs"
     TEMP_DIR = BASE_DIR / "temp"
+    MODEL_CACHE_DIR = Path(os.getenv("MODEL_CACHE_DIR", str(BASE_DIR / "model_cache")))
+    MODEL_STORE_DIR = Path(os.getenv("MODEL_STORE_DIR", str(MODEL_CACHE_DIR / "model_store")))  # export_model_store.py 导出的本地模型
+    TAGGER_OFFLINE = os.getenv("TAGGER_OFFLINE", "false").lower() == "true"  # 只从本地模型仓库加载，不访问Hub
+    
+    # ONNX Runtime 后端配置（线程数为0时由ONNX Runtime决定）
+    ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", str(MODEL_CACHE_DIR / "wd_tagger.onnx"))
+    ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+    ONNX_INTER_OP_THREADS = int(os.getenv("ONNX_INTER_OP_THREADS", "0"))
+    ONNX_GRAPH_OPTIMIZATION = os.getenv("ONNX_GRAPH_OPTIMIZATION", "all")  # disable / basic / extended / all
+    
+    # 微批推理调度配置（合并并发的单图请求）
+    TAGGER_BATCH_MAX_SIZE = int(os.getenv("TAGGER_BATCH_MAX_SIZE", "16"))
+    TAGGER_BATCH_MAX_WAIT_MS = float(os.getenv("TAGGER_BATCH_MAX_WAIT_MS", "10"))
+    TAGGER_QUEUE_MAX_SIZE = int(os.getenv("TAGGER_QUEUE_MAX_SIZE", "256"))
+    
+    # 批次大小自动调优（首次使用时实测吞吐量与峰值内存，请求未指定batch_size时使用调优结果）
+    TAGGER_AUTOTUNE = os.getenv("TAGGER_AUTOTUNE", "true").lower() == "true"
+    TAGGER_AUTOTUNE_MAX_BATCH = int(os.getenv("TAGGER_AUTOTUNE_MAX_BATCH", "64"))
+    TAGGER_MEMORY_LIMIT_MB = float(os.getenv("TAGGER_MEMORY_LIMIT_MB", "0"))  # 0: CUDA取显存的90%，CPU不设上限
+    
+    # 标注结果持久化缓存（按图片内容哈希 + 模型 + 预处理版本缓存概率向量）
+    TAG_CACHE = os.getenv("TAG_CACHE", "true").lower() == "true"
+    TAG_CACHE_PATH = os.getenv("TAG_CACHE_PATH", str(MODEL_CACHE_DIR / "tag_cache.sqlite3"))
+    TAG_CACHE_MAX_MB = float(os.getenv("TAG_CACHE_MAX_MB", "2048"))
     
     # 视频处理配置
     MAX_FRAMES = int(os.getenv("MAX_FRAMES", "200"))
     SCENE_CHANGE_THRESHOLD = float(os.getenv("SCENE_CHANGE_THRESHOLD", "0.15"))  # 降低阈值，要求更显著的变化
     QUALITY_THRESHOLD = float(os.getenv("QUALITY_THRESHOLD", "0.5"))  # 稍微降低质量要求
+    SCENE_SEGMENT_THRESHOLD = float(os.getenv("SCENE_SEGMENT_THRESHOLD", "0.4"))  # 镜头硬切阈值，用于划分场景片段
+    TAG_PROBS_STORE = os.getenv("TAG_PROBS_STORE", "true").lower() == "true"  # 保存每帧完整概率矩阵（float16）
+    TAG_EMBEDDINGS_STORE = os.getenv("TAG_EMBEDDINGS_STORE", "false").lower() == "true"  # 保存每帧池化特征（仅torch后端）
+    
+    # 参考图配色预筛选配置
+    PALETTE_PREFILTER = os.getenv("PALETTE_PREFILTER", "false").lower() == "true"
+    PALETTE_SIMILARITY_THRESHOLD = float(os.getenv("PALETTE_SIMILARITY_THRESHOLD", "0.2"))
+    
+    # 参考图特征相似度预筛选配置（EMBEDDING_MODEL_NAME为空时复用WD Tagger主干）
+    EMBEDDING_PREFILTER = os.getenv("EMBEDDING_PREFILTER", "false").lower() == "true"
+    EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "")
+    EMBEDDING_IMAGE_SIZE = int(os.getenv("EMBEDDING_IMAGE_SIZE", "224"))
+    EMBEDDING_KEEP_RATIO = float(os.getenv("EMBEDDING_KEEP_RATIO", "0.3"))
+    EMBEDDING_MIN_KEEP = int(os.getenv("EMBEDDING_MIN_KEEP", "8"))
+    
+    # 训练分桶输出配置（BUCKET_PRESET为空时保存原始帧，可选 sd / sd2 / sdxl）
+    BUCKET_PRESET = os.getenv("BUCKET_PRESET", "")
+    BUCKET_CROP_MODE = os.getenv("BUCKET_CROP_MODE", "center")  # center / face
+    # face 裁剪使用的级联检测器：默认为动漫人脸检测器 lbpcascade_animeface.xml（需自行下载），
+    # 真人视频可设为 OpenCV 自带的 haarcascade_frontalface_default.xml（只写文件名时在 cv2.data.haarcascades 中查找）
+    BUCKET_FACE_CASCADE = os.getenv("BUCKET_FACE_CASCADE", str(MODEL_CACHE_DIR / "lbpcascade_animeface.xml"))
+    
+    # 跨视频感知哈希库配置（跳过在其他剧集中已提取过的重复镜头）
+    PHASH_LIBRARY = os.getenv("PHASH_LIBRARY", "false").lower() == "true"
+    PHASH_LIBRARY_PATH = os.getenv("PHASH_LIBRARY_PATH", str(DEFAULT_OUTPUT_DIR / "phash_library.sqlite3"))
+    PHASH_LIBRARY_RADIUS = int(os.getenv("PHASH_LIBRARY_RADIUS", "6"))
+    
+    # 场景级标注配置（每个场景片段只标注代表帧，标签传播给同场景帧）
+    SCENE_TAGGING = os.getenv("SCENE_TAGGING", "false").lower() == "true"
+    SCENE_TAG_REPRESENTATIVES = int(os.getenv("SCENE_TAG_REPRESENTATIVES", "1"))
+    SCENE_TAG_VERIFY_THRESHOLD = float(os.getenv("SCENE_TAG_VERIFY_THRESHOLD", "0.12"))  # 小于0时关闭补标
     
     # 标签配置
     TAG_THRESHOLD = float(os.getenv("TAG_THRESHOLD", "0.35"))
@@ -44,9 +118,36 @@ class Config:
             'tag_threshold': cls.TAG_THRESHOLD,
             'character_tag_threshold': cls.CHARACTER_TAG_THRESHOLD,
             'general_tag_threshold': cls.GENERAL_TAG_THRESHOLD,
+            'palette_prefilter': cls.PALETTE_PREFILTER,
+            'palette_similarity_threshold': cls.PALETTE_SIMILARITY_THRESHOLD,
+            'embedding_prefilter': cls.EMBEDDING_PREFILTER,
+            'embedding_keep_ratio': cls.EMBEDDING_KEEP_RATIO,
+            'bucket_preset': cls.BUCKET_PRESET,
+            'bucket_crop_mode': cls.BUCKET_CROP_MODE,
+            'phash_library': cls.PHASH_LIBRARY,
+            'scene_tagging': cls.SCENE_TAGGING,
+            'store_tag_probs': cls.TAG_PROBS_STORE,
+            'store_embeddings': cls.TAG_EMBEDDINGS_STORE,
+            'tagger_model': cls.WD_MODEL_NAME,
             'batch_size': 16
         }
     
+    @staticmethod
+    def explicit_option(options: Any, key: str) -> Any:
+        """请求配置（pydantic模型）中客户端显式给出的字段值，使用模型默认值时返回None"""
+        fields_set = getattr(options, 'model_fields_set', None)
+        if fields_set is None:
+            fields_set = getattr(options, '__fields_set__', set())
+        return getattr(options, key, None) if key in fields_set else None
+    
+    @classmethod
+    def onnx_model_path(cls, model_name: str) -> str:
+        """模型对应的ONNX文件：默认模型为 ONNX_MODEL_PATH，其他模型在同目录下按模型名区分"""
+        if model_name == cls.WD_MODEL_NAME:
+            return cls.ONNX_MODEL_PATH
+        default_path = Path(cls.ONNX_MODEL_PATH)
+        return str(default_path.with_name(f"{default_path.stem}-{model_name.replace('/', '--')}.onnx"))
+    
     @classmethod
     def ensure_directories(cls):
         """确保必要的目录存在"""
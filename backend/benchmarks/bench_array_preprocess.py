@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+像素数组预处理评估 - 对比PIL预处理与 preprocess_arrays 张量预处理的速度、输入误差和标签一致性
+用法: python benchmarks/bench_array_preprocess.py <验证帧目录> [--limit 64] [--batch-size 8]
+"""
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services.wd_tagger import WDTaggerService
+from benchmarks.common import load_images, tag_agreement, fixed_benchmark_config
+
+def main():
+    parser = argparse.ArgumentParser(description="像素数组预处理评估")
+    parser.add_argument("image_dir", help="验证帧目录")
+    parser.add_argument("--limit", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+    fixed_benchmark_config()
+
+    images = load_images(args.image_dir, args.limit)
+    frames = [cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR) for image in images]  # 模拟OpenCV解码的帧
+    tagger = WDTaggerService(device="cpu", backend="torch")
+    print(f"📊 {len(images)} 张图片, 批次 {args.batch_size}")
+
+    start = time.perf_counter()
+    pil_input = tagger.preprocess_batch(images)
+    pil_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    array_input = tagger.preprocess_arrays(frames)
+    array_time = time.perf_counter() - start
+
+    difference = (pil_input - array_input).abs()
+    print(f"PIL预处理: {len(images) / pil_time:.1f} 张/秒, 张量预处理: {len(images) / array_time:.1f} 张/秒")
+    print(f"输入误差: 最大 {difference.max().item():.4f}, 平均 {difference.mean().item():.5f}")
+
+    pil_results = tagger.batch_tag_images(images, batch_size=args.batch_size)
+    array_results = tagger.batch_tag_arrays(frames, batch_size=args.batch_size)
+    agreement = tag_agreement(pil_results, array_results)
+    print(f"标签一致性: Jaccard {agreement['mean_jaccard']:.4f}, "
+          f"完全一致 {agreement['exact_match_ratio'] * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+冷启动评估 - 在全新子进程中分别测量从Hub缓存加载与从本地模型仓库加载WD Tagger的耗时
+用法: python benchmarks/bench_cold_start.py [--runs 3]（需要先运行 export_model_store.py）
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services.model_store import LocalModelStore
+from app.utils.config import config
+
+# 子进程中计时：包含 torch/timm 导入、网络构建、权重与词表加载
+LOAD_SNIPPET = """
+import json, time
+start = time.perf_counter()
+from benchmarks.common import fixed_benchmark_config
+fixed_benchmark_config()
+from app.services.wd_tagger import WDTaggerService
+tagger = WDTaggerService(device="cpu", backend="torch")
+print(json.dumps({"seconds": time.perf_counter() - start, "source": tagger.get_model_info()["model_source"]}))
+"""
+
+def cold_start(store_dir: str) -> dict:
+    env = dict(os.environ, MODEL_STORE_DIR=store_dir, TAGGER_OFFLINE="false")
+    output = subprocess.run([sys.executable, "-c", LOAD_SNIPPET], cwd=project_root, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动评估")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    store = LocalModelStore(config.WD_MODEL_NAME)
+    if not store.exists():
+        raise SystemExit(f"本地模型仓库不存在: {store.path}，请先运行 export_model_store.py")
+
+    missing_store = str(project_root / "temp" / "no_model_store")  # 指向不存在的目录即回退到Hub
+    for label, store_dir in (("Hub缓存", missing_store), ("本地仓库", str(config.MODEL_STORE_DIR))):
+        timings = [cold_start(store_dir) for _ in range(args.runs)]
+        seconds = sorted(t["seconds"] for t in timings)
+        print(f"{label:>6}: 中位数 {seconds[len(seconds) // 2]:.2f} 秒, 最快 {seconds[0]:.2f} 秒 "
+              f"({timings[0]['source']})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+CPU优化推理配置评估 - 对比 default 与 optimized 配置的吞吐量和标签一致性
+用法: python benchmarks/bench_cpu_profile.py <验证帧目录> [--limit 64] [--batch-size 8]
+"""
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import torch
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services.wd_tagger import WDTaggerService, cpu_supports_bf16
+from benchmarks.common import load_images, measure_throughput, tag_agreement, fixed_benchmark_config
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU优化推理配置评估")
+    parser.add_argument("image_dir", help="验证帧目录")
+    parser.add_argument("--limit", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "int8"])
+    args = parser.parse_args()
+    fixed_benchmark_config()
+
+    images = load_images(args.image_dir, args.limit)
+    print(f"📊 {len(images)} 张图片, 批次 {args.batch_size}, torch {torch.__version__}, "
+          f"线程 {torch.get_num_threads()}, 原生bf16: {'是' if cpu_supports_bf16() else '否'}")
+
+    results = {}
+    for profile in ("default", "optimized"):
+        load_start = time.perf_counter()
+        tagger = WDTaggerService(device="cpu", backend="torch", precision=args.precision, cpu_profile=profile)
+        load_time = time.perf_counter() - load_start  # optimized 包含预热/编译时间
+        throughput = measure_throughput(
+            lambda batch: tagger.batch_tag_images(batch, batch_size=args.batch_size),
+            images, args.batch_size
+        )
+        enabled = [name for name, on in tagger.cpu_optimizations.items() if on] or ["eager"]
+        print(f"{profile:>9}: {throughput:.2f} 张/秒, 加载 {load_time:.1f} 秒 ({', '.join(enabled)})")
+        results[profile] = tagger.batch_tag_images(images, batch_size=args.batch_size)
+        del tagger
+
+    agreement = tag_agreement(results["default"], results["optimized"])
+    print(f"标签一致性: Jaccard {agreement['mean_jaccard']:.4f}, "
+          f"完全一致 {agreement['exact_match_ratio'] * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
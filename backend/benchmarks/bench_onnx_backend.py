@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime后端一致性与吞吐量测试 - 与torch后端在同一批图片上对比
+用法: python benchmarks/bench_onnx_backend.py <图片目录> [--limit 64] [--batch-size 8]
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services.wd_tagger import WDTaggerService
+from benchmarks.common import load_images, measure_throughput, tag_agreement, fixed_benchmark_config
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX后端一致性与吞吐量测试")
+    parser.add_argument("image_dir", help="验证图片目录（建议使用实际提取的帧）")
+    parser.add_argument("--limit", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="概率最大允许绝对误差")
+    args = parser.parse_args()
+    fixed_benchmark_config()
+
+    images = load_images(args.image_dir, args.limit)
+    torch_tagger = WDTaggerService(device="cpu", backend="torch")
+    onnx_tagger = WDTaggerService(device="cpu", backend="onnx")
+    print(f"📊 {len(images)} 张图片, 批次 {args.batch_size}, torch线程 {torch.get_num_threads()}")
+    print(f"   ONNX: {onnx_tagger.get_model_info()}")
+
+    # 一致性：相同的预处理输入，比较概率矩阵和阈值后的标签
+    batch_input = torch.stack([torch_tagger.transform(image) for image in images])
+    torch_probs = np.concatenate([torch_tagger.predict_probs(batch_input[i:i + args.batch_size])
+                                  for i in range(0, len(images), args.batch_size)])
+    onnx_probs = np.concatenate([onnx_tagger.predict_probs(batch_input[i:i + args.batch_size])
+                                 for i in range(0, len(images), args.batch_size)])
+    max_diff = float(np.abs(torch_probs - onnx_probs).max())
+    agreement = tag_agreement(torch_tagger.decoder.decode(torch_probs), onnx_tagger.decoder.decode(onnx_probs))
+    print(f"概率最大误差: {max_diff:.2e}, 标签Jaccard: {agreement['mean_jaccard']:.4f}, "
+          f"完全一致: {agreement['exact_match_ratio'] * 100:.1f}%")
+
+    # 吞吐量：包含预处理、推理和解码的完整 batch_tag_images 路径
+    for name, tagger in (("torch", torch_tagger), ("onnx", onnx_tagger)):
+        throughput = measure_throughput(
+            lambda batch: tagger.batch_tag_images(batch, batch_size=args.batch_size),
+            images, args.batch_size
+        )
+        print(f"{name:>6}: {throughput:.2f} 张/秒")
+
+    if max_diff > args.tolerance:
+        print(f"❌ 概率误差超过容差 {args.tolerance}")
+        sys.exit(1)
+    print("✅ ONNX后端与torch后端一致")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+int8动态量化评估 - 对比fp32与int8的内存占用、吞吐量和标签一致性
+用法: python benchmarks/bench_quantized.py <验证帧目录> [--limit 64] [--batch-size 8]
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+import torch
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services.wd_tagger import WDTaggerService
+from benchmarks.common import load_images, measure_throughput, tag_agreement, fixed_benchmark_config
+
+def current_rss_mb() -> float:
+    """当前进程常驻内存（MB），仅Linux可用，其他平台返回0"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="int8动态量化评估")
+    parser.add_argument("image_dir", help="验证帧目录")
+    parser.add_argument("--limit", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+    fixed_benchmark_config()
+
+    images = load_images(args.image_dir, args.limit)
+    print(f"📊 {len(images)} 张图片, 批次 {args.batch_size}, torch线程 {torch.get_num_threads()}")
+
+    taggers = {}
+    for precision in ("fp32", "int8"):
+        rss_before = current_rss_mb()
+        tagger = WDTaggerService(device="cpu", backend="torch", precision=precision)
+        rss_delta = current_rss_mb() - rss_before
+        throughput = measure_throughput(
+            lambda batch: tagger.batch_tag_images(batch, batch_size=args.batch_size),
+            images, args.batch_size
+        )
+        print(f"{precision:>5}: 权重 {tagger.get_model_size_mb():.0f} MB, "
+              f"加载后RSS增量 {rss_delta:.0f} MB, {throughput:.2f} 张/秒")
+        taggers[precision] = tagger
+
+    results = {precision: tagger.batch_tag_images(images, batch_size=args.batch_size)
+               for precision, tagger in taggers.items()}
+    agreement = tag_agreement(results["fp32"], results["int8"])
+    print(f"标签一致性: Jaccard {agreement['mean_jaccard']:.4f}, "
+          f"完全一致 {agreement['exact_match_ratio'] * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
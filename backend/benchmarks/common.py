@@ -0,0 +1,50 @@
+"""基准测试公共工具"""
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence
+
+from PIL import Image
+
+from app.utils.config import config
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
+
+def fixed_benchmark_config():
+    """关闭标注结果缓存和批次自动调优：否则重复标注同一批图片测到的是缓存命中速度，
+    且 --batch-size 会被调优结果覆盖"""
+    config.TAG_CACHE = False
+    config.TAGGER_AUTOTUNE = False
+
+def load_images(directory: str, limit: int = 64) -> List[Image.Image]:
+    """加载目录中的前 limit 张图片（已完全解码为RGB）"""
+    paths = sorted(p for p in Path(directory).rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)[:limit]
+    if not paths:
+        raise SystemExit(f"目录中没有图片: {directory}")
+    return [Image.open(p).convert('RGB') for p in paths]
+
+def measure_throughput(run_batch: Callable[[Sequence], object], items: Sequence,
+                       batch_size: int, warmup: int = 1) -> float:
+    """返回每秒处理的条目数（预热若干批次后计时）"""
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    for batch in batches[:warmup]:
+        run_batch(batch)
+
+    start = time.perf_counter()
+    for batch in batches:
+        run_batch(batch)
+    return len(items) / (time.perf_counter() - start)
+
+def tag_agreement(results_a: Sequence, results_b: Sequence) -> Dict[str, float]:
+    """两组标注结果的标签级一致性（平均Jaccard与完全一致比例）"""
+    jaccards = []
+    exact = 0
+    for a, b in zip(results_a, results_b):
+        tags_a = set(a.general_tags) | set(a.character_tags)
+        tags_b = set(b.general_tags) | set(b.character_tags)
+        union = tags_a | tags_b
+        jaccards.append(len(tags_a & tags_b) / len(union) if union else 1.0)
+        exact += tags_a == tags_b
+    return {
+        'mean_jaccard': sum(jaccards) / len(jaccards) if jaccards else 1.0,
+        'exact_match_ratio': exact / len(jaccards) if jaccards else 1.0
+    }
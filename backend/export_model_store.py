@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+导出WD Tagger到本地模型仓库 - 在联网环境执行一次，之后可设置 TAGGER_OFFLINE=true 离线加载
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app.utils.config import config
+from app.services.model_store import LocalModelStore
+
+def main():
+    parser = argparse.ArgumentParser(description="导出WD Tagger到本地模型仓库")
+    parser.add_argument("--model", default=config.WD_MODEL_NAME, help="Hugging Face 模型名")
+    parser.add_argument("--output-dir", default=str(config.MODEL_STORE_DIR), help="本地模型仓库目录")
+    parser.add_argument("--overwrite", action="store_true", help="覆盖已存在的导出")
+    args = parser.parse_args()
+
+    store = LocalModelStore(args.model, root=Path(args.output_dir))
+    print(f"🤖 模型: {args.model}")
+    manifest = store.export(overwrite=args.overwrite)
+
+    print(f"✅ 已导出: {store.path}")
+    print(f"   权重 {manifest['weights_mb']} MB, {manifest['num_tags']} 个标签")
+    print("   拷贝该目录到推理节点的 MODEL_STORE_DIR，并设置 TAGGER_OFFLINE=true 即可离线加载")
+
+if __name__ == "__main__":
+    main()
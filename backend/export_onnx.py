@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+导出WD Tagger为ONNX模型 - 供 TAGGER_BACKEND=onnx 的CPU推理节点使用
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+import torch
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app.utils.config import config
+from app.services.wd_tagger import WDTaggerService
+
+def main():
+    parser = argparse.ArgumentParser(description="导出WD Tagger为ONNX模型")
+    parser.add_argument("--model", default=config.WD_MODEL_NAME, help="Hugging Face 模型名")
+    parser.add_argument("--output", default=None, help="ONNX文件输出路径（默认按模型名放在 ONNX_MODEL_PATH 同目录）")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset版本")
+    args = parser.parse_args()
+
+    output_path = Path(args.output or config.onnx_model_path(args.model))
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    print(f"🤖 模型: {args.model}")
+    tagger = WDTaggerService(model_name=args.model, device="cpu", backend="torch", sidecar=False)
+
+    # 输入与torch后端预处理后的张量一致，输出原始logits（sigmoid在后端中完成）
+    dummy_input = torch.randn(1, 3, 448, 448)
+    torch.onnx.export(
+        tagger.model,
+        dummy_input,
+        str(output_path),
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=args.opset,
+        do_constant_folding=True
+    )
+
+    print(f"✅ 已导出: {output_path} ({output_path.stat().st_size / 1024 / 1024:.1f} MB)")
+    print("   设置 TAGGER_BACKEND=onnx 以使用ONNX Runtime后端")
+
+if __name__ == "__main__":
+    main()
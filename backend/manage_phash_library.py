@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+跨视频感知哈希库管理脚本 - 查看统计、导入已有数据集、重建/压缩索引
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+import cv2
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from app.utils.config import config
+from app.services.phash_library import PerceptualHashLibrary, compute_phash
+
+def cmd_stats(library: PerceptualHashLibrary, args):
+    """显示哈希库统计信息"""
+    for key, value in library.stats().items():
+        print(f"  {key}: {value}")
+
+def cmd_add(library: PerceptualHashLibrary, args):
+    """把已有目录中的图片加入哈希库"""
+    image_files = sorted(
+        path for path in Path(args.directory).rglob("*")
+        if path.suffix.lower() in config.ALLOWED_IMAGE_EXTENSIONS
+    )
+    added = skipped = 0
+    for path in image_files:
+        image = cv2.imread(str(path))
+        if image is None:
+            print(f"⚠️  无法读取: {path}")
+            continue
+        phash = compute_phash(image)
+        if args.skip_duplicates and library.find_match(phash) is not None:
+            skipped += 1
+            continue
+        library.add(phash, source=str(path), commit=False)
+        added += 1
+    library.flush()
+    print(f"✅ 新增 {added} 条，跳过重复 {skipped} 条")
+
+def cmd_rebuild(library: PerceptualHashLibrary, args):
+    """合并重复条目并重建索引"""
+    result = library.rebuild()
+    print(f"✅ 重建完成: 保留 {result['kept']} 条，合并 {result['removed']} 条重复")
+
+def main():
+    parser = argparse.ArgumentParser(description="跨视频感知哈希库管理")
+    parser.add_argument("--db", default=config.PHASH_LIBRARY_PATH, help="哈希库文件路径")
+    parser.add_argument("--radius", type=int, default=config.PHASH_LIBRARY_RADIUS, help="汉明距离半径")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("stats", help="显示统计信息")
+
+    add_parser = subparsers.add_parser("add", help="导入目录中的图片")
+    add_parser.add_argument("directory", help="图片目录")
+    add_parser.add_argument("--skip-duplicates", action="store_true", help="跳过库中已有的相似图片")
+
+    subparsers.add_parser("rebuild", help="合并重复条目、重建分段索引并压缩数据库")
+
+    args = parser.parse_args()
+
+    print(f"📚 哈希库: {args.db} (半径 {args.radius})")
+    library = PerceptualHashLibrary(args.db, radius=args.radius)
+    try:
+        {"stats": cmd_stats, "add": cmd_add, "rebuild": cmd_rebuild}[args.command](library, args)
+    finally:
+        library.close()
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@
 
 import sys
 import os
+import json
 import asyncio
 from pathlib import Path
 from typing import List
@@ -16,7 +17,8 @@ project_root = Path(__file__).parent
 sys.path.insert(0, str(project_root))
 
 from app.models.video_models import ExtractedFrame, ProcessingConfig
-from app.services.wd_tagger import get_wd_tagger
+from app.utils.config import Config
+from app.services.sharded_tagger import get_bulk_tagger
 from app.services.tag_matcher import get_tag_matcher
 from app.models.tag_models import ImageTagResult
 
@@ -82,108 +84,119 @@ def scan_extracted_frames(directory: str) -> List[ExtractedFrame]:
     logger.info(f"成功加载 {len(frames)} 个帧")
     return frames
 
+def frame_result_record(frame: ExtractedFrame, tag_result: ImageTagResult) -> dict:
+    """单帧标注结果的JSON记录"""
+    return {
+        "frame_id": frame.frame_id,
+        "frame_index": frame.frame_index,
+        "timestamp": frame.timestamp,
+        "image_path": frame.image_path,
+        "scene_change_score": frame.scene_change_score,
+        "quality_score": frame.quality_score,
+        "width": frame.width,
+        "height": frame.height,
+        "file_size": frame.file_size,
+        "tags": {
+            "general": tag_result.general_tags,
+            "character": tag_result.character_tags,
+            "rating": tag_result.rating_tags
+        }
+    }
+
+class StreamingResultWriter:
+    """逐帧把标注结果写入 tagging_results.json，同时累计报告所需的统计量
+
+    结果不在内存中累积，帧数再多内存占用也保持不变。
+    """
+    
+    def __init__(self, output_dir: str):
+        self.output_path = Path(output_dir)
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.results_file = self.output_path / "tagging_results.json"
+        self._file = open(self.results_file, 'w', encoding='utf-8')
+        self._file.write("[\n")
+        self.count = 0
+        self.quality_sum = 0.0
+        self.scene_change_sum = 0.0
+        self.tag_counts = {}
+    
+    def write(self, frame: ExtractedFrame, tag_result: ImageTagResult):
+        if self.count:
+            self._file.write(",\n")
+        self._file.write(json.dumps(frame_result_record(frame, tag_result), ensure_ascii=False, indent=2))
+        self.count += 1
+        self.quality_sum += frame.quality_score
+        self.scene_change_sum += frame.scene_change_score
+        for tag_name, confidence in tag_result.general_tags.items():
+            if confidence > 0.5:  # 只统计高置信度标签
+                self.tag_counts[tag_name] = self.tag_counts.get(tag_name, 0) + 1
+    
+    def close(self, total_frames: int):
+        """结束JSON数组并生成统计报告"""
+        self._file.write("\n]\n")
+        self._file.close()
+        logger.info(f"结果已保存到: {self.results_file}")
+        
+        report_file = self.output_path / "processing_report.txt"
+        with open(report_file, 'w', encoding='utf-8') as f:
+            f.write("视频帧处理报告\n")
+            f.write("=" * 50 + "\n\n")
+            f.write(f"总帧数: {total_frames}\n")
+            f.write(f"标注帧数: {self.count}\n")
+            if self.count:
+                f.write(f"平均质量得分: {self.quality_sum / self.count:.3f}\n")
+                f.write(f"平均场景变化得分: {self.scene_change_sum / self.count:.3f}\n")
+            
+            f.write("\n最常见的标签 (置信度 > 0.5):\n")
+            sorted_tags = sorted(self.tag_counts.items(), key=lambda x: x[1], reverse=True)
+            for tag_name, count in sorted_tags[:20]:  # 显示前20个
+                f.write(f"  {tag_name}: {count} 次\n")
+        
+        logger.info(f"报告已保存到: {report_file}")
+
 async def process_frames_with_wd_tagger(frames: List[ExtractedFrame], 
-                                      config: ProcessingConfig) -> List[ImageTagResult]:
-    """使用WD标签器处理帧"""
+                                      config: ProcessingConfig,
+                                      output_dir: str) -> int:
+    """使用WD标签器流式处理帧，结果逐批写入磁盘，返回标注的帧数"""
     logger.info(f"开始标注 {len(frames)} 张图片")
     
-    # 获取WD标签器
-    wd_tagger = get_wd_tagger()
-    
-    # 加载图片
-    frame_images = []
-    frame_filenames = []
+    # 获取WD标签器（设置 TAGGER_SHARDS 时为多进程标注池）
+    wd_tagger = get_bulk_tagger()
     
-    for frame in frames:
-        img_path = Path(frame.image_path)
-        if img_path.exists():
-            try:
-                image = Image.open(img_path)
-                frame_images.append(image)
-                frame_filenames.append(img_path.name)
-            except Exception as e:
-                logger.warning(f"加载图片失败 {img_path}: {e}")
-                continue
+    frames = [frame for frame in frames if Path(frame.image_path).exists()]
+    writer = StreamingResultWriter(output_dir)
+    skipped = set()
     
-    logger.info(f"成功加载 {len(frame_images)} 张图片")
+    def skip_image(filename: str, error: Exception):
+        logger.warning(f"加载图片失败 {filename}: {error}")
+        skipped.add(filename)
     
-    # 批量标注
+    # 流式批量标注：同一时间只打开/解码一个批次的图片
     try:
-        frame_tag_results = wd_tagger.batch_tag_images(
-            images=frame_images,
-            filenames=frame_filenames,
+        batches = wd_tagger.iter_tag_images(
+            images=(frame.image_path for frame in frames),
+            filenames=(Path(frame.image_path).name for frame in frames),
             general_threshold=config.general_tag_threshold,
             character_threshold=config.character_tag_threshold,
-            batch_size=config.batch_size
+            batch_size=Config.explicit_option(config, 'batch_size'),  # 未指定时由标注器决定
+            on_error=skip_image
         )
+        # 惰性过滤：批次产出前其中无法读取的图片已经回调，跳过对应的帧，结果与帧保持对齐
+        frame_iter = (frame for frame in frames if Path(frame.image_path).name not in skipped)
+        for batch_results in batches:
+            for tag_result in batch_results:
+                writer.write(next(frame_iter), tag_result)
         
-        logger.info(f"标注完成，得到 {len(frame_tag_results)} 个结果")
-        return frame_tag_results
+        if skipped:
+            logger.warning(f"跳过 {len(skipped)} 张无法读取的图片")
+        logger.info(f"标注完成，得到 {writer.count} 个结果")
+        return writer.count
         
     except Exception as e:
         logger.error(f"批量标注失败: {e}")
-        return []
-
-def save_results(frames: List[ExtractedFrame], 
-                tag_results: List[ImageTagResult],
-                output_dir: str):
-    """保存处理结果"""
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
-    
-    # 保存标签结果到JSON
-    import json
-    
-    results_data = []
-    for i, (frame, tag_result) in enumerate(zip(frames, tag_results)):
-        result = {
-            "frame_id": frame.frame_id,
-            "frame_index": frame.frame_index,
-            "timestamp": frame.timestamp,
-            "image_path": frame.image_path,
-            "scene_change_score": frame.scene_change_score,
-            "quality_score": frame.quality_score,
-            "width": frame.width,
-            "height": frame.height,
-            "file_size": frame.file_size,
-            "tags": {
-                "general": tag_result.general_tags,
-                "character": tag_result.character_tags,
-                "rating": tag_result.rating_tags
-            }
-        }
-        results_data.append(result)
-    
-    # 保存到文件
-    results_file = output_path / "tagging_results.json"
-    with open(results_file, 'w', encoding='utf-8') as f:
-        json.dump(results_data, f, ensure_ascii=False, indent=2)
-    
-    logger.info(f"结果已保存到: {results_file}")
-    
-    # 生成统计报告
-    report_file = output_path / "processing_report.txt"
-    with open(report_file, 'w', encoding='utf-8') as f:
-        f.write("视频帧处理报告\n")
-        f.write("=" * 50 + "\n\n")
-        f.write(f"总帧数: {len(frames)}\n")
-        f.write(f"标注帧数: {len(tag_results)}\n")
-        f.write(f"平均质量得分: {sum(f.quality_score for f in frames) / len(frames):.3f}\n")
-        f.write(f"平均场景变化得分: {sum(f.scene_change_score for f in frames) / len(frames):.3f}\n")
-        
-        # 统计最常见的标签
-        all_tags = {}
-        for tag_result in tag_results:
-            for tag_name, confidence in tag_result.general_tags.items():
-                if confidence > 0.5:  # 只统计高置信度标签
-                    all_tags[tag_name] = all_tags.get(tag_name, 0) + 1
-        
-        f.write("\n最常见的标签 (置信度 > 0.5):\n")
-        sorted_tags = sorted(all_tags.items(), key=lambda x: x[1], reverse=True)
-        for tag_name, count in sorted_tags[:20]:  # 显示前20个
-            f.write(f"  {tag_name}: {count} 次\n")
-    
-    logger.info(f"报告已保存到: {report_file}")
+        return writer.count
+    finally:
+        writer.close(total_frames=len(frames))
 
 async def main():
     """主函数"""
@@ -194,6 +207,7 @@ async def main():
     if len(sys.argv) < 2:
         print("用法: python process_extracted_frames.py <帧目录> [输出目录]")
         print("示例: python process_extracted_frames.py E:/Git_my/auto-pic-gen/backend/outputs/video_1_103932-1080p")
+        print("多进程CPU标注: TAGGER_SHARDS=8 TAGGER_SHARD_THREADS=8 python process_extracted_frames.py <帧目录>")
         sys.exit(1)
     
     frame_directory = sys.argv[1]
@@ -218,23 +232,18 @@ async def main():
             quality_threshold=0.5,
             tag_threshold=0.35,
             character_tag_threshold=0.75,
-            general_tag_threshold=0.35,
-            batch_size=8  # 降低批处理大小避免内存问题
+            general_tag_threshold=0.35  # 不指定batch_size：TAGGER_AUTOTUNE 开启时由标注器自动调优，否则为16
         )
         
-        # 3. 进行WD标注
-        print("🏷️  步骤2: WD标签标注...")
-        tag_results = await process_frames_with_wd_tagger(frames, config)
-        if not tag_results:
+        # 3. 进行WD标注（结果边标注边写入输出目录）
+        print("🏷️  步骤2: WD标签标注并保存结果...")
+        tagged_count = await process_frames_with_wd_tagger(frames, config, output_directory)
+        if not tagged_count:
             print("❌ 标注失败")
             sys.exit(1)
         
-        # 4. 保存结果
-        print("💾 步骤3: 保存结果...")
-        save_results(frames, tag_results, output_directory)
-        
         print("✅ 处理完成!")
-        print(f"📊 处理了 {len(frames)} 帧，标注了 {len(tag_results)} 帧")
+        print(f"📊 处理了 {len(frames)} 帧，标注了 {tagged_count} 帧")
         print(f"📁 结果保存在: {output_directory}")
         
     except Exception as e:
@@ -0,0 +1,91 @@
+"""场景级标注回归测试 - 用桩标注器运行 SceneGroupTagger.tag_frames"""
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("torch")
+
+from app.services.scene_tagger import SceneGroupTagger
+from app.services.tag_decoder import TagDecoder
+
+TAG_NAMES = ['general', 'sensitive', 'questionable', 'explicit', 'long_hair', 'smile', 'hatsune_miku']
+TAG_CATEGORIES = [9, 9, 9, 9, 0, 0, 4]
+
+class StubTagger:
+    """按文件名返回固定概率的标注器，记录实际送入标注的文件"""
+
+    def __init__(self, probs_by_name):
+        self.decoder = TagDecoder(TAG_NAMES, TAG_CATEGORIES)
+        self.probs_by_name = probs_by_name
+        self.tagged = []
+
+    def batch_tag_images(self, images, filenames, general_threshold, character_threshold,
+                         batch_size, probs_callback=None, embeddings_callback=None, compact=False,
+                         bypass_cache=False):
+        assert compact and bypass_cache
+        list(images)
+        self.tagged.extend(filenames)
+        probs = np.stack([self.probs_by_name[name] for name in filenames]).astype(np.float32)
+        if probs_callback is not None:
+            probs_callback(0, probs)
+        return self.decoder.decode_compact(probs, filenames, general_threshold, character_threshold)
+
+def _write_frame(directory: Path, name: str, value: int) -> str:
+    path = directory / name
+    cv2.imwrite(str(path), np.full((128, 128, 3), value, dtype=np.uint8))
+    return str(path)
+
+@pytest.fixture
+def scene_frames(tmp_path):
+    """两个场景：场景0有三帧（其中一帧画面差异很大），场景1只有一帧"""
+    specs = [('f0.png', 100, 0, 0.9), ('f1.png', 102, 0, 0.5), ('f2.png', 250, 0, 0.4), ('f3.png', 30, 1, 0.8)]
+    frames, metadata = [], {}
+    for name, value, segment, quality in specs:
+        frame = SimpleNamespace(frame_id=name[:-4], image_path=_write_frame(tmp_path, name, value),
+                                quality_score=quality)
+        frames.append(frame)
+        metadata[frame.frame_id] = {'scene_segment': segment}
+    return frames, metadata
+
+def _probs(*values):
+    return np.array([0.9, 0.05, 0.01, 0.0, *values])
+
+def test_tag_frames_returns_results_for_every_frame(scene_frames):
+    frames, metadata = scene_frames
+    tagger = StubTagger({
+        'f0.png': _probs(0.8, 0.1, 0.9),
+        'f2.png': _probs(0.1, 0.7, 0.2),
+        'f3.png': _probs(0.6, 0.6, 0.1)
+    })
+
+    results, stats = SceneGroupTagger(tagger, verify_threshold=0.12).tag_frames(frames, metadata)
+
+    assert len(results) == len(frames)
+    assert results.filenames == ['f0.png', 'f1.png', 'f2.png', 'f3.png']
+    assert sorted(tagger.tagged) == ['f0.png', 'f2.png', 'f3.png']
+    assert stats == {'scenes': 2, 'tagged_frames': 3, 'propagated_frames': 1, 'verified_frames': 1}
+
+    # f1 与代表帧 f0 几乎相同，复制其标签；f2 差异过大，单独补标
+    assert set(results.tag_dict(1)) == {'long_hair', 'hatsune_miku'}
+    assert results.tag_dict(1) == results.tag_dict(0)
+    assert metadata['f1']['tag_source'] == 'f0'
+    assert set(results.tag_dict(2)) == {'smile'}
+    assert set(results.tag_dict(3)) == {'long_hair', 'smile'}
+
+def test_tag_frames_without_verification_propagates_whole_scene(scene_frames):
+    frames, metadata = scene_frames
+    tagger = StubTagger({'f0.png': _probs(0.8, 0.1, 0.9), 'f3.png': _probs(0.6, 0.6, 0.1)})
+
+    results, stats = SceneGroupTagger(tagger, verify_threshold=None).tag_frames(frames, metadata)
+
+    assert len(results) == len(frames)
+    assert stats['propagated_frames'] == 2
+    assert results.tag_dict(2) == results.tag_dict(0)